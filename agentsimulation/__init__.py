@@ -16,4 +16,47 @@ def log_interp1d(xx, yy, kind='linear'):
     logy = numpy.log10(yy)
     lin_interp = sp.interpolate.interp1d(xx, logy, kind=kind)
     log_interp = lambda zz: numpy.power(10.0, lin_interp(zz))
-    return log_interp
\ No newline at end of file
+    return log_interp
+
+class LogLinearTrajectory(object):
+    """
+        A viral-load curve that is linear in log10 between y0 (at 0) and y1 (at duration).
+
+        The same as log_interp1d([0,duration],[y0,y1]), but the log10 of the start value
+        and the slope are computed once, so an evaluation is a multiplication and a power.
+
+        The duration, y0 and y1 can be numpy arrays (one curve for each replicate).
+        Indexing returns the curves of the selected replicates.
+    """
+    __slots__ = ("logy0","slope")
+
+    def __init__(self, duration, y0, y1, logy0=None, slope=None):
+        """
+        :param duration:
+                The length of the phase [s].
+        :param y0:
+                The value at 0.
+        :param y1:
+                The value at the duration.
+        """
+        if logy0 is None:
+            logy0 = numpy.log10(y0)
+            slope = (numpy.log10(y1) - logy0) / duration
+
+        self.logy0 = logy0
+        self.slope = slope
+
+    def __call__(self, elapsed):
+        """
+            Evaluate the curve.
+
+        :param elapsed:
+                The time since the start of the phase [s] (number or array).
+        :return:
+        """
+        return numpy.power(10.0, self.logy0 + self.slope * elapsed)
+
+    def __getitem__(self, idx):
+        logy0 = self.logy0[idx] if numpy.ndim(self.logy0) > 0 else self.logy0
+        slope = self.slope[idx] if numpy.ndim(self.slope) > 0 else self.slope
+        return LogLinearTrajectory(None, None, None, logy0=logy0, slope=slope)
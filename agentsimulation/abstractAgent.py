@@ -3,21 +3,36 @@ import numpy
 from random import Random
 from unum import Unum
 from unum.units import *
+from .history import HistoryRecorder,SummaryRecorder,DecimatedRecorder,FLOAT,DATETIME,CONSTANT
+from .parameters import RECORD_EVERY_STEP,RECORD_STEPS,RECORD_INTERVAL,RECORD_ON_EVENT
 
 class Agent(object):
-    _history = None
+    _history = None         # HistoryRecorder (or SummaryRecorder if the full data is not collected).
     _loggingFields = None
 
     _fieldChange = None # holds fields names and their change (after *dt).
 
     _agentType = None
 
+    _parameters = None      # The compiled (SI floats) parameters of the agent type.
+    _eventHandlers = None   # action name -> bound handler.
+
+    _historyUnits = {}      # column -> (display unit, SI unit) of the history fields that are held in SI floats.
+    _summedColumns = []     # The history fields that are summed in summary() (the changes in a step).
+    _eventColumns = []      # The history fields that are not zero in a step when something happened.
+
+    _sharedFields = ("model","_parameters","_eventHandlers") # The references that the constructor sets (not in getState).
+
     model = None
 
     @property
     def settings(self):
         return self.model.settings[self._agentType]
 
+    @property
+    def parameters(self):
+        return self._parameters
+
     @property
     def agentType(self):
         return self._agentType
@@ -32,8 +47,8 @@ class Agent(object):
                 ref to the model
         :param agentType: str
                 type of agent. In single room simulation can be 'person' or 'room'.
-                In the aircabin can be 'passenger','seatingCompartment','aisle','kitchen','toilets',
-                'airCrew'.
+                In the aircabin, the passengers and the air crew are 'person' and the cabin and
+                its compartments (seat rows and galleys) are 'room' (see aircabin).
 
         :param loggingFields: list
                 The list of parameters to hold the history for.
@@ -41,29 +56,102 @@ class Agent(object):
 
         self.unique_id = unique_id
         self.model = model
-        self._history = []
-        self._loggingFields = loggingFields
+        self._loggingFields = list(loggingFields)
         self._agentType = agentType
         self._fieldChange = {}
 
+        self._parameters = getattr(model.parameters, agentType)
+        self._history = self._createHistory()
+        self._eventHandlers = {}
+        for actionList in self._parameters.actions.values():
+            for action in actionList:
+                self._eventHandlers[action.name] = getattr(self, action.handler)
+
+    def getState(self):
+        """
+            The state of the agent (see Model.checkpoint).
+
+            The references to the model, the parameters and the other agents (_sharedFields)
+            are set by the constructor and are not part of the state.
+        :return:
+            dict field -> value (not copied).
+        """
+        return dict([(key,value) for key,value in vars(self).items() if key not in self._sharedFields])
+
+    def setState(self,state):
+        """
+            Restore the state (from getState).
+        :param state: dict
+        """
+        self.__dict__.update(state)
+
+    def _createHistory(self):
+        """
+            Declare the columns of the history.
+
+            The default history holds the AgentID, the date and the logging fields (as floats).
+        :return:
+            HistoryRecorder
+        """
+        columns = [("AgentID",CONSTANT),("date",DATETIME)] + [(field,FLOAT) for field in self._loggingFields]
+        units   = dict([(col,unit) for col,unit in self._historyUnits.items() if col in self._loggingFields])
+        return self._newHistory(columns,units=units,constants=dict(AgentID=self.unique_id))
+
+    def _newHistory(self,columns,**kwargs):
+        """
+            Return the recorder of the history.
+
+            If simulation.collectFullData is false, the agent keeps only the last row
+            and the sums of the _summedColumns (SummaryRecorder). Otherwise, the rows
+            are written according to simulation.recording (see DecimatedRecorder).
+
+        :param columns: list
+                list of (name,kind), see HistoryRecorder.
+        :param kwargs:
+                The other parameters of HistoryRecorder.
+        :return:
+            HistoryRecorder
+        """
+        simulation = self.model.parameters.simulation
+        if not simulation.collectFullData:
+            return SummaryRecorder(columns,sumColumns=self._summedColumns,**kwargs)
+        elif simulation.recordingPolicy == RECORD_EVERY_STEP:
+            return HistoryRecorder(columns,sumColumns=self._summedColumns,**kwargs)
+        else:
+            interval = simulation.recordingInterval
+            return DecimatedRecorder(columns,
+                                     steps=simulation.recordingSteps if simulation.recordingPolicy == RECORD_STEPS else None,
+                                     interval=int(interval*1e9) if simulation.recordingPolicy == RECORD_INTERVAL else None,
+                                     eventColumns=self._eventColumns if simulation.recordingPolicy == RECORD_ON_EVENT else None,
+                                     sumColumns=self._summedColumns,
+                                     **kwargs)
+
     def history(self,unitless=False):
         """
-            If true, remove the units.
+            Return the history.
+
+            The fields in _historyUnits are held in SI floats and are
+            converted here to their display units.
+
+            If the full data is not collected, the history has only the last row.
+
         :param unitless:
+                If true, return numbers (in the display units). Otherwise, return unum objects.
         :return:
             pandas.DataFrame
         """
-        pandasData = pandas.DataFrame(self._history)
-        if unitless:
-            unitless_pandasData = pandas.DataFrame()
-            for col in pandasData.columns:
-                if isinstance(pandasData[col].iloc[0],Unum):
-                    unitless_pandasData = unitless_pandasData.assign(**{col : [x.asNumber() for x in pandasData[col]]})
-                else:
-                    unitless_pandasData[col]=pandasData[col]
+        return self._history.toDataFrame(unitless=unitless)
+
+    def summary(self,unitless=True):
+        """
+            Return the last row of the history and the sums of the changes (sum_<field>).
 
-            pandasData = unitless_pandasData
-        return pandasData
+        :param unitless:
+                If true, return numbers (in the display units). Otherwise, return unum objects.
+        :return:
+            dict
+        """
+        return self._history.summary(unitless=unitless)
 
     @property
     def hisoryUnits(self):
@@ -72,27 +160,31 @@ class Agent(object):
         :return:
            dict
         """
-        pandasData = pandas.DataFrame(self._history)
-        ret = {}
-        for col in pandasData.columns:
-            if isinstance(pandasData[col].iloc[0], Unum):
-                ret[col] = pandasData[col].iloc[0].strUnit()
-
-        return ret
+        return self._history.historyUnits()
 
     @property
     def random(self) -> Random:
         return self.model.random
 
+    def randomStream(self,name):
+        """
+            The random generator of a stream of draws of the agent (see Model.randomStream).
+
+        :param name: str
+                The name of the stream (an action, incubation...).
+        """
+        return self.model.randomStream(f"{self.unique_id}/{name}")
+
     def addLoggingFields(self,fieldNameList):
-        self._loggingFields += numpy.atleast_1d(fieldNameList)
+        """
+            Add fields to the history. Must be called before the simulation starts (the history is cleared).
+        """
+        self._loggingFields += list(numpy.atleast_1d(fieldNameList))
+        self._history = self._createHistory()
 
 
     def collect(self):
-        ret = dict(AgentID=self.unique_id,date=self.model.getCurrentDatetime)
-        for field in self._loggingFields:
-            ret[field] = getattr(self,field)
-        self._history.append(ret)
+        self._history.record([getattr(self,field) for field in self._loggingFields],(self.model.simulationStartNs + self.model.currentTimeNs,))
 
     @property
     def currentState(self):
@@ -106,18 +198,10 @@ class Agent(object):
 
         :param state:
         :return:
+            tuple of parameters.ActionParameters (frequency in [1/s]).
         """
         theState = self.currentState if state is None else state
-
-        actionList = []
-        for event, eventData in self.settings["actions"].items():
-            name = event
-            freq = eventData["frequency"][theState] if isinstance(eventData["frequency"], dict) \
-                else eventData["frequency"]
-
-            actionList.append(dict(name=name, frequency=freq))
-
-        return actionList
+        return self._parameters.actions[theState]
 
     def handle_event(self):
         """
@@ -138,7 +222,7 @@ class Agent(object):
                 datetime.timedelat.
         """
         mead_day = mean.asNumber(d)
-        inc = self.random.lognormal(numpy.log(mead_day),std)
+        inc = self.randomStream("incubation").lognormal(numpy.log(mead_day),std)
         return pandas.to_timedelta("%sd" % inc)
 
     def func_const(self,const):
@@ -148,25 +232,58 @@ class Agent(object):
         return pandas.to_timedelta(f"{const}d")
 
 class AgentEquiDistance(Agent):
-    """ Base class for a model agent. """
+    """
+        Base class for a model agent.
+
+        The events are drawn in advance (fillEvents) and are held in a calendar of
+        sorted arrays: the time of the event [ns from the simulation start] and the code of the action (the index in _eventNames).
+        The events are consumed by advancing a cursor.
+    """
 
-    _eventList = None
-    _upcomingEvent = None
-    _passedEvents  = None
+    _eventTime   = None # numpy int64 [ns].
+    _eventAction = None # numpy int, the index of the action name in _eventNames.
+    _eventNames  = None # list of action names.
+    _eventCursor = None # The index of the upcoming event.
 
     @property
     def upcomingEvent(self):
-        return self._upcomingEvent
+        """
+            The next event that was not handled.
+        :return:
+            dict(date=..., name=..., agent=...) or None
+        """
+        if self._eventCursor >= len(self._eventTime):
+            return None
+
+        return dict(date=self.model.toDatetime(self._eventTime[self._eventCursor]),
+                    name=self._eventNames[self._eventAction[self._eventCursor]],
+                    agent=self.unique_id)
+
+    @property
+    def upcomingEventTime(self):
+        """
+            The time of the next event that was not handled [ns from the simulation start], or None.
+        """
+        return self._eventTime[self._eventCursor] if self._eventCursor < len(self._eventTime) else None
 
     @property
     def passedEvents(self):
-        return self._passedEvents
+        """
+            The events that were handled.
+        :return:
+            pandas.DataFrame with the columns date, name and agent.
+        """
+        return pandas.DataFrame(dict(date=pandas.to_datetime(self.model.simulationStartNs + self._eventTime[:self._eventCursor]),
+                                     name=numpy.array(self._eventNames,dtype=object)[self._eventAction[:self._eventCursor]],
+                                     agent=self.unique_id))
 
     def __init__(self, unique_id, model,agentType, loggingFields=[]):
         """ Create a new agent. """
         super().__init__(unique_id,model,agentType,loggingFields)
-        self._eventList = []
-        self._passedEvents = []
+        self._eventTime   = numpy.zeros(0,dtype=numpy.int64)
+        self._eventAction = numpy.zeros(0,dtype=numpy.int64)
+        self._eventNames  = []
+        self._eventCursor = 0
 
     def step(self):
         """ A single step of the agent. """
@@ -180,56 +297,50 @@ class AgentEquiDistance(Agent):
             and spread equally over time.
 
         :param actionList: list
-                The list of actions.
+                The list of additional actions (parameters.ActionParameters).
                 each action is defined by name and by frequency.
 
-                dict(name=..., frequency=...)
-
-        :param SimulationStartTime: datetime
-                The date of the begining of the simulation.
-        :param TotalSimulationTime: unum
-                The total time of the simulation.
+        :param fromTime: int
+                The begining of the simulation [ns from the simulation start].
+        :param totalTime: float
+                The total time of the simulation [s].
         :return:
         """
 
         cActionList = self.getActionList(agentState)
 
-        actionList = cActionList if actionList is None else cActionList+actionList
+        actionList = cActionList if actionList is None else cActionList+tuple(actionList)
 
+        eventTime   = [self._eventTime[self._eventCursor:]]
+        eventAction = [self._eventAction[self._eventCursor:]]
         for action in actionList:
-            eventsFrequency = action["frequency"]
-            events = self.random.poisson((totalTime * eventsFrequency).asNumber())
-            eventsTimeDelta =  pandas.to_timedelta("%sm" % totalTime.asNumber(min)) / (events + 1)
-            for eventIndex in range(1,events+1):
-                self._eventList.append(dict(
-                                        date=fromTime + eventIndex * eventsTimeDelta,
-                                        name= action['name'],
-                                        agent=self.unique_id
-                                    )
-                                 )
-        self._eventList.sort(key=lambda x: x['date'])
+            if action.name not in self._eventNames:
+                self._eventNames.append(action.name)
+
+            events = self.randomStream(action.name).poisson(totalTime * action.frequency)
+            eventsTimeDelta =  pandas.to_timedelta(totalTime, unit='s') / (events + 1)
+
+            eventTime.append(fromTime + numpy.arange(1,events+1,dtype=numpy.int64)*eventsTimeDelta.value)
+            eventAction.append(numpy.full(events,self._eventNames.index(action.name),dtype=numpy.int64))
+
+        eventTime   = numpy.concatenate(eventTime)
+        eventAction = numpy.concatenate(eventAction)
+        order = numpy.argsort(eventTime,kind='stable')
+
+        self._eventTime   = numpy.concatenate([self._eventTime[:self._eventCursor],eventTime[order]])
+        self._eventAction = numpy.concatenate([self._eventAction[:self._eventCursor],eventAction[order]])
 
     def handle_event(self):
-        loopEvent = True
-        while loopEvent:
-            if self.upcomingEvent is None:
-                if len(self._eventList) >0:
-                    self._upcomingEvent = self._eventList.pop(0)
-                else:
-                    loopEvent = False
-            elif self.upcomingEvent["date"] == self.model.getCurrentDatetime:
-
-                fname = f"event_{self.upcomingEvent['name']}"
-                self._fieldChange[fname] = self._fieldChange.get(fname,0)+1
-
-                getattr(self,"_event_handle_%s" % self.upcomingEvent['name'])()
-                self._passedEvents.append(self.upcomingEvent)
-                if len(self._eventList) >0:
-                    self._upcomingEvent = self._eventList.pop(0)
-                else:
-                    self._upcomingEvent = None
-            else:
-                loopEvent = False
+        currentTime = self.model.currentTimeNs
+        eventTime   = self._eventTime
+        while self._eventCursor < len(eventTime) and eventTime[self._eventCursor] == currentTime:
+            name = self._eventNames[self._eventAction[self._eventCursor]]
+
+            fname = f"event_{name}"
+            self._fieldChange[fname] = self._fieldChange.get(fname,0)+1
+
+            self._eventHandlers[name]()
+            self._eventCursor += 1
 
 
 class AgentEvents(Agent):
@@ -249,19 +360,275 @@ class AgentEvents(Agent):
         :return:
         """
 
-        cActionList = self.getActionList()
-
-        # get the currect action list (according to the time).
-        #actionList = [x for x in cActionList if (x['fromTime']<=self.model.getCurrentDatetime and x['toTime']>=self.model.getCurrentDatetime)][0]
-        for action in cActionList: #['actions']:
-            eventsFrequency = action["frequency"]
-            events = self.random.poisson((self.model.dt * eventsFrequency).asNumber())
+        dt = self.model.dt
+        for action in self._parameters.actions[self.currentState]:
+            events = self.randomStream(action.name).poisson(dt * action.frequency)
 
             if events > 0:
-                fname = f"event_{action['name']}"
-                self._fieldChange[fname] = self._fieldChange.get(fname,0)+1
-                getattr(self, "_event_handle_%s" % action['name'])()
+                self._fieldChange[action.fieldName] = self._fieldChange.get(action.fieldName,0)+1
+                self._eventHandlers[action.name]()
 
                 #if action['name'] =='washHands' and self.unique_id=='primary':
                 #    print(events,action,self._fieldChange.get(fname,0))
 
+
+class AgentTauLeaping(Agent):
+    """
+        This implementation randomizes the number of events of each action in a leap
+        and handles all of them (the handlers add the change of each event to _fieldChange).
+
+        The model chooses the leap so that the state changes little in it (see relativeChangeRate).
+    """
+
+    def __init__(self, unique_id, model,agentType, loggingFields=[]):
+        """ Create a new agent. """
+        super().__init__(unique_id,model,agentType,loggingFields)
+
+    def relativeChangeRate(self):
+        """
+            The largest relative rate of change of the state of the agent [1/s].
+        """
+        raise NotImplementedError("Implement in child")
+
+    def handle_event(self):
+        """
+            random the poisson number of events of each action in the leap and handle them.
+        :return:
+        """
+        dt = self.model.dt
+        for action in self._parameters.actions[self.currentState]:
+            events = self.randomStream(action.name).poisson(dt * action.frequency)
+
+            if events > 0:
+                self._fieldChange[action.fieldName] = self._fieldChange.get(action.fieldName,0)+events
+                for i in range(events):
+                    self._eventHandlers[action.name]()
+
+
+class AgentNextEvent(Agent):
+    """
+        This implementation handles one event at a time.
+
+        The model draws the time to the next event from the total rate of the actions of all the agents,
+        and the agent handles the action that was selected (with probability proportional to its rate).
+    """
+
+    _totalRates = None # state -> the sum of the action rates [1/s].
+
+    def __init__(self, unique_id, model,agentType, loggingFields=[]):
+        """ Create a new agent. """
+        super().__init__(unique_id,model,agentType,loggingFields)
+        self._totalRates = dict([(state,sum([action.frequency for action in actionList]))
+                                 for state,actionList in self._parameters.actions.items()])
+
+    def totalRate(self):
+        """
+            The sum of the rates of the actions in the current state [1/s].
+        """
+        return self._totalRates[self.currentState]
+
+    def handle_event(self,rate):
+        """
+            Handle the action that its cumulative rate first exceeds rate.
+
+        :param rate: float
+                uniform in [0,totalRate()).
+        :return:
+        """
+        for action in self._parameters.actions[self.currentState]:
+            rate -= action.frequency
+            if rate < 0:
+                self._fieldChange[action.fieldName] = self._fieldChange.get(action.fieldName,0)+1
+                self._eventHandlers[action.name]()
+                break
+
+
+class AgentMeanField(Agent):
+    """
+        This implementation does not draw the events: every action happens at its rate.
+
+        handle_event() calls the rate handler of each action (_rate_handle_<name>) with its frequency
+        in the current state. The rate handlers add the expected change per second to _fieldChange
+        (the fields that the event handlers change), and the event counters get the rate.
+
+        The variables of the ODE of the agent are the attributes in _odeFields and the integrals
+        of the fields in _routeFields (the expected total of each route since the simulation start).
+    """
+
+    _rateHandlers = None    # action name -> bound rate handler.
+    _odeFields    = ()      # The attributes that are variables of the ODE.
+    _routeFields  = ()      # The fields of _fieldChange whose integral is a variable of the ODE.
+    _routeTotals  = None    # field -> the integral of the field since the simulation start.
+
+    _sharedFields = Agent._sharedFields + ("_rateHandlers",)
+
+    def __init__(self, unique_id, model,agentType, loggingFields=[]):
+        """ Create a new agent. """
+        super().__init__(unique_id,model,agentType,loggingFields)
+        self._rateHandlers = {}
+        for actionList in self._parameters.actions.values():
+            for action in actionList:
+                self._rateHandlers[action.name] = getattr(self, f"_rate_handle_{action.name}")
+        self._routeTotals = {}
+
+    def handle_event(self):
+        """
+            Add the rates of the actions in the current state to _fieldChange.
+        :return:
+        """
+        for action in self._parameters.actions[self.currentState]:
+            self._fieldChange[action.fieldName] = self._fieldChange.get(action.fieldName,0)+action.frequency
+            self._rateHandlers[action.name](action.frequency)
+
+    def resetRates(self):
+        """
+            Zero the rates in _fieldChange (before handle_event).
+        """
+        for field in self._fieldChange:
+            self._fieldChange[field] = 0.
+
+    def odeState(self):
+        """
+            The variables of the ODE of the agent: the _odeFields and then the totals of the _routeFields.
+        :return:
+            numpy.array
+        """
+        return numpy.array([getattr(self,field) for field in self._odeFields] +
+                           [self._routeTotals.get(field,0.) for field in self._routeFields])
+
+    def setOdeState(self,y):
+        """
+            Set the variables of the ODE (see odeState).
+        :param y: numpy.array
+        """
+        values = y.tolist()
+        for field,value in zip(self._odeFields,values):
+            setattr(self,field,value)
+
+        self._routeTotals = dict(zip(self._routeFields,values[len(self._odeFields):]))
+
+    def derivative(self):
+        """
+            The derivative of the variables of the ODE (in the order of odeState).
+            Called after handle_event of all the agents.
+        :return:
+            numpy.array
+        """
+        raise NotImplementedError("Implement in child")
+
+    def collectChanges(self,previous):
+        """
+            Set the field changes to the expected changes since previous and add a row to the history.
+
+        :param previous: numpy.array
+                The variables of the ODE at the previous row (see odeState).
+        """
+        changes = self.odeState() - previous
+        for field,value in zip(self._routeFields,changes[len(self._odeFields):]):
+            self._fieldChange[field] = value
+        self.collect()
+
+
+class AgentBatched(Agent):
+    """
+        Advances R replicates of the agent at once.
+
+        The state of the agent is held in numpy arrays of length R (one entry for each replicate).
+        Every time step, the number of events of each action is randomized for all the replicates
+        in one call and the handlers get the indices of the replicates in which the event took place.
+
+        Replicates that ended are removed from the arrays (see compact).
+
+        The Crowd method uses the same arrays for the occupants of a room (see arrayLength).
+    """
+
+    _replicateArrays = None # The names of the attributes that hold the per-replicate arrays.
+
+    _actionRates = None     # list of (action, rate array [1/s] by state code).
+
+    @property
+    def replicates(self):
+        return self.model.replicates
+
+    @property
+    def arrayLength(self):
+        """
+            The length of the arrays of the agent (the number of running replicates).
+        """
+        return self.model.runningReplicates
+
+    def __init__(self, unique_id, model,agentType, loggingFields=[]):
+        """ Create a new agent. """
+        super().__init__(unique_id,model,agentType,loggingFields)
+        self._replicateArrays = []
+
+        self._actionRates = []
+        states = list(self._parameters.actions.keys())
+        for actionIndex,action in enumerate(self._parameters.actions[states[0]]):
+            rates = numpy.array([self._parameters.actions[state][actionIndex].frequency for state in states])
+            self._actionRates.append((action,rates))
+
+    def addReplicateArray(self,name,value):
+        """
+            Set a per-replicate array attribute.
+
+        :param name: str
+                The name of the attribute.
+        :param value: numpy.array
+                The initial value.
+        """
+        setattr(self,name,value)
+        self._replicateArrays.append(name)
+
+    def compact(self,keep):
+        """
+            Keep only the replicates in keep.
+
+        :param keep: numpy.array of bool
+                True for the replicates that are still running.
+        """
+        for name in self._replicateArrays:
+            setattr(self,name,getattr(self,name)[keep])
+
+    @property
+    def currentStateCode(self):
+        """
+            The index of the state in the actions dispatch table.
+            None when the actions do not depend on the state.
+        :return:
+            numpy.array of int or None
+        """
+        return None
+
+    def handle_event(self):
+        """
+            random a poisson event for all the replicates to see if the event takes place.
+        :return:
+        """
+        dt = self.model.dt
+        stateCode = self.currentStateCode
+        size = self.arrayLength
+
+        for action,rates in self._actionRates:
+            lam = dt*rates[0] if stateCode is None else dt*rates[stateCode]
+            events = self.random.poisson(lam,size=size)
+
+            eventIndices = numpy.flatnonzero(events)
+            if len(eventIndices) > 0:
+                self._eventHandlers[action.name](eventIndices)
+
+    def func_lognormal(self,mean,std):
+        """
+            return incubation time that distributes lognormally for all the replicates.
+        :param mean:
+                the mean incubation time.
+        :param std:
+                the std
+        :return:
+                numpy.array [s].
+        """
+        mead_day = mean.asNumber(d)
+        return self.random.lognormal(numpy.log(mead_day),std,size=self.arrayLength)*86400.
+
+    def func_const_td(self,const):
+        return numpy.full(self.arrayLength,const*86400.)
@@ -0,0 +1,607 @@
+"""
+    The aircabin scenario.
+
+    The cabin is a chain of compartments: the front galley, the seat-row compartments
+    (aircabin.rowsPerCompartment rows each) and the rear galley (with the toilets).
+    Adjacent compartments exchange air (aircabin.ventilation.longitudinalFlow) and every compartment
+    is ventilated with clean air (aircabin.ventilation.airChangeRate). The air is advanced with
+    the sparse implicit step of airflow.AirflowNetwork.
+
+    - The passengers are held in one agent whose fields are numpy arrays (one entry for each seat),
+      as in the Crowd method. They breathe the air and touch the fomite and the stains of the compartment of their seat,
+      and have social contacts with the passengers of their compartment.
+
+    - The air crew are person agents (AgentEvents). A crew member stays in a compartment for
+      a random (exponential) residence time and then walks to an adjacent compartment
+      (Room.leaveRoom and Room.enterRoom).
+
+    - The cabin agent holds the air and the fomite of the compartments (arrays), and the compartments
+      (rooms) hold the stains.
+
+    The aircabin.indexCases passengers (in random seats) are infected (at the maximal viral load) when the flight starts.
+    The person and the room settings are used for the passengers, the crew and the fomite of the compartments.
+"""
+import copy
+import time
+
+import numpy
+import pandas
+
+from . import abstractAgent
+from . import SUSCEPTIBLE
+from .parameters import PERSON_STATES
+from .person import Person
+from .room import Room, StainStore
+from .model import Model
+from .airflow import AirflowNetwork
+from .batched import BatchedPerson, SUSCEPTIBLE_CODE, INFECTED_CODE
+
+
+def getPassengersClass():
+    return type('person', (Passengers, abstractAgent.AgentBatched), {})
+
+
+def getAirCrewClass():
+    return type('person', (AirCrew, abstractAgent.AgentEvents), {})
+
+
+def getCabinClass():
+    return type('room', (Cabin, abstractAgent.AgentBatched), {})
+
+
+def getCompartmentClass():
+    return type('room', (CabinCompartment, abstractAgent.AgentEvents), {})
+
+
+class Passengers(BatchedPerson):
+    """
+        The passengers.
+
+        The arrays hold one entry for each seat (see BatchedPerson). The location of the passengers is the cabin.
+    """
+
+    @property
+    def arrayLength(self):
+        return self.model.passengers
+
+    @property
+    def totalExposeFromBreath(self):
+        return self._fieldChange_totalExposeFromBreath
+
+    @property
+    def totalExposeFromHand(self):
+        return self._fieldChange_totalExposeFromHand
+
+    def __init__(self, unique_id, model,indexCases=()):
+        """
+        :param indexCases: numpy.array
+                The seats of the passengers that are infected when the flight starts.
+        """
+        super().__init__(unique_id,model)
+
+        self._currentState[indexCases] = INFECTED_CODE
+        self._recordedState[indexCases] = INFECTED_CODE
+        self._incubationStart[indexCases] = -self._incubationPeriod[indexCases]
+        self._viralLoad[indexCases] = self._parameters.maxViralLoad
+
+    def updateSocial(self,idx,viralLoad):
+        # a passenger can have several contacts in a step.
+        numpy.add.at(self._fieldChange["hand_interperson"],idx,viralLoad)
+
+
+class AirCrew(Person):
+    """
+        A crew member that walks between the compartments.
+
+        The residence time in a compartment is exponential with the mean aircabin.crew.residenceTime.
+    """
+
+    @property
+    def residenceEnded(self):
+        return self._residenceTimeCounter > self._residenceTime
+
+    def enterLocation(self,locationRef,zone=0):
+        super().enterLocation(locationRef,zone=zone)
+        self._residenceTime = self.random.exponential(self.model.parameters.aircabin.crewResidenceTime)
+        self._residenceTimeCounter = 0.
+
+
+class CabinCompartment(Room):
+    """
+        A compartment of the cabin (a room that the crew can enter and leave).
+
+        The air and the fomite of the compartment are held by the cabin, and the compartment
+        holds its stains.
+    """
+
+    _index = None
+    _cabin = None
+    _surfaceArea = None
+
+    _sharedFields = Room._sharedFields + ("_cabin",)
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def virusConcentrationAir(self):
+        """
+            [1/m**3]
+        """
+        return self._cabin.compartmentAir[self._index]
+
+    @property
+    def virusFomiteConcentration(self):
+        """
+            [1/m**2]
+        """
+        return self._cabin.compartmentFomite[self._index]
+
+    @property
+    def effectiveSurfaceArea(self):
+        """
+            [m**2]
+        """
+        return self._surfaceArea
+
+    def __init__(self, unique_id, model,cabin,index,surfaceArea):
+        """
+        :param cabin: Cabin
+                The cabin agent.
+        :param index: int
+                The index of the compartment in the cabin.
+        :param surfaceArea: float
+                The area of the surfaces that the stains land on [m**2].
+        """
+        super().__init__(unique_id,model)
+        self._cabin = cabin
+        self._index = index
+        self._surfaceArea = surfaceArea
+        self._shedList = StainStore(surfaceArea,self._parameters.negligibleStainLoad)
+
+    def updateAir(self,viralLoad,zone=0):
+        self._cabin.updateCompartmentAir(self._index,viralLoad)
+
+    def updateFomite(self,viralLoad):
+        self._cabin.updateCompartmentFomite(self._index,viralLoad)
+
+
+class Cabin(Room):
+    """
+        The air and the fomite of the compartments of the cabin (arrays of length C, one entry for each compartment).
+
+        The cabin is the location of the passengers, so (as in the Batched room) the concentrations are at the seats
+        of the passengers (arrays with one entry for each seat) and the changes are given with the seats.
+    """
+
+    _airflow = None             # airflow.AirflowNetwork
+    _compartments = None        # list of CabinCompartment.
+    _seatCompartment = None     # The compartment of each seat.
+    _firstSeat = None           # The first seat of each compartment (the seats of a compartment are consecutive).
+    _seats = None               # The number of seats in each compartment.
+    _fomiteSurfaceArea = None   # [m**2] of each compartment.
+
+    _sharedFields = Room._sharedFields + ("_airflow","_compartments","_seatCompartment","_firstSeat","_seats","_fomiteSurfaceArea")
+
+    @property
+    def arrayLength(self):
+        return self._airflow.compartments
+
+    @property
+    def compartments(self):
+        return self._compartments
+
+    @property
+    def airflow(self):
+        return self._airflow
+
+    @property
+    def compartmentAir(self):
+        """
+            The air concentration of each compartment [1/m**3].
+        """
+        return self._virusConcentrationAir
+
+    @property
+    def compartmentFomite(self):
+        """
+            The fomite concentration of each compartment [1/m**2].
+        """
+        return self._fomiteConcentration
+
+    @property
+    def seatCompartment(self):
+        return self._seatCompartment
+
+    @property
+    def virusConcentrationAir(self):
+        """
+            The air concentration at each seat [1/m**3].
+        """
+        return self._virusConcentrationAir[self._seatCompartment]
+
+    @property
+    def virusFomiteConcentration(self):
+        """
+            The fomite concentration at each seat [1/m**2].
+        """
+        return self._fomiteConcentration[self._seatCompartment]
+
+    def __init__(self, unique_id, model,airflow,seatCompartment,fomiteSurfaceArea):
+        """
+        :param airflow: airflow.AirflowNetwork
+                The compartments and the flows between them.
+        :param seatCompartment: numpy.array
+                The compartment of each seat (non decreasing).
+        :param fomiteSurfaceArea: numpy.array
+                The fomite area of each compartment [m**2].
+        """
+        self._airflow = airflow
+        super(Room,self).__init__(unique_id,model,agentType="room")
+        C = self.arrayLength
+
+        self._seatCompartment = seatCompartment
+        self._seats = numpy.bincount(seatCompartment,minlength=C)
+        self._firstSeat = numpy.cumsum(self._seats) - self._seats
+        self._fomiteSurfaceArea = fomiteSurfaceArea
+
+        self._virusConcentrationAir = numpy.zeros(C)
+        self._fomiteConcentration = numpy.zeros(C)
+        self._changeAir = numpy.zeros(C)
+        self._changeFomite = numpy.zeros(C)
+        self._personInRoom = {}
+        self._compartments = []
+
+    def addCompartment(self,compartment):
+        self._compartments.append(compartment)
+
+    def handle_event(self):
+        """
+            random a poisson event of each action for all the compartments.
+
+            A social contact involves 2 passengers of the compartment, so the number of contacts in each compartment
+            is randomized at (the number of seats)/2 times the frequency of the social action (as in the Crowd method).
+            A compartment with a single seat has no social contacts.
+        :return:
+        """
+        dt = self.model.dt
+        for action,rates in self._actionRates:
+            if action.name == "social":
+                contacts = self.random.poisson(dt*rates[0]*numpy.where(self._seats > 1,self._seats/2.,0.))
+                if contacts.any():
+                    self._event_handle_social(contacts)
+            else:
+                events = self.random.poisson(dt*rates[0],size=self.arrayLength)
+                eventIndices = numpy.flatnonzero(events)
+                if len(eventIndices) > 0:
+                    self._eventHandlers[action.name](eventIndices)
+
+    def _event_handle_cleanFomite(self,idx):
+        self._fomiteConcentration[idx] *= (1-self._parameters.cleaningEfficiencyFomite)
+
+    def _event_handle_social(self,contacts):
+        """
+            Exchange the hand load of random pairs of passengers in the same compartment.
+
+        :param contacts: numpy.array
+                The number of pairs in each compartment.
+        :return:
+        """
+        passengers = self.model.population
+        compartment = numpy.repeat(numpy.arange(self.arrayLength),contacts)
+        firstSeat = self._firstSeat[compartment]
+        seats = self._seats[compartment]
+
+        person1 = self.random.randint(0,seats)
+        person2 = firstSeat + (person1 + self.random.randint(1,seats)) % seats
+        person1 += firstSeat
+
+        hand = passengers.virusHandConcentration
+        person1Person2 = passengers.handSurfaceArea * passengers.factorHandToFace * (hand[person2] - hand[person1])
+
+        passengers.updateSocial(person1, person1Person2)
+        passengers.updateSocial(person2,-person1Person2)
+
+    def updateCompartmentAir(self,compartment,viralLoad):
+        self._changeAir[compartment] += viralLoad
+
+    def updateCompartmentFomite(self,compartment,viralLoad):
+        self._changeFomite[compartment] += viralLoad
+
+    def updateAir(self,idx,viralLoad):
+        numpy.add.at(self._changeAir,self._seatCompartment[idx],viralLoad)
+
+    def updateFomite(self,idx,viralLoad):
+        numpy.add.at(self._changeFomite,self._seatCompartment[idx],viralLoad)
+
+    def updateStain(self,idx,viralLoad,stainArea):
+        """
+            Add a stain to the compartment of each of the seats in idx.
+
+        :param idx: numpy.array
+                The seats.
+        :param viralLoad: numpy.array
+                The number of viruses in the stain.
+        :param stainArea: float
+                [m**2]
+        """
+        for seat,load in zip(idx,viralLoad):
+            self._compartments[self._seatCompartment[seat]].updateStain(load,stainArea)
+
+    def touchStain(self,idx):
+        """
+            Each of the seats in idx touches at most one stain of its compartment.
+
+        :param idx: numpy.array
+                The seats.
+        :return:
+            (the viral load on the touched stain (0 if no stain was touched),stain area)
+        """
+        viralLoad = numpy.zeros(len(idx))
+        stainArea = numpy.ones(len(idx))
+
+        compartment = self._seatCompartment[idx]
+        for index in numpy.unique(compartment):
+            stains = self._compartments[index].stains
+            if stains.count > 0:
+                touching = compartment == index
+                viralLoad[touching],stainArea[touching] = stains.touchEach(self.random.uniform(0,1,size=touching.sum()))
+
+        return viralLoad,stainArea
+
+    def step(self):
+        params = self._parameters
+        dt = self.model.dt
+
+        self._virusConcentrationAir = self._airflow.step(self._virusConcentrationAir,self._changeAir,dt)
+
+        self._fomiteConcentration += self._changeFomite/self._fomiteSurfaceArea
+        self._fomiteConcentration /= (1 + params.decayRateFomite * dt)
+
+        surfaceDecay = 1/(1 + params.decayRateSurface * dt)
+        for compartment in self._compartments:
+            compartment.decayStains(surfaceDecay)
+
+        self._changeAir[:] = 0.
+        self._changeFomite[:] = 0.
+
+    def collect(self):
+        pass
+
+
+class aircabinEnvironment_Events(Model):
+    """
+        Simulation of a flight (see the module).
+
+        The passengers are numbered by the rows (aircabin.seatsPerRow seats in each row),
+        compartment 0 is the front galley and the last compartment is the rear galley.
+    """
+    _population = None          # The passengers agent.
+    _crew = None                # list of AirCrew.
+    _cabin = None
+    _indexCases = None          # The seats of the index cases.
+    _crewCompartment = None     # The compartment of each crew member.
+
+    _sharedFields = Model._sharedFields + ("_population","_crew","_cabin","_indexCases")
+
+    @property
+    def cabin(self):
+        return self._cabin
+
+    @property
+    def room(self):
+        return self._cabin
+
+    @property
+    def population(self):
+        """
+            The passengers agent.
+        """
+        return self._population
+
+    @property
+    def passengers(self):
+        """
+            The number of passengers.
+        """
+        return self.parameters.aircabin.rows*self.parameters.aircabin.seatsPerRow
+
+    @property
+    def crew(self):
+        return self._crew
+
+    @property
+    def occupants(self):
+        """
+            The number of passengers and crew members.
+        """
+        return self.passengers + len(self._crew)
+
+    @property
+    def indexCases(self):
+        return self.parameters.aircabin.indexCases
+
+    @property
+    def secondaryInfections(self):
+        """
+            The number of passengers (that are not index cases) and crew members that were infected.
+        """
+        passengers = int(numpy.sum(self._population.currentState != SUSCEPTIBLE_CODE)) - self.indexCases
+        return passengers + sum([member.currentState != SUSCEPTIBLE for member in self._crew])
+
+    def __init__(self,JSON,randomSeed):
+        """
+            Initializes the cabin, the passengers and the crew.
+
+        :param JSON:
+                JSON config with the aircabin settings:
+
+                "aircabin" : {
+                    "rows" : 40,
+                    "seatsPerRow" : 9,
+                    "rowsPerCompartment" : 1,
+                    "row" : {"volume" : "16*m**3","surfaceArea" : "25*m**2","fomiteSurfaceArea" : "1*m**2"},
+                    "galley" : {"volume" : "20*m**3","surfaceArea" : "25*m**2","fomiteSurfaceArea" : "2*m**2"},
+                    "ventilation" : {"airChangeRate" : "20/h","longitudinalFlow" : "0.02*m**3/s"},
+                    "flightDuration" : "10*h",
+                    "indexCases" : 1,
+                    "crew" : {"members" : 10,"residenceTime" : "5*min"}
+                }
+
+        :param randomSeed: int
+                The seed of the random number generator.
+        """
+        super().__init__(JSON,randomSeed)
+        simulation = self.parameters.simulation
+        if simulation.commonRandomNumbers or simulation.raoBlackwell:
+            raise ValueError("simulation.commonRandomNumbers and simulation.raoBlackwell are not supported in the aircabin")
+
+        aircabin = self.parameters.aircabin
+        if aircabin is None:
+            raise ValueError("The aircabin settings are missing")
+
+        rowCompartments = aircabin.rows//aircabin.rowsPerCompartment
+        compartments = rowCompartments + 2
+        volume = numpy.full(compartments,aircabin.rowVolume*aircabin.rowsPerCompartment)
+        volume[[0,-1]] = aircabin.galleyVolume
+        surfaceArea = numpy.full(compartments,aircabin.rowSurfaceArea*aircabin.rowsPerCompartment)
+        surfaceArea[[0,-1]] = aircabin.galleySurfaceArea
+        fomiteSurfaceArea = numpy.full(compartments,aircabin.rowFomiteSurfaceArea*aircabin.rowsPerCompartment)
+        fomiteSurfaceArea[[0,-1]] = aircabin.galleyFomiteSurfaceArea
+
+        flows = [(i,i+1,aircabin.longitudinalFlow) for i in range(compartments-1)] + \
+                [(i+1,i,aircabin.longitudinalFlow) for i in range(compartments-1)]
+        airflow = AirflowNetwork(volume,flows,aircabin.decayRateAir + aircabin.airChangeRate)
+
+        rows = numpy.repeat(numpy.arange(aircabin.rows),aircabin.seatsPerRow)
+        self._cabin = getCabinClass()("cabin",self,airflow,1 + rows//aircabin.rowsPerCompartment,fomiteSurfaceArea)
+        for index in range(compartments):
+            compartment = getCompartmentClass()(f"compartment{index}",self,self._cabin,index,surfaceArea[index])
+            self._cabin.addCompartment(compartment)
+            self.addLocation(compartment)
+
+        self._indexCases = self.random.choice(self.passengers,aircabin.indexCases,replace=False)
+        self._population = getPassengersClass()("passengers",self,indexCases=self._indexCases)
+        self._cabin.enterRoom(self._population)
+
+        self._crew = []
+        self._crewCompartment = []
+        for i in range(aircabin.crewMembers):
+            member = getAirCrewClass()(f"crew{i}",self)
+            self._cabin.compartments[0].enterRoom(member)
+            self._crew.append(member)
+            self._crewCompartment.append(0)
+
+        self.addLocation(self._cabin)
+        self.addAgent(self._population)
+        for member in self._crew:
+            self.addAgent(member)
+        self.addAgent(self._cabin)
+
+    def _state(self):
+        # the compartments are locations (not agents), so their stains are added to the state.
+        state = super()._state()
+        state["compartments"] = dict([(compartment.unique_id,compartment.getState()) for compartment in self._cabin.compartments])
+        return state
+
+    def restore(self,state):
+        # the crew are placed in their compartments before the state (and the random generator) is restored.
+        for member,index in zip(self._crew,state["model"]["_crewCompartment"]):
+            member.location.leaveRoom(member)
+            self._cabin.compartments[index].enterRoom(member)
+        super().restore(state)
+
+        compartments = copy.deepcopy(state["compartments"])
+        for compartment in self._cabin.compartments:
+            compartment.setState(compartments[compartment.unique_id])
+
+    def step(self):
+        for agent in self.agents:
+            agent.handle_event()
+
+        for agent in self.agents:
+            agent.step()
+
+        self._moveCrew()
+        self._currentTime += self._dt_ns
+
+    def _moveCrew(self):
+        """
+            Move the crew members whose residence time ended to an adjacent compartment.
+        """
+        for i,member in enumerate(self._crew):
+            if member.residenceEnded:
+                current = self._crewCompartment[i]
+                neighbours = self._cabin.airflow.neighbours(current)
+                target = neighbours[self.random.randint(len(neighbours))]
+
+                self._cabin.compartments[current].leaveRoom(member)
+                self._cabin.compartments[target].enterRoom(member)
+                self._crewCompartment[i] = target
+
+    def runSimulation(self,terminatePrimaryInfected=True,checkpoint=None,checkpointInterval=600):
+        """
+            Running until the end of the flight (aircabin.flightDuration).
+
+        :param terminatePrimaryInfected: bool
+                Not used (the index cases are infected when the flight starts).
+        :param checkpoint: callable
+                Called with the model (between steps) every checkpointInterval [s] of wall time.
+        :param checkpointInterval: float
+                [s] of wall time.
+        :return:
+        """
+        lastCheckpoint = time.monotonic()
+        while self.currentTime < self.parameters.aircabin.flightDuration:
+            self.step()
+
+            if checkpoint is not None and time.monotonic()-lastCheckpoint >= checkpointInterval:
+                checkpoint(self)
+                lastCheckpoint = time.monotonic()
+
+    def summary(self):
+        """
+            The summary of the passengers and the crew.
+
+            The fields:
+                occupant, role (passenger or crew), row (-1 for the crew), compartment (at the end of the flight),
+                indexCase, state, incubationStart [s] from the simulation start (nan if the occupant was not infected),
+                totalExposure, exposeFromBreath and exposeFromHand.
+
+        :return:
+            pandas.DataFrame
+        """
+        aircabin = self.parameters.aircabin
+        passengers = self._population
+        indexCase = numpy.zeros(self.passengers,dtype=bool)
+        indexCase[self._indexCases] = True
+
+        passengerSummary = pandas.DataFrame(dict(occupant=numpy.arange(self.passengers),
+                                                 role="passenger",
+                                                 row=numpy.arange(self.passengers)//aircabin.seatsPerRow,
+                                                 compartment=self._cabin.seatCompartment,
+                                                 indexCase=indexCase,
+                                                 state=[PERSON_STATES[x] for x in passengers.currentState],
+                                                 incubationStart=passengers.incubationStart,
+                                                 totalExposure=passengers.totalExposed,
+                                                 exposeFromBreath=passengers.totalExposeFromBreath,
+                                                 exposeFromHand=passengers.totalExposeFromHand))
+
+        crewSummary = []
+        for i,member in enumerate(self._crew):
+            summary = member.summary(unitless=True)
+            incubationStart = member.incubationStartDatetime
+            crewSummary.append(dict(occupant=self.passengers+i,
+                                    role="crew",
+                                    row=-1,
+                                    compartment=self._crewCompartment[i],
+                                    indexCase=False,
+                                    state=member.currentState,
+                                    incubationStart=numpy.nan if incubationStart is None else (incubationStart-self.simulationStart).total_seconds(),
+                                    totalExposure=member.totalExposed,
+                                    exposeFromBreath=summary["sum_exposeFromBreath"],
+                                    exposeFromHand=summary["sum_exposeFromHand"]))
+        crewSummary = pandas.DataFrame(crewSummary)
+
+        return pandas.concat([passengerSummary,crewSummary],ignore_index=True)
@@ -0,0 +1,179 @@
+"""
+    The air exchange between compartments (zones) that are connected by airflows.
+
+    The concentration c_i [1/m**3] of compartment i with volume V_i follows
+
+        dc_i/dt = -(decay_i + sum_j Q_ij/V_i) c_i + sum_j Q_ji c_j/V_i
+
+    where Q_ij [m**3/s] is the flow from i to j, and decay_i [1/s] is the decay of the virus and
+    the extraction of the air of i (that is replaced by clean air).
+
+    The step is implicit, as in Room.step:
+
+        (I + dt*A) c(t+dt) = c(t) + change/V
+
+    The matrix is sparse (each compartment is connected to a few others). Its LU factorization
+    is computed once and is reused in the steps. It is computed again only when dt or the
+    flows and the decay (the ventilation) change.
+"""
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+class AirflowNetwork(object):
+    """
+        The compartments and the flows between them.
+    """
+
+    _volume = None          # [m**3]
+    _flows = None           # list of (source,target,flow [m**3/s]).
+    _decayRate = None       # [1/s] of each compartment.
+    _matrix = None          # A, scipy.sparse.csc_matrix [1/s]
+    _neighbours = None      # compartment -> the compartments that are connected to it.
+    _factorizations = None  # dt [s] -> the LU factorization of I + dt*A (not saved in the checkpoint).
+
+    MAX_FACTORIZATIONS = 16 # The number of dt that are kept (the least recently used is removed first).
+
+    @property
+    def compartments(self):
+        return len(self._volume)
+
+    @property
+    def volume(self):
+        """
+            [m**3]
+        """
+        return self._volume
+
+    @property
+    def matrix(self):
+        return self._matrix
+
+    @property
+    def flows(self):
+        return self._flows
+
+    @property
+    def decayRate(self):
+        """
+            [1/s]
+        """
+        return self._decayRate
+
+    @property
+    def maxRate(self):
+        """
+            The largest rate [1/s] at which the air of a compartment is removed (decay and outflows).
+        """
+        return float(numpy.max(self._matrix.diagonal()))
+
+    def neighbours(self,compartment):
+        """
+            The compartments that are connected to the compartment (by a flow in any direction).
+        :return:
+            list of int
+        """
+        return self._neighbours[compartment]
+
+    def __init__(self,volume,flows,decayRate):
+        """
+        :param volume: numpy.array
+                The volume of each compartment [m**3].
+        :param flows: list
+                list of (source,target,flow [m**3/s]). The air flows from the source compartment to the target.
+        :param decayRate: float or numpy.array
+                The decay and the extraction of each compartment [1/s].
+        """
+        self._volume = numpy.asarray(volume,dtype=float)
+        self._flows = [(int(source),int(target),float(rate)) for source,target,rate in flows]
+        self._decayRate = numpy.array(numpy.broadcast_to(decayRate,(self.compartments,)),dtype=float)
+        self._build()
+
+    def __getstate__(self):
+        # the factorizations cannot be pickled, they are computed again after the restore.
+        state = dict(self.__dict__)
+        state["_factorizations"] = None
+        return state
+
+    def _build(self):
+        compartments = self.compartments
+
+        source = numpy.array([flow[0] for flow in self._flows],dtype=int)
+        target = numpy.array([flow[1] for flow in self._flows],dtype=int)
+        rate   = numpy.array([flow[2] for flow in self._flows],dtype=float)
+
+        # the outflow removes the air from the source, and the inflow adds it to the target.
+        outflow = numpy.bincount(source,weights=rate,minlength=compartments)/self._volume
+        diagonal = self._decayRate + outflow
+
+        rows = numpy.concatenate([numpy.arange(compartments),target])
+        cols = numpy.concatenate([numpy.arange(compartments),source])
+        values = numpy.concatenate([diagonal,-rate/self._volume[target]])
+        self._matrix = scipy.sparse.csc_matrix((values,(rows,cols)),shape=(compartments,compartments))
+
+        self._neighbours = [[] for i in range(compartments)]
+        for i,j in zip(source,target):
+            if j not in self._neighbours[i]:
+                self._neighbours[i].append(j)
+            if i not in self._neighbours[j]:
+                self._neighbours[j].append(i)
+
+        self._factorizations = None
+
+    def setFlows(self,flows):
+        """
+            Replace the flows between the compartments (the factorization is computed again in the next step).
+
+        :param flows: list
+                list of (source,target,flow [m**3/s]).
+        """
+        self._flows = [(int(source),int(target),float(rate)) for source,target,rate in flows]
+        self._build()
+
+    def setDecayRate(self,decayRate):
+        """
+            Replace the decay and the extraction of the compartments (the factorization is computed again in the next step).
+
+        :param decayRate: float or numpy.array
+                [1/s]
+        """
+        self._decayRate = numpy.array(numpy.broadcast_to(decayRate,(self.compartments,)),dtype=float)
+        self._build()
+
+    def _factorize(self,dt):
+        """
+            The factorization of I + dt*A.
+
+            The factorizations of the MAX_FACTORIZATIONS most recently used dt are kept, since the step of EquiDistance
+            returns to the base dt after each event and most of the leaps of TauLeaping are the maximal leap.
+        """
+        if self._factorizations is None:
+            self._factorizations = {}
+
+        factorization = self._factorizations.pop(dt,None)
+        if factorization is None:
+            if len(self._factorizations) >= self.MAX_FACTORIZATIONS:
+                del self._factorizations[next(iter(self._factorizations))]
+            implicit = scipy.sparse.identity(self.compartments,format="csc") + dt*self._matrix
+            factorization = scipy.sparse.linalg.splu(implicit)
+        self._factorizations[dt] = factorization
+        return factorization
+
+    def step(self,concentration,change,dt):
+        """
+            Advance the concentrations dt seconds.
+
+        :param concentration: numpy.array
+                The concentration of each compartment [1/m**3].
+        :param change: numpy.array
+                The number of viruses that were added to each compartment in the step.
+        :param dt: float
+                [s]
+        :return:
+            numpy.array, the concentrations after the step.
+        """
+        if dt == 0:
+            return concentration + change/self._volume
+
+        return self._factorize(dt).solve(concentration + change/self._volume)
@@ -0,0 +1,573 @@
+"""
+    The Batched numerical method.
+
+    Advances R replicates (seeds) of the single room scenario at once.
+    The dynamics are the same as in the Events method, but every field
+    (air, fomite, hand concentration, exposure, state, viral load ...) is a numpy array of length R.
+
+    The replicates that reach the termination conditions of runSimulation are removed
+    from the arrays and their summary is saved.
+"""
+import time
+
+import numpy
+import pandas
+
+from . import abstractAgent
+from . import LogLinearTrajectory, SUSCEPTIBLE, EXPOSED
+from .parameters import PERSON_STATES
+from .person import Person, RECOVERED_VIRALLOAD
+from .room import Room
+from .model import Model, ONE_PER_ML
+
+# Above this number of (replicate,stain) pairs, a touch searches the stains by a binary search instead of
+# comparing all of them.
+DENSE_TOUCH_SIZE = 50000
+
+SUSCEPTIBLE_CODE, EXPOSED_CODE, INFECTED_CODE, RECOVERED_CODE = [PERSON_STATES.index(x) for x in PERSON_STATES]
+
+
+def getBatchedPersonClass():
+    return type('person', (BatchedPerson, abstractAgent.AgentBatched), {})
+
+
+def getBatchedRoomClass():
+    return type('room', (BatchedRoom, abstractAgent.AgentBatched), {})
+
+
+class BatchedPerson(Person):
+    """
+        A person agent that holds R replicates.
+
+        The state is held as a code (the index in parameters.PERSON_STATES).
+        The incubation start and period are in [s] from the simulation start (nan if not exposed).
+    """
+
+    _recordedState = None # The state when the person was collected (before the state changes of the step).
+
+    _incubationTrajectory = None # The viral load curves of the incubation (one for each replicate).
+    _sicknessTrajectory   = None # The viral load curve of the sickness (the same for all the replicates).
+
+    @property
+    def currentState(self):
+        return self._currentState
+
+    @property
+    def currentStateCode(self):
+        return self._currentState
+
+    @property
+    def recordedState(self):
+        return self._recordedState
+
+    @property
+    def incubationStart(self):
+        """
+            [s] from the simulation start (nan if not exposed).
+        """
+        return self._incubationStart
+
+    @property
+    def incubationEnd(self):
+        """
+            [s] from the simulation start.
+        """
+        return self._incubationStart + self._incubationPeriod
+
+    def __init__(self, unique_id, model,startState=SUSCEPTIBLE):
+        super(Person,self).__init__(unique_id, model,agentType="person")
+        R = self.arrayLength
+
+        self.addReplicateArray("_currentState",numpy.full(R,PERSON_STATES.index(startState),dtype=numpy.int8))
+        self.addReplicateArray("_recordedState",self._currentState.copy())
+        self.addReplicateArray("_incubationStart",numpy.full(R,0. if startState == EXPOSED else numpy.nan))
+        self.addReplicateArray("_incubationPeriod",self.get_incubationPeriod())
+
+        params = self._parameters
+        self.addReplicateArray("_incubationTrajectory",LogLinearTrajectory(numpy.ceil(self._incubationPeriod/3600.)*3600.,
+                                                                           params.minViralLoad,params.maxViralLoad))
+        self._sicknessTrajectory = LogLinearTrajectory(numpy.ceil(params.sicknessPeriod/3600.)*3600.,
+                                                       params.maxViralLoad,RECOVERED_VIRALLOAD)
+
+        self.addReplicateArray("_viralLoad",numpy.zeros(R))
+        self.addReplicateArray("_virusHandConcentration",numpy.zeros(R))
+        self.addReplicateArray("_currentExposure",numpy.zeros(R))
+        self.addReplicateArray("_totalExposure",numpy.zeros(R))
+
+        for field in ["surfaceToHand","fomiteToHand","hand_interperson","faceToHand","exposeFromHand"]:
+            self._fieldChange[field] = numpy.zeros(R)
+
+        self.addReplicateArray("_fieldChange_totalExposeFromBreath",numpy.zeros(R))
+        self.addReplicateArray("_fieldChange_totalExposeFromHand",numpy.zeros(R))
+
+        self.setExhaleVolume()
+
+    def compact(self,keep):
+        super().compact(keep)
+        for field,value in self._fieldChange.items():
+            self._fieldChange[field] = value[keep]
+
+    def step(self):
+        room = self.location
+        params = self._parameters
+        dt = self.model.dt
+        fieldChange = self._fieldChange
+
+        exposeFromBreath = room.virusConcentrationAir * params.breathingRate * params.breathingEfficiency * dt
+        exposeFromHand   = fieldChange["exposeFromHand"]
+
+        numpy.maximum(self._currentExposure + exposeFromHand + exposeFromBreath,0,out=self._currentExposure)
+        numpy.maximum(self._totalExposure + exposeFromHand + exposeFromBreath,0,out=self._totalExposure)
+
+        self._fieldChange_totalExposeFromBreath += exposeFromBreath
+        self._fieldChange_totalExposeFromHand   += exposeFromHand
+
+        handchange = (fieldChange["surfaceToHand"]     + fieldChange["fomiteToHand"]  + \
+                      fieldChange["hand_interperson"] + fieldChange["faceToHand"])/params.handSurfaceArea
+
+        hand = (self._virusHandConcentration + handchange)/(1+ params.handDecayRate*dt)
+        numpy.maximum(hand,0,out=self._virusHandConcentration)
+
+        self._recordedState[:] = self._currentState
+        for value in fieldChange.values():
+            value[:] = 0.
+
+        currentTime = self.model.currentTime
+
+        exposed = numpy.flatnonzero(self._currentState == EXPOSED_CODE)
+        sick = numpy.flatnonzero(self._currentState == INFECTED_CODE)
+
+        if len(exposed) > 0:
+            incubationEnd = self.incubationEnd[exposed]
+            becameInfected = currentTime > incubationEnd
+
+            infected = exposed[becameInfected]
+            self._currentState[infected] = INFECTED_CODE
+            self._viralLoad[infected] = params.maxViralLoad
+
+            incubating = exposed[~becameInfected]
+            timeIncubating = currentTime - self._incubationStart[incubating]
+            self._viralLoad[incubating] = self._incubationTrajectory[incubating](timeIncubating)
+
+        if len(sick) > 0:
+            timeSick = currentTime - self.incubationEnd[sick]
+            recovered = timeSick > params.sicknessPeriod
+
+            self._currentState[sick[recovered]] = RECOVERED_CODE
+
+            stillSick = sick[~recovered]
+            timeSick = numpy.maximum(timeSick[~recovered],0)
+            self._viralLoad[stillSick] = self._sicknessTrajectory(timeSick)
+
+    def _event_handle_touchFomite(self,idx):
+        room = self.location
+        params = self._parameters
+
+        fomiteToHand = params.factorSurfaceToHand * params.handSurfaceArea * room.virusFomiteConcentration[idx]
+        handToFomite = params.factorHandToSurface * params.handSurfaceArea * self._virusHandConcentration[idx]
+
+        self._fieldChange["fomiteToHand"][idx] += fomiteToHand - handToFomite
+        room.updateFomite(idx,-self._fieldChange["fomiteToHand"][idx])
+
+    def _event_handle_touchFace(self,idx):
+        params = self._parameters
+        handToFace = params.factorHandToFace * params.handSurfaceArea * self._virusHandConcentration[idx]
+        faceToHand = params.factorHandToFace * params.autoincolationVolume * self._viralLoad[idx]
+
+        self._fieldChange["faceToHand"][idx] += faceToHand - handToFace
+        self._fieldChange["exposeFromHand"][idx] -= self._fieldChange["faceToHand"][idx]*params.handToMouth
+
+    def _event_handle_touchSurface(self,idx):
+        params = self._parameters
+        viralLoadSurface,stainArea = self.location.touchStain(idx)
+        self._fieldChange["surfaceToHand"][idx] += viralLoadSurface*params.factorSurfaceToHand*params.handSurfaceArea/stainArea
+
+    def _expel(self,idx,viralLoadFactor,evaporatingDropletsVolume,nonEvaporatingDropletsVolume):
+        viralLoad = viralLoadFactor*self._viralLoad[idx]
+        viralExpolsionAir = viralLoad*evaporatingDropletsVolume
+        viralExpolsionSurface = viralLoad*nonEvaporatingDropletsVolume
+
+        self.location.updateAir(idx,viralExpolsionAir)
+        stained = viralExpolsionSurface > 0
+        self.location.updateStain(idx[stained],viralExpolsionSurface[stained],self._parameters.stainArea)
+
+    def _event_handle_cough(self,idx):
+        self._expel(idx,self._parameters.viralLoadFactor_cough,
+                    self._evaporatingDropletsVolume_cough,self._nonEvaporatingDropletsVolume_cough)
+
+    def _event_handle_talk(self,idx):
+        self._expel(idx,self._parameters.viralLoadFactor_talk,
+                    self._evaporatingDropletsVolume_talk,self._nonEvaporatingDropletsVolume_talk)
+
+    def _event_handle_sneeze(self,idx):
+        self._expel(idx,self._parameters.viralLoadFactor_sneeze,
+                    self._evaporatingDropletsVolume_sneeze,self._nonEvaporatingDropletsVolume_sneeze)
+
+    def _event_handle_washHands(self,idx):
+        self._virusHandConcentration[idx] *= (1 - self._parameters.washingHandEfficiency)
+
+    def _event_handle_immuneSystem(self,idx):
+        idx = idx[self._currentState[idx] == SUSCEPTIBLE_CODE]
+        if len(idx) == 0:
+            return
+
+        params = self._parameters
+        doseresponseFunc = getattr(self,"doseresponse_%s" % params.doseresponseName)
+
+        P = doseresponseFunc(exposure=self._currentExposure[idx], **params.doseresponseParams)
+        val = self.random.uniform(0,1,size=len(idx))
+
+        infected = idx[val < P]
+        self._incubationStart[infected] = self.model.currentTime
+        self._currentState[infected] = EXPOSED_CODE
+
+        self._currentExposure[idx[val >= P]] = 0
+
+    def updateSocial(self,idx,viralLoad):
+        self._fieldChange["hand_interperson"][idx] += viralLoad
+
+    def collect(self):
+        pass
+
+
+class BatchedRoom(Room):
+    """
+        A room that holds R replicates.
+
+        The stains of each replicate are held in the rows of 2D arrays.
+        All the stains decay at the same rate, so the decay is held in a single
+        multiplier (_surfaceDecay) and the stain loads are saved divided by the multiplier at the
+        time they were shed.
+
+        The probability to touch a stain does not change after it was shed, so the cumulative hazard
+        of the first i stains is saved as well (see room.StainStore). A touch draws one uniform number
+        and finds the first stain whose cumulative hazard exceeds it.
+
+        The consecutive stains whose load is below the negligible load are merged in each replicate
+        (as in StainStore.mergeNegligible), so the number of columns does not grow with the simulation.
+    """
+
+    _surfaceDecay = None
+    _mergeCount = None     # merge when the number of stains of a replicate reaches this size.
+
+    @property
+    def shedList(self):
+        return self._stainLoad
+
+    def __init__(self, unique_id, model):
+        super(Room,self).__init__(unique_id,model,agentType="room")
+        R = self.replicates
+
+        self.addReplicateArray("_virusConcentrationAir",numpy.zeros(R))
+        self.addReplicateArray("_fomiteConcentration",numpy.zeros(R))
+
+        self.addReplicateArray("_stainCount",numpy.zeros(R,dtype=numpy.int64))
+        self.addReplicateArray("_stainLoad",numpy.zeros((R,16)))
+        self.addReplicateArray("_stainArea",numpy.ones((R,16)))
+        self.addReplicateArray("_stainHazard",numpy.zeros((R,16)))
+
+        self.addReplicateArray("_changeAir",numpy.zeros(R))
+        self.addReplicateArray("_changeFomite",numpy.zeros(R))
+
+        self._surfaceDecay = 1.
+        self._mergeCount = 64
+        self._personInRoom = {}
+
+    def _event_handle_cleanFomite(self,idx):
+        self._fomiteConcentration[idx] *= (1-self._parameters.cleaningEfficiencyFomite)
+
+    def _event_handle_social(self,idx):
+        person1 = self.model.primary
+        person2 = self.model.secondary
+
+        person1Person2 = person1.handSurfaceArea * person1.factorHandToFace * (
+                          person2.virusHandConcentration[idx] - person1.virusHandConcentration[idx])
+
+        person1.updateSocial(idx, person1Person2)
+        person2.updateSocial(idx,-person1Person2)
+
+    def updateAir(self,idx,viralLoad):
+        self._changeAir[idx] += viralLoad
+
+    def updateFomite(self,idx,viralLoad):
+        self._changeFomite[idx] += viralLoad
+
+    def updateStain(self,idx,viralLoad,stainArea):
+        """
+            Add a stain to each of the replicates in idx.
+
+        :param idx: numpy.array
+                The replicates.
+        :param viralLoad: numpy.array
+                The number of viruses in the stain.
+        :param stainArea: float
+                [m**2]
+        """
+        if len(idx) == 0:
+            return
+
+        position = self._stainCount[idx]
+        if position.max() >= self._stainLoad.shape[1]:
+            newSize = 2*self._stainLoad.shape[1]
+            for name,fill in [("_stainLoad",0.),("_stainArea",1.),("_stainHazard",0.)]:
+                current = getattr(self,name)
+                expanded = numpy.full((current.shape[0],newSize),fill)
+                expanded[:,:current.shape[1]] = current
+                setattr(self,name,expanded)
+
+        previous = self._stainHazard[idx,position-1]
+        previous[position == 0] = 0
+
+        self._stainLoad[idx,position] = viralLoad/self._surfaceDecay
+        self._stainArea[idx,position] = stainArea
+        self._stainHazard[idx,position] = previous - numpy.log1p(-numpy.minimum(stainArea/self.effectiveSurfaceArea,1.))
+        self._stainCount[idx] += 1
+
+        maxCount = self._stainCount.max()
+        if maxCount >= self._mergeCount:
+            self.mergeNegligible()
+            self._mergeCount = max(2*self._stainCount.max(),64)
+
+    def mergeNegligible(self):
+        """
+            Merge every run of consecutive stains whose load is below the negligible load to its last stain
+            in each replicate (see StainStore.mergeNegligible), and drop the columns that are not used.
+        """
+        count = self._stainCount
+        width = max(count.max(),1)
+        R = len(count)
+
+        load = self._stainLoad[:,:width]
+        valid = numpy.arange(width)[None,:] < count[:,None]
+        negligible = valid & (load*self._surfaceDecay < self._parameters.negligibleStainLoad)
+        if not negligible.any():
+            return
+
+        # the run id of every stain: a new run starts at every stain that is not negligible or after one.
+        newRun = numpy.ones((R,width),dtype=bool)
+        newRun[:,1:] = ~(negligible[:,1:] & negligible[:,:-1])
+        runId = numpy.cumsum(newRun,axis=1)-1
+        runEnd = numpy.ones((R,width),dtype=bool)
+        runEnd[:,:-1] = newRun[:,1:]
+
+        # the position of each stain after the merge (in the flat arrays).
+        position = (numpy.arange(R)[:,None]*width + runId)[valid]
+        lastRun = numpy.take_along_axis(runId,numpy.maximum(count-1,0)[:,None],axis=1)[:,0]
+        newCount = numpy.where(count > 0,lastRun+1,0)
+
+        newWidth = max(newCount.max(),1)
+        merged = numpy.arange(width)[None,:] < newCount[:,None]
+        stainLoad = numpy.bincount(position,weights=load[valid],minlength=R*width).reshape(R,width)
+        stainArea = numpy.bincount(position,weights=self._stainArea[:,:width][valid],minlength=R*width).reshape(R,width)
+        stainHazard = numpy.zeros(R*width)
+        stainHazard[(numpy.arange(R)[:,None]*width + runId)[valid & runEnd]] = self._stainHazard[:,:width][valid & runEnd]
+        stainHazard = stainHazard.reshape(R,width)
+
+        self._stainLoad = numpy.where(merged,stainLoad,0.)[:,:newWidth]
+        self._stainArea = numpy.where(merged,stainArea,1.)[:,:newWidth]
+        self._stainHazard = numpy.where(merged,stainHazard,0.)[:,:newWidth]
+        self._stainCount = newCount
+
+    def touchStain(self,idx):
+        """
+            Each of the replicates in idx touches at most one stain.
+
+        :param idx: numpy.array
+                The replicates.
+        :return:
+            (the viral load on the touched stain (0 if no stain was touched),stain area)
+        """
+        hazard = -numpy.log1p(-self.random.uniform(0,1,size=len(idx)))
+        count = self._stainCount[idx]
+        width = max(count.max(),1)
+
+        if len(idx)*width <= DENSE_TOUCH_SIZE:
+            touched = (self._stainHazard[idx,:width] > hazard[:,None]) & \
+                      (numpy.arange(width)[None,:] < count[:,None])
+            stain = touched.argmax(axis=1)
+            anyTouched = touched.any(axis=1)
+        else:
+            # a binary search for the first stain whose cumulative hazard exceeds the hazard in each replicate
+            # (the cumulative hazard of the stains of a replicate does not decrease).
+            low = numpy.zeros(len(idx),dtype=count.dtype)
+            high = count.copy()
+            for _ in range(int(width).bit_length()):
+                middle = (low + high)//2
+                above = self._stainHazard[idx,numpy.minimum(middle,width-1)] > hazard
+                searching = low < high
+                high = numpy.where(searching & above,middle,high)
+                low = numpy.where(searching & ~above,middle+1,low)
+
+            anyTouched = low < count
+            stain = numpy.where(anyTouched,low,0)
+
+        viralLoad = numpy.where(anyTouched,self._stainLoad[idx,stain]*self._surfaceDecay,0.)
+        return viralLoad,self._stainArea[idx,stain]
+
+    def compact(self,keep):
+        super().compact(keep)
+        width = max(self._stainCount.max(),1) if len(self._stainCount) > 0 else 1
+        for name in ["_stainLoad","_stainArea","_stainHazard"]:
+            setattr(self,name,getattr(self,name)[:,:width])
+
+    def step(self):
+        params = self._parameters
+        dt = self.model.dt
+
+        self._virusConcentrationAir += self._changeAir/params.roomVolume
+        self._virusConcentrationAir /= (1 + params.decayRateAir * dt)
+
+        self._fomiteConcentration += self._changeFomite/params.fomiteSurfaceArea
+        self._fomiteConcentration /= (1 + params.decayRateFomite * dt)
+
+        self._surfaceDecay /= (1 + params.decayRateSurface * dt)
+        if self._surfaceDecay < 1e-200:
+            self._stainLoad *= self._surfaceDecay
+            self._surfaceDecay = 1.
+
+        self._changeAir[:] = 0.
+        self._changeFomite[:] = 0.
+
+    def collect(self):
+        pass
+
+
+class singleRoomEnvironmentCloseContant_Batched(Model):
+    """
+        Simulation of R replicates of 2 agents, primary and secondary.
+        The primary begins as exposed and the secondary as susceptible.
+
+        The replicates use the random seed randomSeed (and not one seed each).
+    """
+    _replicates = None
+    _replicateIndex = None  # The replicate id of each running replicate.
+    _summary = None         # replicate id -> summary fields.
+
+    _sharedFields = Model._sharedFields + ("_primary","_secondary")
+
+    @property
+    def replicates(self):
+        return self._replicates
+
+    @property
+    def runningReplicates(self):
+        return len(self._replicateIndex)
+
+    @property
+    def room(self):
+        return self._locations["room"]
+
+    @property
+    def primary(self):
+        return self._primary
+
+    @property
+    def secondary(self):
+        return self._secondary
+
+    def __init__(self,JSON,randomSeed,replicates=None):
+        """
+            Initializes R replicates of the singleRoom environment.
+
+        :param JSON:
+                JSON config. See singleRoomEnvironmentCloseContant.
+        :param randomSeed: int
+                The seed of the random number generator of the batch.
+        :param replicates: int
+                The number of replicates. If None, use simulation.replicates of the config (default 1000).
+        """
+        super().__init__(JSON,randomSeed)
+        self._replicates = int(JSON['simulation'].get('replicates',1000) if replicates is None else replicates)
+        self._replicateIndex = numpy.arange(self._replicates)
+        self._summary = {}
+
+        room      = getBatchedRoomClass()("room",self)
+        self._primary   = getBatchedPersonClass()("primary",self,startState=EXPOSED)
+        self._secondary = getBatchedPersonClass()("secondary",self)
+
+        self.addLocation(room)
+
+        self.room.enterRoom(self.primary)
+        self.room.enterRoom(self.secondary)
+
+        self.addAgent(self.primary)
+        self.addAgent(self.secondary)
+        self.addAgent(self.room)
+
+    def _checkpointArguments(self):
+        return dict(replicates=self._replicates)
+
+    def step(self):
+        for agent in self.agents:
+            agent.handle_event()
+
+        for agent in self.agents:
+            agent.step()
+
+        self._currentTime += self._dt_ns
+
+    def runSimulation(self,terminatePrimaryInfected=True,checkpoint=None,checkpointInterval=600):
+        """
+            Running until all the replicates ended.
+
+            A replicate ends when the primary is infected (or recovered) or the secondary is exposed.
+
+        :param checkpoint: callable
+                Called with the model (between steps) every checkpointInterval [s] of wall time.
+        :param checkpointInterval: float
+                [s] of wall time.
+        :return:
+        """
+        lastCheckpoint = time.monotonic()
+        while self.runningReplicates > 0:
+            self.step()
+
+            ended = self.secondary.currentState == EXPOSED_CODE
+            ended |= (self.currentTime > self.primary.incubationEnd) & (self.primary.viralLoad < ONE_PER_ML)
+            ended |= self.primary.currentState == (INFECTED_CODE if terminatePrimaryInfected else RECOVERED_CODE)
+
+            if ended.any():
+                self._endReplicates(ended)
+
+            if self.runningReplicates > 0 and checkpoint is not None and time.monotonic()-lastCheckpoint >= checkpointInterval:
+                checkpoint(self)
+                lastCheckpoint = time.monotonic()
+
+    def _endReplicates(self,ended):
+        primarySymptoms = self.primary.incubationEnd[ended]
+        secondarySymptoms = self.secondary.incubationEnd[ended]
+        secondaryIncubationStart = self.secondary.incubationStart[ended]
+
+        primaryState = self.primary.recordedState[ended]
+        secondaryState = self.secondary.recordedState[ended]
+
+        for i,replicate in enumerate(self._replicateIndex[ended]):
+            self._summary[replicate] = dict(
+                runid=int(replicate),
+                primaryState=PERSON_STATES[primaryState[i]],
+                secondaryState=PERSON_STATES[secondaryState[i]],
+                secondarySick=bool(secondaryState[i] == EXPOSED_CODE),
+                serialIndex=float(secondarySymptoms[i]-primarySymptoms[i]),
+                infectionDateDiff=float(secondaryIncubationStart[i]-primarySymptoms[i]),
+                endTime=self.currentTime
+            )
+
+        keep = ~ended
+        for agent in self.agents:
+            agent.compact(keep)
+        self._replicateIndex = self._replicateIndex[keep]
+
+    def summary(self):
+        """
+            The summary of the replicates that ended.
+
+            Has the fields that singleRoomScenario.run saves for each run:
+                runid, primaryState, secondaryState, secondarySick, serialIndex [s], infectionDateDiff [s]
+            (serialIndex and infectionDateDiff are nan if the secondary was not infected)
+
+            and endTime [s], the time the replicate ended.
+
+        :return:
+            pandas.DataFrame
+        """
+        return pandas.DataFrame([self._summary[x] for x in sorted(self._summary)])
@@ -0,0 +1,458 @@
+"""
+    The Crowd numerical method.
+
+    N occupants in a single room (a classroom, an office ...). The dynamics are the same as in the Events
+    method, but the occupants are held in one agent whose fields (state, hand concentration, exposure,
+    viral load, incubation timing ...) are numpy arrays of length N, as in the Batched method.
+    The events of each action are randomized for all the occupants in one call, and the handlers
+    get the indices of the occupants in which the event took place.
+
+    The occupants share the air, the fomite and the stains of the room. A social contact is
+    between a pair of occupants.
+
+    With room.proximity, the occupants have positions on the floor, and the room indexes them
+    in a uniform grid (spatial.SpatialGrid). A social contact (a hand shake) is then between an occupant
+    and one of its neighbours within room.proximity.contactRadius, and the occupants within
+    room.proximity.talk.radius of a talking occupant inhale a fraction of its airborne droplets
+    (the rest of the droplets are added to the air of the room).
+    The neighbours are found in the cells around the occupant, so the cost is O(N) and not O(N**2).
+
+    The first simulation.indexCases occupants begin as exposed and the others as susceptible.
+"""
+import time
+
+import numpy
+import pandas
+
+from . import abstractAgent
+from .parameters import PERSON_STATES
+from .room import Room
+from .model import Model, ONE_PER_ML
+from .batched import BatchedPerson, SUSCEPTIBLE_CODE, EXPOSED_CODE, INFECTED_CODE, RECOVERED_CODE
+from .spatial import SpatialGrid, toNeighbourRows, expandRows
+
+DEFAULT_OCCUPANTS = 30
+DEFAULT_INDEX_CASES = 1
+
+
+def getCrowdPersonClass():
+    return type('person', (CrowdPerson, abstractAgent.AgentBatched), {})
+
+
+def getCrowdRoomClass():
+    return type('room', (CrowdRoom, abstractAgent.AgentEvents), {})
+
+
+class CrowdPerson(BatchedPerson):
+    """
+        The occupants of a room.
+
+        The arrays hold one entry for each occupant (see BatchedPerson).
+    """
+
+    @property
+    def arrayLength(self):
+        return self.model.occupants
+
+    @property
+    def totalExposeFromBreath(self):
+        return self._fieldChange_totalExposeFromBreath
+
+    @property
+    def totalExposeFromHand(self):
+        return self._fieldChange_totalExposeFromHand
+
+    @property
+    def totalExposeFromDroplets(self):
+        """
+            The exposure to the talk droplets of the neighbours (room.proximity).
+        """
+        return self._fieldChange_totalExposeFromDroplets
+
+    def __init__(self, unique_id, model,indexCases=1):
+        super().__init__(unique_id,model)
+
+        self._currentState[:indexCases] = EXPOSED_CODE
+        self._recordedState[:indexCases] = EXPOSED_CODE
+        self._incubationStart[:indexCases] = 0.
+
+        self._fieldChange["exposeFromDroplets"] = numpy.zeros(self.arrayLength)
+        self.addReplicateArray("_fieldChange_totalExposeFromDroplets",numpy.zeros(self.arrayLength))
+
+    def step(self):
+        exposeFromDroplets = self._fieldChange["exposeFromDroplets"]
+        self._currentExposure += exposeFromDroplets
+        self._totalExposure   += exposeFromDroplets
+        self._fieldChange_totalExposeFromDroplets += exposeFromDroplets
+
+        super().step()
+
+    def _event_handle_touchFomite(self,idx):
+        room = self.location
+        params = self._parameters
+
+        fomiteToHand = params.factorSurfaceToHand * params.handSurfaceArea * room.virusFomiteConcentration
+        handToFomite = params.factorHandToSurface * params.handSurfaceArea * self._virusHandConcentration[idx]
+
+        self._fieldChange["fomiteToHand"][idx] += fomiteToHand - handToFomite
+        room.updateFomite(idx,-(fomiteToHand - handToFomite))
+
+    def _event_handle_talk(self,idx):
+        """
+            Each listener within the talk radius inhales talkInhaledFraction of the airborne droplets
+            (all the listeners together inhale at most all of them), and the rest is added to the air of the room.
+        """
+        room = self.location
+        if room.talkInhaledFraction == 0:
+            return super()._event_handle_talk(idx)
+
+        params = self._parameters
+        talker,listener = room.talkNeighbours(idx)
+        listeners = room.talkListenerCount(idx)
+        inhaled = numpy.minimum(room.talkInhaledFraction*listeners,1.)
+
+        viralExpolsionAir = params.viralLoadFactor_talk*self._viralLoad[idx]*self._evaporatingDropletsVolume_talk
+        numpy.add.at(self._fieldChange["exposeFromDroplets"],listener,
+                     numpy.repeat(viralExpolsionAir*inhaled/numpy.maximum(listeners,1),listeners))
+
+        self._expel(idx,params.viralLoadFactor_talk,
+                    self._evaporatingDropletsVolume_talk*(1-inhaled),self._nonEvaporatingDropletsVolume_talk)
+
+    def updateSocial(self,idx,viralLoad):
+        # an occupant can have several contacts in a step.
+        numpy.add.at(self._fieldChange["hand_interperson"],idx,viralLoad)
+
+
+class CrowdRoom(Room):
+    """
+        The room of the occupants.
+
+        The air, the fomite and the stains are shared, so the changes of all the occupants
+        are added to them. Each occupant has social contacts at the frequency of the social action.
+
+        With room.proximity, the room holds the positions of the occupants in a SpatialGrid
+        and the neighbours of each occupant within the contact and the talk radius (compressed rows,
+        see SpatialGrid.neighbours). They are computed again when the occupants move (moveOccupants).
+    """
+
+    _grid = None                # spatial.SpatialGrid, None without room.proximity.
+    _contactNeighbours = None   # (offset,neighbours) within the contact radius.
+    _talkNeighbours = None      # (offset,neighbours) within the talk radius.
+
+    @property
+    def positions(self):
+        """
+            The positions of the occupants [m] (None without room.proximity).
+        """
+        return None if self._grid is None else self._grid.positions
+
+    @property
+    def talkInhaledFraction(self):
+        proximity = self._parameters.proximity
+        return 0. if proximity is None else proximity.talkInhaledFraction
+
+    def __init__(self, unique_id, model,positions=None):
+        """
+        :param positions: numpy.array
+                (occupants,2) the positions of the occupants [m] (with room.proximity).
+                If None, the positions are uniform on a square floor of room.physical.surfaceArea.
+        """
+        super().__init__(unique_id,model)
+
+        proximity = self._parameters.proximity
+        if proximity is not None:
+            if positions is None:
+                side = numpy.sqrt(self._parameters.surfaceArea)
+                positions = self.randomStream("positions").uniform(0,side,size=(self.model.occupants,2))
+
+            self._grid = SpatialGrid(self._checkPositions(positions),max(proximity.contactRadius,proximity.talkRadius))
+            self._indexNeighbours()
+
+    def _checkPositions(self,positions):
+        positions = numpy.asarray(positions,dtype=float)
+        if positions.shape != (self.model.occupants,2):
+            raise ValueError(f"The positions must be an array of ({self.model.occupants},2) [m], got the shape {positions.shape}")
+        return positions
+
+    def _indexNeighbours(self):
+        proximity = self._parameters.proximity
+        first,second,distance = self._grid.pairsWithin(self._grid.cellSize)
+
+        contact = distance <= proximity.contactRadius
+        self._contactNeighbours = toNeighbourRows(first[contact],second[contact],self.model.occupants)
+
+        talk = distance <= proximity.talkRadius
+        self._talkNeighbours = toNeighbourRows(first[talk],second[talk],self.model.occupants)
+
+    def moveOccupants(self,positions):
+        """
+            Set new positions of the occupants and index them.
+
+        :param positions: numpy.array
+                (occupants,2) [m]
+        """
+        if self._grid is None:
+            raise ValueError("The occupants have positions only with room.proximity")
+
+        self._grid.update(self._checkPositions(positions))
+        self._indexNeighbours()
+
+    def talkNeighbours(self,idx):
+        """
+            The occupants within the talk radius of the occupants in idx.
+
+        :param idx: numpy.array
+                The talking occupants.
+        :return:
+            (talker,listener) numpy.arrays, a pair for each listener of each talker.
+        """
+        offset,neighbours = self._talkNeighbours
+        return expandRows(offset,neighbours,idx)
+
+    def talkListenerCount(self,idx):
+        """
+            The number of occupants within the talk radius of each of the occupants in idx.
+        """
+        offset,neighbours = self._talkNeighbours
+        return offset[idx+1] - offset[idx]
+
+    def handle_event(self):
+        """
+            random a poisson event to see if the event takes place (as in the Events method).
+
+            A social contact involves 2 occupants, so the number of contacts in the room is randomized at
+            N/2 times the frequency of the social action and all of them are handled.
+        :return:
+        """
+        dt = self.model.dt
+        for action in self._parameters.actions[self.currentState]:
+            if action.name == "social":
+                events = self.randomStream(action.name).poisson(dt * action.frequency * self.model.occupants/2.)
+                if events > 0:
+                    self._fieldChange[action.fieldName] = self._fieldChange.get(action.fieldName,0)+events
+                    self._event_handle_social(events)
+            else:
+                events = self.randomStream(action.name).poisson(dt * action.frequency)
+                if events > 0:
+                    self._fieldChange[action.fieldName] = self._fieldChange.get(action.fieldName,0)+1
+                    self._eventHandlers[action.name]()
+
+    def _event_handle_social(self,contacts=1):
+        """
+            Exchange the hand load of random pairs of occupants (with room.proximity, an occupant and
+            one of its neighbours).
+
+        :param contacts: int
+                The number of pairs.
+        :return:
+        """
+        population = self.model.population
+        random = self.randomStream("social")
+
+        person1 = random.randint(0,self.model.occupants,size=contacts)
+        if self._grid is None:
+            person2 = (person1 + random.randint(1,self.model.occupants,size=contacts)) % self.model.occupants
+        else:
+            # a contact with a random neighbour (an occupant without neighbours has no contact).
+            offset,neighbours = self._contactNeighbours
+            degree = offset[person1+1] - offset[person1]
+            person1 = person1[degree > 0]
+            degree = degree[degree > 0]
+            person2 = neighbours[offset[person1] + (random.uniform(0,1,size=len(person1))*degree).astype(int)]
+
+        hand = population.virusHandConcentration
+        person1Person2 = population.handSurfaceArea * population.factorHandToFace * (hand[person2] - hand[person1])
+
+        population.updateSocial(person1, person1Person2)
+        population.updateSocial(person2,-person1Person2)
+
+    def updateAir(self,idx,viralLoad):
+        self._fieldChange["airconcentration"] += numpy.sum(viralLoad)
+
+    def updateFomite(self,idx,viralLoad):
+        self._fieldChange['fomite'] += numpy.sum(viralLoad)
+
+    def updateStain(self,idx,viralLoad,stainArea):
+        """
+            Add a stain for each of the occupants in idx.
+
+        :param idx: numpy.array
+                The occupants.
+        :param viralLoad: numpy.array
+                The number of viruses in the stain.
+        :param stainArea: float
+                [m**2]
+        """
+        self._shedList.add(viralLoad,stainArea)
+
+    def touchStain(self,idx):
+        """
+            Each of the occupants in idx touches at most one stain.
+
+        :param idx: numpy.array
+                The occupants.
+        :return:
+            (the viral load on the touched stain (0 if no stain was touched),stain area)
+        """
+        if self._shedList.count == 0:
+            return numpy.zeros(len(idx)),numpy.ones(len(idx))
+
+        return self._shedList.touchEach(self.randomStream("touchStain").uniform(0,1,size=len(idx)))
+
+
+class singleRoomEnvironmentCloseContant_Crowd(Model):
+    """
+        Simulation of N occupants of a single room.
+        The first indexCases occupants begin as exposed and the others as susceptible.
+
+        The exposed occupants go through the incubation and the sickness (and shed when their viral load
+        is high), so the occupants that were infected in the room can infect others.
+    """
+    _occupants = None
+    _indexCases = None
+    _population = None
+    _positions = None   # The positions of the constructor (None if they were drawn).
+
+    _sharedFields = Model._sharedFields + ("_occupants","_indexCases","_population","_positions")
+
+    @property
+    def occupants(self):
+        """
+            The number of occupants.
+        """
+        return self._occupants
+
+    @property
+    def indexCases(self):
+        """
+            The number of occupants that begin as exposed.
+        """
+        return self._indexCases
+
+    @property
+    def room(self):
+        return self._locations["room"]
+
+    @property
+    def population(self):
+        """
+            The agent of the occupants.
+        """
+        return self._population
+
+    @property
+    def secondaryInfections(self):
+        """
+            The number of occupants (that are not index cases) that were infected.
+        """
+        return int(numpy.sum(self._population.currentState[self._indexCases:] != SUSCEPTIBLE_CODE))
+
+    def __init__(self,JSON,randomSeed,occupants=None,indexCases=None,positions=None):
+        """
+            Initializes the room and its occupants.
+
+        :param JSON:
+                JSON config. See singleRoomEnvironmentCloseContant.
+        :param randomSeed: int
+                The seed of the random number generator.
+        :param occupants: int
+                The number of occupants. If None, use simulation.occupants of the config (default 30).
+        :param indexCases: int
+                The number of occupants that begin as exposed.
+                If None, use simulation.indexCases of the config (default 1).
+        :param positions: numpy.array
+                (occupants,2) the positions of the occupants [m] (with room.proximity).
+                If None, the positions are uniform on the floor of the room.
+        """
+        super().__init__(JSON,randomSeed)
+        self._occupants = int(JSON['simulation'].get('occupants',DEFAULT_OCCUPANTS) if occupants is None else occupants)
+        self._indexCases = int(JSON['simulation'].get('indexCases',DEFAULT_INDEX_CASES) if indexCases is None else indexCases)
+
+        if self._occupants < 2:
+            raise ValueError(f"simulation.occupants must be at least 2, got {self._occupants}")
+
+        if self._indexCases < 1 or self._indexCases >= self._occupants:
+            raise ValueError(f"simulation.indexCases must be between 1 and {self._occupants-1}, got {self._indexCases}")
+
+        self._positions = None if positions is None else numpy.asarray(positions,dtype=float)
+        room = getCrowdRoomClass()("room",self,positions=self._positions)
+        self._population = getCrowdPersonClass()("occupants",self,indexCases=self._indexCases)
+
+        self.addLocation(room)
+        self.room.enterRoom(self.population)
+
+        self.addAgent(self.population)
+        self.addAgent(self.room)
+
+    def _checkpointArguments(self):
+        return dict(occupants=self._occupants,indexCases=self._indexCases,positions=self._positions)
+
+    def step(self):
+        for agent in self.agents:
+            agent.handle_event()
+
+        for agent in self.agents:
+            agent.step()
+
+        self._currentTime += self._dt_ns
+
+    def runSimulation(self,terminatePrimaryInfected=True,checkpoint=None,checkpointInterval=600):
+        """
+            Running until all the index cases ended or all the occupants were infected.
+
+            An index case ends when it is infected (or recovered if not terminatePrimaryInfected),
+            or when its viral load is below 1/ml after the incubation.
+
+        :param checkpoint: callable
+                Called with the model (between steps) every checkpointInterval [s] of wall time.
+        :param checkpointInterval: float
+                [s] of wall time.
+        :return:
+        """
+        population = self.population
+        lastCheckpoint = time.monotonic()
+        running = True
+        while (running):
+            self.step()
+
+            indexState = population.currentState[:self._indexCases]
+            ended = (indexState >= INFECTED_CODE) if terminatePrimaryInfected else (indexState == RECOVERED_CODE)
+            ended |= (self.currentTime > population.incubationEnd[:self._indexCases]) & \
+                     (population.viralLoad[:self._indexCases] < ONE_PER_ML)
+
+            if ended.all() or not (population.currentState == SUSCEPTIBLE_CODE).any():
+                running = False
+
+            if running and checkpoint is not None and time.monotonic()-lastCheckpoint >= checkpointInterval:
+                checkpoint(self)
+                lastCheckpoint = time.monotonic()
+
+    def summary(self):
+        """
+            The summary of the occupants.
+
+            The fields:
+                occupant, indexCase, state, incubationStart [s] and symptomsAppear [s] from the simulation start
+                (nan if the occupant was not infected), totalExposure, exposeFromBreath and exposeFromHand.
+                With room.proximity, also x [m], y [m] and exposeFromDroplets.
+
+        :return:
+            pandas.DataFrame
+        """
+        population = self.population
+        ret = pandas.DataFrame(dict(occupant=numpy.arange(self._occupants),
+                                    indexCase=numpy.arange(self._occupants) < self._indexCases,
+                                    state=[PERSON_STATES[x] for x in population.currentState],
+                                    incubationStart=population.incubationStart,
+                                    symptomsAppear=population.incubationEnd,
+                                    totalExposure=population.totalExposed,
+                                    exposeFromBreath=population.totalExposeFromBreath,
+                                    exposeFromHand=population.totalExposeFromHand))
+
+        positions = self.room.positions
+        if positions is not None:
+            ret["x"] = positions[:,0]
+            ret["y"] = positions[:,1]
+            ret["exposeFromDroplets"] = population.totalExposeFromDroplets
+
+        return ret
@@ -0,0 +1,344 @@
+"""
+    A columnar store for the history of the agents.
+
+    Each agent declares its columns up front. The rows are written to
+    preallocated typed numpy arrays that grow (double) when they are full:
+
+        - FLOAT    : float64 (in SI units, see units).
+        - DATETIME : int64 [ns since epoch]. pandas.NaT is saved as NAT.
+        - CATEGORY : int8 codes of a list of categories (for example, the state).
+        - CONSTANT : a value that is the same in all the rows (for example, the name of the agent).
+
+    The units of the float columns are saved once as metadata.
+
+    SummaryRecorder has the same interface, but keeps only the last row and the
+    sums of some of the float columns (memory that does not depend on the length of the simulation).
+
+    DecimatedRecorder writes only some of the rows (every k rows, at time intervals or on events),
+    and accumulates the sum columns between the rows that are written.
+"""
+import numpy
+import pandas
+
+FLOAT    = "float"
+DATETIME = "datetime"
+CATEGORY = "category"
+CONSTANT = "constant"
+
+NAT = pandas.NaT.value
+
+
+class HistoryRecorder(object):
+    """
+        Holds the rows of the history of an agent in columns.
+
+        Use record() to add a row and toDataFrame() to get the history.
+    """
+
+    _columns    = None  # list of (name,kind) in the order of the output.
+    _units      = None  # column -> (display unit,SI unit)
+    _categories = None  # column -> list of categories.
+    _constants  = None  # column -> value
+    _sumColumns = None  # The float columns that are summed in summary().
+
+    _floats = None      # 2D array: row x float column.
+    _dates  = None      # 2D array: row x datetime column.
+    _codes  = None      # 2D array: row x category column.
+    _length = None
+
+    @property
+    def columns(self):
+        return [name for name,kind in self._columns]
+
+    @property
+    def floatColumns(self):
+        return [name for name,kind in self._columns if kind == FLOAT]
+
+    @property
+    def dateColumns(self):
+        return [name for name,kind in self._columns if kind == DATETIME]
+
+    @property
+    def categoryColumns(self):
+        return [name for name,kind in self._columns if kind == CATEGORY]
+
+    @property
+    def units(self):
+        return self._units
+
+    def __len__(self):
+        return self._length
+
+    def __init__(self,columns,units={},categories={},constants={},sumColumns=(),capacity=1024):
+        """
+            Creates an empty history.
+
+        :param columns: list
+                list of (name,kind) in the order of the output.
+        :param units: dict
+                column -> (display unit,SI unit). The values of these columns are saved in SI units
+                and are converted to the display unit in toDataFrame.
+        :param categories: dict
+                column -> the list of categories of a CATEGORY column.
+        :param constants: dict
+                column -> the value of a CONSTANT column.
+        :param sumColumns: list
+                The float columns whose sum over the rows is returned by summary() (as sum_<column>).
+        :param capacity: int
+                The initial number of rows.
+        """
+        self._columns    = list(columns)
+        self._units      = dict(units)
+        self._categories = dict(categories)
+        self._constants  = dict(constants)
+        self._sumColumns = [name for name in sumColumns if name in self.floatColumns]
+
+        self._floats = numpy.zeros((capacity,len(self.floatColumns)))
+        self._dates  = numpy.zeros((capacity,len(self.dateColumns)),dtype=numpy.int64)
+        self._codes  = numpy.zeros((capacity,len(self.categoryColumns)),dtype=numpy.int8)
+        self._length = 0
+
+    def _grow(self):
+        for name in ["_floats","_dates","_codes"]:
+            current = getattr(self,name)
+            expanded = numpy.zeros((2*current.shape[0],current.shape[1]),dtype=current.dtype)
+            expanded[:current.shape[0]] = current
+            setattr(self,name,expanded)
+
+    def record(self,floats,dates=(),codes=()):
+        """
+            Add a row.
+
+        :param floats: sequence
+                The values of the FLOAT columns (in the order of the columns).
+        :param dates: sequence
+                The values of the DATETIME columns [ns since epoch] (NAT for missing).
+        :param codes: sequence
+                The codes of the CATEGORY columns.
+        """
+        if self._length == self._floats.shape[0]:
+            self._grow()
+
+        row = self._length
+        self._floats[row] = floats
+        if len(dates) > 0:
+            self._dates[row] = dates
+        if len(codes) > 0:
+            self._codes[row] = codes
+        self._length += 1
+
+    def _toDisplayUnits(self,name,values,unitless):
+        if name in self._units:
+            displayUnit,siUnit = self._units[name]
+            values = values / displayUnit.asNumber(siUnit)
+            if not unitless:
+                values = [x*displayUnit for x in values]
+        return values
+
+    def _rows(self):
+        """
+            The rows of the arrays that hold the history.
+        """
+        return slice(0,self._length)
+
+    def _sums(self):
+        """
+            The sums of the sumColumns (NaN is ignored).
+        """
+        floatIndex = [self.floatColumns.index(name) for name in self._sumColumns]
+        return numpy.nansum(self._floats[self._rows(),floatIndex],axis=0)
+
+    def toDataFrame(self,unitless=True):
+        """
+            Return the history.
+
+        :param unitless: bool
+                If true, return numbers (in the display units). Otherwise, return unum objects.
+        :return:
+            pandas.DataFrame
+        """
+        rows = self._rows()
+        floatIndex = dict([(name,i) for i,name in enumerate(self.floatColumns)])
+        dateIndex  = dict([(name,i) for i,name in enumerate(self.dateColumns)])
+        codeIndex  = dict([(name,i) for i,name in enumerate(self.categoryColumns)])
+
+        data = {}
+        for name,kind in self._columns:
+            if kind == FLOAT:
+                data[name] = self._toDisplayUnits(name,self._floats[rows,floatIndex[name]],unitless)
+            elif kind == DATETIME:
+                data[name] = self._dates[rows,dateIndex[name]].view("datetime64[ns]")
+            elif kind == CATEGORY:
+                data[name] = pandas.Categorical.from_codes(self._codes[rows,codeIndex[name]],categories=self._categories[name])
+            else:
+                data[name] = [self._constants[name]]*(rows.stop-rows.start)
+
+        return pandas.DataFrame(data,columns=self.columns)
+
+    def summary(self,unitless=True):
+        """
+            Return the last row and the sums of the sumColumns.
+
+        :param unitless: bool
+                If true, return numbers (in the display units). Otherwise, return unum objects.
+        :return:
+            dict column -> the value in the last row (pandas.NaT for missing dates),
+            and sum_<column> -> the sum of the column.
+        """
+        last = self._rows().stop - 1
+        if last < 0:
+            return {}
+
+        ret = {}
+        for name,kind in self._columns:
+            if kind == FLOAT:
+                ret[name] = self._toDisplayUnits(name,self._floats[last:last+1,self.floatColumns.index(name)],unitless)[0]
+            elif kind == DATETIME:
+                ret[name] = pandas.Timestamp(self._dates[last,self.dateColumns.index(name)])
+            elif kind == CATEGORY:
+                ret[name] = self._categories[name][self._codes[last,self.categoryColumns.index(name)]]
+            else:
+                ret[name] = self._constants[name]
+
+        for name,value in zip(self._sumColumns,self._sums()):
+            ret[f"sum_{name}"] = self._toDisplayUnits(name,numpy.array([value]),unitless)[0]
+
+        return ret
+
+    def historyUnits(self):
+        """
+            Return a JSON with field name and the unit of the columns.
+        :return:
+           dict
+        """
+        return dict([(name,self._units[name][0].strUnit()) for name in self.columns if name in self._units])
+
+
+class SummaryRecorder(HistoryRecorder):
+    """
+        Keeps only the last row and the running sums of the sumColumns.
+
+        toDataFrame() returns the last row.
+    """
+
+    _sumIndex = None    # The index of the sumColumns in the float columns.
+    _sumValues = None   # The running sums.
+
+    def __init__(self,columns,units={},categories={},constants={},sumColumns=()):
+        super().__init__(columns,units=units,categories=categories,constants=constants,sumColumns=sumColumns,capacity=1)
+        self._sumIndex  = [self.floatColumns.index(name) for name in self._sumColumns]
+        self._sumValues = numpy.zeros(len(self._sumColumns))
+
+    def record(self,floats,dates=(),codes=()):
+        self._floats[0] = floats
+        if len(dates) > 0:
+            self._dates[0] = dates
+        if len(codes) > 0:
+            self._codes[0] = codes
+
+        self._sumValues += numpy.nan_to_num(self._floats[0,self._sumIndex])
+        self._length += 1
+
+    def _rows(self):
+        return slice(0,min(self._length,1))
+
+    def _sums(self):
+        return self._sumValues
+
+
+class DecimatedRecorder(HistoryRecorder):
+    """
+        Writes a row only when one of the conditions holds:
+
+            - steps    : steps rows were recorded since the last row that was written.
+            - interval : the first DATETIME column (the date) advanced interval [ns] since the last row that was written.
+            - events   : an event column was not zero in one of the rows since the last row that was written
+                         (something happened), or a category (the state) changed.
+
+        The sum columns of a row that is written hold their sum since the previous row that was written,
+        so the totals are exact. The last recorded row is always in the history: the rows that were not
+        written are staged in the row after the written rows (with the sums since the last row that was written),
+        and reading the history returns the staged row without writing it.
+    """
+
+    _steps      = None
+    _interval   = None
+    _eventIndex = None  # The index of the event columns in the float columns (None to ignore the events).
+
+    _sumIndex    = None  # The index of the sumColumns in the float columns.
+    _accumulated = None  # The sums of the sumColumns since the last row that was written.
+    _staged      = None  # The number of rows that were recorded and were not written.
+    _event       = None  # True if an event happened since the last row that was written.
+
+    def __init__(self,columns,steps=None,interval=None,eventColumns=None,**kwargs):
+        """
+            Creates an empty history.
+
+        :param columns: list
+                list of (name,kind), see HistoryRecorder.
+        :param steps: int
+                Write every steps rows (None to ignore).
+        :param interval: int
+                Write every interval [ns] of the date (None to ignore).
+        :param eventColumns: list
+                The float columns (changes in a step) that are not zero when something happened.
+                Write the rows in which something happened (None to ignore).
+        :param kwargs:
+                The other parameters of HistoryRecorder.
+        """
+        super().__init__(columns,**kwargs)
+        self._steps    = steps
+        self._interval = interval
+        if eventColumns is not None:
+            self._eventIndex = [self.floatColumns.index(name) for name in eventColumns if name in self.floatColumns]
+
+        self._sumIndex    = [self.floatColumns.index(name) for name in self._sumColumns]
+        self._accumulated = numpy.zeros(len(self._sumColumns))
+        self._staged      = 0
+        self._event       = False
+
+    def record(self,floats,dates=(),codes=()):
+        if self._length == self._floats.shape[0]:
+            self._grow()
+
+        # stage the row after the last row that was written.
+        row = self._length
+        self._floats[row] = floats
+        if len(dates) > 0:
+            self._dates[row] = dates
+        if len(codes) > 0:
+            self._codes[row] = codes
+
+        if self._eventIndex is not None:
+            self._event = self._event or bool(numpy.any(numpy.nan_to_num(self._floats[row,self._eventIndex]) != 0))
+
+        self._accumulated += numpy.nan_to_num(self._floats[row,self._sumIndex])
+        self._floats[row,self._sumIndex] = self._accumulated
+        self._staged += 1
+
+        if self._write(row):
+            self._commit()
+
+    def _write(self,row):
+        if row == 0:
+            return True
+
+        if self._steps is not None and self._staged >= self._steps:
+            return True
+
+        if self._interval is not None and self._dates[row,0] - self._dates[row-1,0] >= self._interval:
+            return True
+
+        if self._eventIndex is not None:
+            return self._event or bool(numpy.any(self._codes[row] != self._codes[row-1]))
+
+        return False
+
+    def _commit(self):
+        self._length += 1
+        self._staged = 0
+        self._accumulated[:] = 0
+        self._event = False
+
+    def _rows(self):
+        return slice(0,self._length + (1 if self._staged > 0 else 0))
@@ -0,0 +1,399 @@
+"""
+    The MeanField numerical method.
+
+    The expected values of the single room scenario. Every action happens at its rate
+    (the mean of its Poisson process) instead of at random times, so the air, the fomite, the stains,
+    the hands and the exposures follow a system of ODEs. The rates are taken from the same
+    actions configuration (and the per-state frequencies) as the other methods.
+
+    The ODE is stiff (the hands change in minutes and the viral load in days), and is integrated with
+    scipy.integrate.solve_ivp (simulation.meanField) between the state changes of the persons.
+"""
+import numpy
+import scipy.integrate
+
+from . import abstractAgent
+from . import SUSCEPTIBLE, EXPOSED, INFECTED
+from .person import Person, FIELD_CHANGE_COLUMNS, STATE_CHANGE_RESOLUTION
+from .room import Room
+from .model import singleRoomEnvironmentCloseContant, ONE_PER_ML
+
+# The field changes of the person whose integrals are variables of the ODE
+# (hand_with_decay and the totals are computed from the variables).
+PERSON_ROUTE_COLUMNS = ["surfaceToHand","fomiteToHand","hand_interperson","faceToHand","wash_hands",
+                        "exposeFromBreath","exposeFromHand",
+                        "expulsion_breath_talk","expulsion_breath_sneeze","expulsion_breath_cough",
+                        "immuneSystem"]
+
+MAX_PROBABILITY = 1-1e-15 # The dose response is clipped to this value in the hazard (so it is finite).
+
+
+def getMeanFieldPersonClass():
+    return type('person', (MeanFieldPerson, abstractAgent.AgentMeanField), {})
+
+
+def getMeanFieldRoomClass():
+    return type('room', (MeanFieldRoom, abstractAgent.AgentMeanField), {})
+
+
+class MeanFieldPerson(Person):
+    """
+        A person whose actions happen at their rates (see abstractAgent.AgentMeanField).
+
+        The variables of the ODE are the hand concentration, the current and the total exposure,
+        and the estimate of the infection (see Person._estimateInfection): the immune system checks
+        remove the current exposure at their rate and their hazard is -rate*log(1-P).
+        The person stays susceptible.
+
+        The viral load is a function of the time in the current state (as in updateState).
+    """
+
+    _odeFields = ("_virusHandConcentration","_currentExposure","_totalExposure","_logSurvival","_weightedInfectionTime")
+
+    _sharedFields = Person._sharedFields + ("_rateHandlers",)
+
+    def __init__(self, unique_id, model,startState=SUSCEPTIBLE):
+        super().__init__(unique_id,model,startState=startState)
+        self._routeFields = PERSON_ROUTE_COLUMNS + self._fieldChangeColumns[len(FIELD_CHANGE_COLUMNS):]
+
+        self._fieldChange["immuneSystem"] = 0.
+        self._fieldChange["logSurvival"] = 0.
+        self._fieldChange["weightedInfectionTime"] = 0.
+
+    def viralLoadAt(self,time):
+        """
+            The viral load [1/m**3] in the current state.
+
+        :param time: float
+                [s] from the simulation start.
+        :return:
+            float
+        """
+        if self.currentState == EXPOSED:
+            return float(self._viralLoadTrajectory(time - self._incubationStartNs*1e-9))
+        elif self.currentState == INFECTED:
+            return float(self._viralLoadTrajectory(numpy.maximum(time - self.incubationEndNs*1e-9,0)))
+        else:
+            return self._viralLoad
+
+    def timeOfViralLoad(self,value):
+        """
+            The first time at which the viral load of the sickness is below value.
+
+        :param value: float
+                [1/m**3]
+        :return:
+            int [ns] from the simulation start, or None (if the person is not sick).
+        """
+        if self.currentState != INFECTED:
+            return None
+
+        trajectory = self._viralLoadTrajectory
+        elapsed = numpy.maximum((numpy.log10(value) - trajectory.logy0)/trajectory.slope,0)
+        return self.incubationEndNs + int(numpy.ceil(elapsed*1e9)) + STATE_CHANGE_RESOLUTION
+
+    def setOdeState(self,y):
+        super().setOdeState(y)
+        self._viralLoad = self.viralLoadAt(self.model.currentTime)
+
+    def _rate_handle_touchFomite(self,rate):
+        room = self.location
+        params = self._parameters
+
+        fomiteToHand = rate * params.handSurfaceArea * (params.factorSurfaceToHand * room.virusFomiteConcentration -
+                                                        params.factorHandToSurface * self._virusHandConcentration)
+
+        self._fieldChange["fomiteToHand"] += fomiteToHand
+        room.updateFomite(-fomiteToHand)
+
+    def _rate_handle_touchFace(self,rate):
+        params = self._parameters
+        faceToHand = rate * params.factorHandToFace * (params.autoincolationVolume * self._viralLoad -
+                                                       params.handSurfaceArea * self._virusHandConcentration)
+
+        self._fieldChange["faceToHand"] += faceToHand
+        self._fieldChange["exposeFromHand"] -= faceToHand*params.handToMouth
+
+    def _rate_handle_touchSurface(self,rate):
+        """
+            A touch takes at most one stain: the first stain (the oldest) that it hits (see room.StainStore).
+            The expected concentration on the stain that a touch takes is MeanFieldRoom.stainPickup.
+        """
+        params = self._parameters
+        self._fieldChange["surfaceToHand"] += rate*self.location.stainPickup*params.factorSurfaceToHand*params.handSurfaceArea
+
+    def _expel(self,rate,viralLoadFactor,evaporatingDropletsVolume,nonEvaporatingDropletsVolume,fieldName):
+        viralLoad = rate*viralLoadFactor*self._viralLoad
+
+        self.location.updateAir(viralLoad*evaporatingDropletsVolume)
+        if viralLoad*nonEvaporatingDropletsVolume > 0:
+            self.location.updateStain(viralLoad*nonEvaporatingDropletsVolume,self._parameters.stainArea,rate)
+        self._fieldChange[fieldName] += viralLoad*evaporatingDropletsVolume
+
+    def _rate_handle_cough(self,rate):
+        self._expel(rate,self._parameters.viralLoadFactor_cough,
+                    self._evaporatingDropletsVolume_cough,self._nonEvaporatingDropletsVolume_cough,"expulsion_breath_cough")
+
+    def _rate_handle_talk(self,rate):
+        self._expel(rate,self._parameters.viralLoadFactor_talk,
+                    self._evaporatingDropletsVolume_talk,self._nonEvaporatingDropletsVolume_talk,"expulsion_breath_talk")
+
+    def _rate_handle_sneeze(self,rate):
+        self._expel(rate,self._parameters.viralLoadFactor_sneeze,
+                    self._evaporatingDropletsVolume_sneeze,self._nonEvaporatingDropletsVolume_sneeze,"expulsion_breath_sneeze")
+
+    def _rate_handle_washHands(self,rate):
+        params = self._parameters
+        self._fieldChange["wash_hands"] -= rate*self._virusHandConcentration*params.washingHandEfficiency*params.handSurfaceArea
+
+    def _rate_handle_immuneSystem(self,rate):
+        if self.currentState == SUSCEPTIBLE:
+            params = self._parameters
+            doseresponseFunc = getattr(self,"doseresponse_%s" % params.doseresponseName)
+
+            P = doseresponseFunc(exposure=self._currentExposure, **params.doseresponseParams)
+            hazard = -rate*numpy.log1p(-numpy.minimum(P,MAX_PROBABILITY))
+
+            self._fieldChange["immuneSystem"] -= rate*self._currentExposure
+            self._fieldChange["logSurvival"] -= hazard
+            self._fieldChange["weightedInfectionTime"] += hazard*numpy.exp(self._logSurvival)*self.model.currentTime
+
+    def derivative(self):
+        params = self._parameters
+        fieldChange = self._fieldChange
+
+        fieldChange["exposeFromBreath"] = self.location.virusConcentrationAir * \
+                                          params.breathingRate * \
+                                          params.breathingEfficiency
+
+        # the exposures do not drop below zero (as in step).
+        exposure = fieldChange["exposeFromHand"] + fieldChange["exposeFromBreath"]
+        currentExposure = exposure + fieldChange["immuneSystem"]
+        if self._currentExposure <= 0 and currentExposure < 0:
+            currentExposure = 0.
+
+        totalExposure = exposure
+        if self._totalExposure <= 0 and totalExposure < 0:
+            totalExposure = 0.
+
+        hand = (fieldChange["surfaceToHand"]     + fieldChange["fomiteToHand"] + \
+                fieldChange["hand_interperson"] + fieldChange["faceToHand"]   + fieldChange["wash_hands"])/params.handSurfaceArea - \
+               params.handDecayRate*self._virusHandConcentration
+
+        return numpy.array([hand,currentExposure,totalExposure,fieldChange["logSurvival"],fieldChange["weightedInfectionTime"]] +
+                           [fieldChange.get(field,0.) for field in self._routeFields])
+
+    def collectChanges(self,previous):
+        self._fieldChange["hand_with_decay"] = self._virusHandConcentration - previous[0]
+        self._fieldChange["totalExposeFromBreath"] = self._routeTotals.get("exposeFromBreath",0.)
+        self._fieldChange["totalExposeFromHand"] = self._routeTotals.get("exposeFromHand",0.)
+        super().collectChanges(previous)
+
+    def collect(self):
+        # the event counters of the other methods count the events since the simulation start.
+        for field in self._fieldChangeColumns[len(FIELD_CHANGE_COLUMNS):]:
+            self._fieldChange[field] = self._routeTotals.get(field,0.)
+        super().collect()
+
+
+class MeanFieldRoom(Room):
+    """
+        A room whose actions happen at their rates (see abstractAgent.AgentMeanField).
+
+        The variables of the ODE are the air and the fomite concentrations and the stains.
+
+        A touch takes the first stain that it hits, so the stain k is taken with the probability
+        exp(-H_{k-1})*q_k, where q_k = min(stainArea/effectiveSurfaceArea,1) and H_{k-1} is the hazard
+        of the older stains (see room.StainStore). The stains are shed by a Poisson process, so the expectation
+        of exp(-H_{k-1}) is exp(-Q), where Q is the expected sum of q of the older stains (_stainHazard).
+        The expected concentration that a touch takes is the sum of exp(-Q)*q_k*load_k/stainArea_k (_stainPickup),
+        and all the stains decay at the same rate.
+    """
+
+    _stainLoad   = None # The total viral load of the stains.
+    _stainHazard = None # The expected sum of the probabilities to hit each stain (Q).
+    _stainPickup = None # The expected concentration on the stain that a touch takes [1/m**2].
+
+    _odeFields = ("_virusConcentrationAir","_fomiteConcentration","_stainLoad","_stainHazard","_stainPickup")
+    _routeFields = ("airconcentration","fomite","clean_fomite")
+
+    _sharedFields = Room._sharedFields + ("_rateHandlers",)
+
+    @property
+    def stainLoad(self):
+        """
+            The total viral load of the stains.
+        """
+        return self._stainLoad
+
+    @property
+    def stainPickup(self):
+        """
+            The expected concentration on the stain that a touch takes [1/m**2] (0 if no stain is touched).
+        """
+        return self._stainPickup
+
+    def __init__(self, unique_id, model):
+        super().__init__(unique_id,model)
+        self._stainLoad = 0.
+        self._stainHazard = 0.
+        self._stainPickup = 0.
+        self._fieldChange["stain"] = 0.
+        self._fieldChange["stainHazard"] = 0.
+        self._fieldChange["stainPickup"] = 0.
+
+    def updateStain(self,viralLoad,stainArea,rate):
+        """
+            Shed stains.
+
+        :param viralLoad: float
+                The viral load that is shed to the stains per second.
+        :param stainArea: float
+                The area of a stain [m**2].
+        :param rate: float
+                The number of stains per second.
+        """
+        hitProbability = min(stainArea/self.effectiveSurfaceArea,1.)
+
+        self._fieldChange["stain"] += viralLoad
+        self._fieldChange["stainHazard"] += rate*hitProbability
+        self._fieldChange["stainPickup"] += viralLoad*numpy.exp(-self._stainHazard)*hitProbability/stainArea
+
+    def _rate_handle_cleanFomite(self,rate):
+        params = self._parameters
+        self._fieldChange["clean_fomite"] -= rate*self._fomiteConcentration*params.cleaningEfficiencyFomite*params.fomiteSurfaceArea
+
+    def _rate_handle_social(self,rate):
+        person1 = self.model.primary
+        person2 = self.model.secondary
+
+        person1Person2 = rate * person1.handSurfaceArea * person1.factorHandToFace * (
+                         person2.virusHandConcentration - person1.virusHandConcentration)
+
+        person1.updateSocial( person1Person2)
+        person2.updateSocial(-person1Person2)
+
+    def derivative(self):
+        params = self._parameters
+        fieldChange = self._fieldChange
+
+        air    = fieldChange["airconcentration"]/params.roomVolume - params.decayRateAir*self._virusConcentrationAir
+        fomite = (fieldChange["fomite"] + fieldChange["clean_fomite"])/params.fomiteSurfaceArea - \
+                 params.decayRateFomite*self._fomiteConcentration
+        stains = fieldChange["stain"] - params.decayRateSurface*self._stainLoad
+        pickup = fieldChange["stainPickup"] - params.decayRateSurface*self._stainPickup
+
+        return numpy.array([air,fomite,stains,fieldChange["stainHazard"],pickup] + [fieldChange[field] for field in self._routeFields])
+
+    def collectChanges(self,previous):
+        self._fieldChange["air_with_decay"] = self._virusConcentrationAir - previous[0]
+        self._fieldChange["fomite_with_decay"] = self._fomiteConcentration - previous[1]
+        super().collectChanges(previous)
+
+
+class singleRoomEnvironmentCloseContant_MeanField(singleRoomEnvironmentCloseContant):
+    """
+        The expected values of the simulation of 2 agents, primary and secondary.
+        The primary begins as exposed and the secondary as susceptible.
+
+        Each step integrates the ODE of the agents to the next state change of the persons
+        (or to the time at which the primary stops shedding, see runSimulation) with the solver
+        of simulation.meanField. The history has a row for each step of the solver, with the
+        expected changes since the previous row (and the expected number of events since the simulation
+        start in the event counters, as the counters of the other methods).
+
+        The secondary stays susceptible and its infection probability is estimated along the
+        expected exposure (as in simulation.raoBlackwell). The incubation period of the primary is drawn
+        from the seed, so a run is the expectation given the incubation period.
+    """
+
+    _odeSlices = None # The slice of the variables of each agent in the ODE.
+
+    def __init__(self,JSON,randomSeed):
+        super().__init__(JSON,randomSeed)
+
+        self._odeSlices = []
+        start = 0
+        for agent in self.agents:
+            size = len(agent.odeState())
+            self._odeSlices.append(slice(start,start+size))
+            start += size
+
+        # the first row holds the initial state.
+        for agent in self.agents:
+            agent.collectChanges(agent.odeState())
+
+    def _agentClasses(self):
+        return getMeanFieldPersonClass(),getMeanFieldRoomClass()
+
+    def _odeState(self):
+        return numpy.concatenate([agent.odeState() for agent in self.agents])
+
+    def _setOdeState(self,y):
+        for agent,odeSlice in zip(self.agents,self._odeSlices):
+            agent.setOdeState(y[odeSlice])
+
+    def _derivative(self,t,y):
+        """
+            The derivative of the ODE of all the agents.
+
+        :param t: float
+                [s] from the simulation start.
+        :param y: numpy.array
+                The variables of the agents.
+        :return:
+            numpy.array
+        """
+        self._currentTime = int(round(t*1e9))
+        self._setOdeState(y)
+
+        for agent in self.agents:
+            agent.resetRates()
+
+        for agent in self.agents:
+            agent.handle_event()
+
+        return numpy.concatenate([agent.derivative() for agent in self.agents])
+
+    def _integrate(self,endNs):
+        """
+            Integrate the ODE to endNs and add the rows of the steps of the solver to the history.
+
+        :param endNs: int
+                [ns] from the simulation start.
+        """
+        simulation = self.parameters.simulation
+        startNs = self._currentTime
+        y0 = self._odeState()
+
+        solution = scipy.integrate.solve_ivp(self._derivative,(startNs*1e-9,endNs*1e-9),y0,
+                                             method=simulation.meanFieldSolver,
+                                             rtol=simulation.meanFieldRtol,
+                                             atol=simulation.meanFieldAtol)
+        if not solution.success:
+            raise RuntimeError(f"The mean field solver failed at {self.toDatetime(startNs)}: {solution.message}")
+
+        times = numpy.round(solution.t[1:]*1e9).astype(numpy.int64)
+        times[-1] = endNs
+
+        previous = y0
+        self._currentTime = startNs
+        for timeNs,y in zip(times,solution.y.T[1:]):
+            self._update_dt(int(timeNs)-self._currentTime)
+            self._currentTime = int(timeNs)
+            self._setOdeState(y)
+            for agent,odeSlice in zip(self.agents,self._odeSlices):
+                agent.collectChanges(previous[odeSlice])
+            previous = y
+
+    def step(self):
+        upcomingChanges = [x for x in [self.primary.nextStateChange(),
+                                       self.secondary.nextStateChange(),
+                                       self.primary.timeOfViralLoad(ONE_PER_ML)] if x is not None]
+
+        endNs = sorted(upcomingChanges)[0] if len(upcomingChanges) > 0 else self._currentTime + self._dt_ns_base
+        if endNs > self._currentTime:
+            self._integrate(endNs)
+
+        self.primary.updateState()
+        self.secondary.updateState()
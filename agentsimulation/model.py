@@ -1,70 +1,189 @@
 import pandas
 import numpy
+import json
+import copy
+import os
+import pickle
+import time
+import zlib
+import functools
 from .person import getPersonClass
 from .room import getRoomClass
 
 from .person import SUSCEPTIBLE,EXPOSED,INFECTED,RECOVERED
 from unum.units import *
 from . import ml
+from .parameters import compileSettings
+
+ONE_PER_ML = (1/ml).asNumber(1/m**3) # [1/m**3]
+
+COMPILED_CONFIGURATIONS_CACHE_SIZE = 16 # The number of compiled configurations that a process keeps (the most recently used).
+
+
+@functools.lru_cache(maxsize=COMPILED_CONFIGURATIONS_CACHE_SIZE)
+def _compiledConfiguration(key):
+    """
+        The settings and the parameters of a configuration.
+
+    :param key: str
+            The JSON of the configuration as a string (see Model._compileConfiguration).
+    :return:
+        (settings,parameters.ModelParameters)
+    """
+    settings = Model._ConvertJSON_to_conf(json.loads(key))
+    return settings,compileSettings(settings)
 
 
 def getModelClass(JSON):
+    """
+        The model class of the environment (simulation.environment, default singleRoomEnvironmentCloseContant)
+        and the numerical method of the configuration.
+    """
+    environment = JSON['simulation'].get('environment',"singleRoomEnvironmentCloseContant")
     simType = JSON['simulation']['numericalMethod']
-    clsName = f"singleRoomEnvironmentCloseContant_{simType}"
+    clsName = f"{environment}_{simType}"
     return globals()[clsName]
 
+def loadCheckpoint(path):
+    """
+        Create the model of a checkpoint (see Model.saveCheckpoint).
+
+        The model is created with the configuration and the seed of the checkpoint
+        and then its state is restored, so running it continues the run exactly.
+
+    :param path: str
+            The checkpoint file.
+    :return:
+        (the model, the metadata that was saved with the checkpoint)
+    """
+    with open(path,"rb") as file:
+        checkpoint = pickle.load(file)
+
+    JSON = checkpoint["configuration"]
+    model = getModelClass(JSON)(JSON,checkpoint["randomSeed"],**checkpoint["arguments"])
+    model.restore(checkpoint["state"])
+    return model,checkpoint["metadata"]
+
 class Model(object):
     """
         Basic model class.
     """
     _simulationStart = None
+    _simulationStartNs = None
     random = None
+    _streams = None # stream name -> RandomState (None if all the streams use random).
 
     _locations = None
     _agentList = None
     _settings  = None
+    _parameters = None
+
+    _configuration = None
+    _randomSeed = None
+
+    # The fields that the constructor sets from the configuration (not in the checkpoint).
+    _sharedFields = ("_agentList","_locations","_settings","_parameters","_configuration","_randomSeed")
 
     @property
     def simulationStart(self):
         return self._simulationStart
 
-    _currentTime = None
+    @property
+    def simulationStartNs(self):
+        """
+            The simulation start [ns since epoch].
+        """
+        return self._simulationStartNs
+
+    _currentTime = None # int [ns] from the simulation start.
 
     @property
-    def getCurrentDatetime(self):
+    def currentTimeNs(self):
+        """
+            The current time, int [ns] from the simulation start.
+        """
         return self._currentTime
 
+    @property
+    def currentTime(self):
+        """
+            The current time [s] from the simulation start.
+        """
+        return self._currentTime*1e-9
+
+    @property
+    def getCurrentDatetime(self):
+        return self.toDatetime(self._currentTime)
+
+    def toDatetime(self,timeNs):
+        """
+            Convert a time in the simulation clock to a datetime.
+
+        :param timeNs: int
+                [ns] from the simulation start.
+        :return:
+            pandas.Timestamp
+        """
+        return pandas.Timestamp(self._simulationStartNs + timeNs)
+
 
     @property
     def settings(self):
         return self._settings
 
+    @property
+    def parameters(self):
+        """
+            The settings compiled to SI floats (see parameters.compileSettings).
+        :return:
+            parameters.ModelParameters
+        """
+        return self._parameters
 
     @property
     def dt_base(self):
-        return self.settings["simulation"]["dt"]
+        """
+            The base time step [s].
+        """
+        return self.parameters.simulation.dt
+
+    _dt_ns_base = None
+    @property
+    def dt_ns_base(self):
+        """
+            The base time step, int [ns].
+        """
+        return self._dt_ns_base
 
     @property
     def dt_datetime_base(self):
-        return pandas.to_timedelta("%sm" % self.dt_base.asNumber(min), unit='ms')
+        return pandas.to_timedelta(self._dt_ns_base, unit='ns')
 
 
     _dt = None
+    _dt_ns = None
     @property
     def dt(self):
+        """
+            The current time step [s].
+        """
         return self._dt
 
     def __init__(self,JSON,randomSeed):
 
         self._agentList = []
-        self._settings  = self._ConvertJSON_to_conf(JSON)
+        self._configuration = copy.deepcopy(JSON)
+        self._randomSeed = randomSeed
+        self._settings,self._parameters = self._compileConfiguration(JSON)
         self._locations = {}
 
         self._simulationStart  = pandas.to_datetime(pandas.to_datetime("1/1/2020 00:00"), unit='ms')
-        self._currentTime = self._simulationStart
+        self._simulationStartNs = self._simulationStart.value
+        self._currentTime = 0
 
         self._dt = self.dt_base
-        self._dt_datetime = self.dt_datetime_base
+        self._dt_ns_base = pandas.to_timedelta(self.dt_base, unit='s').value
+        self._dt_ns = self._dt_ns_base
 
         try:
             self.random = numpy.random.RandomState(randomSeed)
@@ -72,7 +191,105 @@ class Model(object):
             print(e)
             print("Error seed %s too large " % randomSeed)
 
-    def _ConvertJSON_to_conf(self,JSON):
+        self._streams = {} if self.parameters.simulation.commonRandomNumbers else None
+
+    def randomStream(self,name):
+        """
+            The random generator of a stream of draws (the events of an agent/action pair,
+            the incubation period of an agent...).
+
+            With simulation.commonRandomNumbers, each stream has its own generator that is derived
+            from the seed and the name of the stream. Runs of different configurations with the same
+            seed (the replicate) draw the same numbers in each stream, so their results are paired.
+            Otherwise, all the streams use the generator of the model.
+
+        :param name: str
+                The name of the stream.
+        :return:
+            numpy.random.RandomState
+        """
+        if self._streams is None:
+            return self.random
+
+        if name not in self._streams:
+            seed = numpy.random.SeedSequence(self._randomSeed,spawn_key=(zlib.crc32(name.encode("utf-8")),))
+            self._streams[name] = numpy.random.RandomState(numpy.random.MT19937(seed))
+        return self._streams[name]
+
+    def _state(self):
+        return dict(model=dict([(key,value) for key,value in vars(self).items() if key not in self._sharedFields]),
+                    agents=dict([(agent.unique_id,agent.getState()) for agent in self.agents]))
+
+    def checkpoint(self):
+        """
+            Return the state of the model: the clock, the random generator and the state of the agents
+            (the history, the stains, the event calendar...).
+
+            The model can continue to run (the state is a copy).
+        :return:
+            dict
+        """
+        return copy.deepcopy(self._state())
+
+    def restore(self,state):
+        """
+            Restore a state (from checkpoint).
+
+            The model must have the configuration and the seed of the model of the state.
+        :param state: dict
+        """
+        state = copy.deepcopy(state)
+        self.__dict__.update(state["model"])
+        for agent in self.agents:
+            agent.setState(state["agents"][agent.unique_id])
+
+    def _checkpointArguments(self):
+        """
+            The arguments of the constructor (other than the configuration and the seed).
+        """
+        return {}
+
+    def saveCheckpoint(self,path,**metadata):
+        """
+            Save the configuration, the seed and the state of the model (see loadCheckpoint).
+
+            The checkpoint is written to a temporary file that replaces path, so path always
+            holds a complete checkpoint.
+
+        :param path: str
+                The checkpoint file.
+        :param metadata:
+                Saved with the checkpoint (returned by loadCheckpoint).
+        """
+        checkpoint = dict(configuration=self._configuration,
+                          randomSeed=self._randomSeed,
+                          arguments=self._checkpointArguments(),
+                          metadata=metadata,
+                          state=self._state())
+
+        temporary = f"{path}.tmp"
+        with open(temporary,"wb") as file:
+            pickle.dump(checkpoint,file,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary,path)
+
+    def _compileConfiguration(self,JSON):
+        """
+            Convert the JSON to settings and parameters.
+
+            The results of the last COMPILED_CONFIGURATIONS_CACHE_SIZE configurations are kept for the process,
+            so a worker that runs many seeds of the same configuration compiles it once.
+            The settings and the parameters are not changed by the models.
+
+        :param JSON:
+                JSON config.
+        :return:
+            (settings,parameters.ModelParameters)
+        """
+        # the keys are not sorted: the order of the actions in the configuration is the order of their events.
+        return _compiledConfiguration(json.dumps(JSON,default=str))
+
+    @staticmethod
+    def _ConvertJSON_to_conf(JSON):
         """
             Traverse the JSON and replace all the unum values with objects.
 
@@ -82,7 +299,7 @@ class Model(object):
         ret ={}
         for key,value in JSON.items():
             if isinstance(value,dict):
-                ret[key] = self._ConvertJSON_to_conf(JSON[key])
+                ret[key] = Model._ConvertJSON_to_conf(JSON[key])
             elif isinstance(value,list):
                 ret[key] = value
             else:
@@ -116,10 +333,12 @@ class singleRoomEnvironmentCloseContant(Model):
     _primary = None
     _secondary = None
 
+    _sharedFields = Model._sharedFields + ("_primary","_secondary")
+
 
     @property
     def terminatePrimaryInfected(self):
-        return self.settings["simulation"]["terminatePrimaryInfected"]
+        return self.parameters.simulation.terminatePrimaryInfected
 
     @property
     def room(self):
@@ -193,9 +412,7 @@ class singleRoomEnvironmentCloseContant(Model):
 
         """
         super().__init__(JSON,randomSeed)
-        numericalMethod = self.settings["simulation"]["numericalMethod"]
-        PersonClass = getPersonClass(f"Agent{numericalMethod}")
-        RoomClass   = getRoomClass(f"Agent{numericalMethod}")
+        PersonClass,RoomClass = self._agentClasses()
 
         room      = RoomClass("room",self)
         self._primary   = PersonClass("primary",self,startState=EXPOSED)
@@ -211,26 +428,46 @@ class singleRoomEnvironmentCloseContant(Model):
         self.addAgent(self.room)
 
 
+    def _agentClasses(self):
+        """
+            The classes of the persons and the room of the numerical method.
+        :return:
+            (person class,room class)
+        """
+        numericalMethod = self.parameters.simulation.numericalMethod
+        return getPersonClass(f"Agent{numericalMethod}"),getRoomClass(f"Agent{numericalMethod}")
+
     def step(self):
         raise NotImplementedError("Implement in specialized class")
 
-    def _update_dt(self,new_dt):
-        self._dt = new_dt.total_seconds()*s
-        self._dt_datetime = new_dt
+    def _update_dt(self,new_dt_ns):
+        """
+            Set the time step.
+        :param new_dt_ns: int
+                [ns]
+        """
+        self._dt = new_dt_ns*1e-9
+        self._dt_ns = new_dt_ns
 
-    def runSimulation(self,terminatePrimaryInfected=True):
+    def runSimulation(self,terminatePrimaryInfected=True,checkpoint=None,checkpointInterval=600):
         """
             Running until primary is infected or the secondary is exposed
 
+        :param checkpoint: callable
+                Called with the model (between steps) every checkpointInterval.
+                For example, lambda model: model.saveCheckpoint(path).
+        :param checkpointInterval: float
+                [s] of wall time.
         :return:
         """
+        lastCheckpoint = time.monotonic()
         running = True
         while (running):
             self.step()
             if self.secondary.currentState == EXPOSED:
                 running = False
 
-            if (self.getCurrentDatetime > self.primary.incubationEnd) and (self.primary.viralLoad.asNumber(1 / ml) < 1):
+            if (self.currentTimeNs > self.primary.incubationEndNs) and (self.primary.viralLoad < ONE_PER_ML):
                 running = False
 
             if terminatePrimaryInfected:
@@ -240,6 +477,10 @@ class singleRoomEnvironmentCloseContant(Model):
                 if self.primary.currentState == RECOVERED:
                     running = False
 
+            if running and checkpoint is not None and time.monotonic()-lastCheckpoint >= checkpointInterval:
+                checkpoint(self)
+                lastCheckpoint = time.monotonic()
+
 
 
 class singleRoomEnvironmentCloseContant_EquiDistance(singleRoomEnvironmentCloseContant):
@@ -250,40 +491,39 @@ class singleRoomEnvironmentCloseContant_EquiDistance(singleRoomEnvironmentCloseC
 
     def __init__(self,JSON,randomSeed):
         super().__init__(JSON,randomSeed)
-        speriod = pandas.to_timedelta("%sd" % self.primary.sicknessPeriod.asNumber(d))
-        totalsimulation = ((self.primary.incubationEnd+speriod)-self.getCurrentDatetime ).total_seconds()*s
+        totalsimulation = pandas.to_timedelta(self.primary.incubationEndNs+self.primary.sicknessPeriodNs-self.currentTimeNs,unit='ns').total_seconds()
         self.fillAllEvents(totalsimulation)
 
     def fillAllEvents(self,totalsimulation):
-        self.primary.fillEvents(self.getCurrentDatetime,totalsimulation)
-        self.secondary.fillEvents(self.getCurrentDatetime,totalsimulation)
-        self.room.fillEvents(self.getCurrentDatetime,totalsimulation)
+        self.primary.fillEvents(self.currentTimeNs,totalsimulation)
+        self.secondary.fillEvents(self.currentTimeNs,totalsimulation)
+        self.room.fillEvents(self.currentTimeNs,totalsimulation)
 
     def step(self):
-        upcommingEventDate = None
+        upcommingEventTime = None
         for agent in self.agents:
             agent.handle_event()
 
 
         for agent in self.agents:
             agent.step()
-            if agent.upcomingEvent is not None:
-                if upcommingEventDate is None:
-                    upcommingEventDate = agent.upcomingEvent["date"]
-                elif agent.upcomingEvent["date"] < upcommingEventDate :
-                    upcommingEventDate = agent.upcomingEvent["date"]
+            agentEventTime = agent.upcomingEventTime
+            if agentEventTime is not None:
+                if upcommingEventTime is None or agentEventTime < upcommingEventTime:
+                    upcommingEventTime = agentEventTime
 
 
-        if upcommingEventDate  is not None:
-            dt_diff = upcommingEventDate - self.getCurrentDatetime
-            if dt_diff < self._dt_datetime:
+        if upcommingEventTime  is not None:
+            dt_diff = int(upcommingEventTime - self._currentTime)
+            # compare to the base dt (and not to the current dt), so that a step never passes an event.
+            if dt_diff < self._dt_ns_base:
                 self._update_dt(dt_diff)
             else:
-                self._update_dt(self.dt_datetime_base)
+                self._update_dt(self._dt_ns_base)
         else:
-            self._update_dt(self.dt_datetime_base)
+            self._update_dt(self._dt_ns_base)
 
-        self._currentTime += self._dt_datetime
+        self._currentTime += self._dt_ns
 
 class singleRoomEnvironmentCloseContant_Events(singleRoomEnvironmentCloseContant):
     """
@@ -297,4 +537,109 @@ class singleRoomEnvironmentCloseContant_Events(singleRoomEnvironmentCloseContant
         for agent in self.agents:
             agent.step()
 
-        self._currentTime += self._dt_datetime
+        self._currentTime += self._dt_ns
+
+class singleRoomEnvironmentCloseContant_TauLeaping(singleRoomEnvironmentCloseContant):
+    """
+        Simulation of 2 agents, primary and secondary.
+        The primary begins as exposed and the secondary as susceptible.
+
+        Tau leaping: the step (the leap) is chosen from the current rates of the actions and the decay rates,
+        so that the expected relative change of the hands, the viral load, the air and the fomite in a leap
+        is about simulation.tauLeaping.epsilon (epsilon/the largest relative rate of change of the agents,
+        see relativeChangeRate), and at most simulation.tauLeaping.maxLeap.
+        A leap does not pass a state change of the persons.
+
+        In a leap, the number of events of each action is poisson and all of them are handled.
+    """
+
+    def _leap(self):
+        """
+            The length of the next leap, int [ns].
+        """
+        simulation = self.parameters.simulation
+        rate = numpy.max([agent.relativeChangeRate() for agent in self.agents])
+        leap = simulation.tauLeapingMaxLeap if rate == 0 else numpy.minimum(simulation.tauLeapingEpsilon/rate,simulation.tauLeapingMaxLeap)
+        leapNs = int(leap*1e9)
+
+        stateChanges = [x for x in [self.primary.nextStateChange(),self.secondary.nextStateChange()] if x is not None]
+        if len(stateChanges) > 0:
+            leapNs = numpy.minimum(leapNs,sorted(stateChanges)[0]-self._currentTime)
+
+        return int(numpy.maximum(leapNs,1))
+
+    def step(self):
+        # the leap and the events use the state at the start of the leap.
+        self.primary.updateState()
+        self.secondary.updateState()
+        self._update_dt(self._leap())
+
+        for agent in self.agents:
+            agent.handle_event()
+
+        for agent in self.agents:
+            agent.step()
+
+        self._currentTime += self._dt_ns
+
+class singleRoomEnvironmentCloseContant_NextEvent(singleRoomEnvironmentCloseContant):
+    """
+        Simulation of 2 agents, primary and secondary.
+        The primary begins as exposed and the secondary as susceptible.
+
+        Discrete event simulation: instead of a fixed dt, the time to the next event is drawn
+        from the total rate of the actions of all the agents. The agents are advanced to that time
+        in closed form (exponential decay, see Person.advance and Room.advance) and only then the event is handled.
+
+        The state changes of the persons (end of incubation and sickness) are scheduled events.
+        The history has a row for each event.
+    """
+
+    def _nextEvent(self):
+        """
+            Return the time to the next event, int [ns], and whether it is a state change.
+        """
+        totalRate = sum([agent.totalRate() for agent in self.agents])
+        timeToEvent = self.random.exponential(1e9/totalRate) if totalRate > 0 else numpy.inf
+
+        stateChanges = [x for x in [self.primary.nextStateChange(),self.secondary.nextStateChange()] if x is not None]
+        if len(stateChanges) > 0:
+            timeToChange = sorted(stateChanges)[0]-self._currentTime
+            if timeToChange <= timeToEvent:
+                return max(timeToChange,0),True
+
+        if numpy.isinf(timeToEvent):
+            return self._dt_ns_base,True
+
+        return int(timeToEvent),False
+
+    def step(self):
+        timeToEvent,stateChange = self._nextEvent()
+        self._update_dt(timeToEvent)
+
+        for agent in self.agents:
+            agent.advance(self._dt)
+
+        self._currentTime += self._dt_ns
+
+        self.primary.updateState()
+        self.secondary.updateState()
+
+        if not stateChange:
+            rate = self.random.uniform(0,sum([agent.totalRate() for agent in self.agents]))
+            for agent in self.agents:
+                if rate < agent.totalRate():
+                    agent.handle_event(rate)
+                    break
+                rate -= agent.totalRate()
+
+        # apply the changes of the event (without decay).
+        self._dt = 0.
+        for agent in self.agents:
+            agent.step()
+
+
+from .batched import singleRoomEnvironmentCloseContant_Batched
+from .meanField import singleRoomEnvironmentCloseContant_MeanField
+from .crowd import singleRoomEnvironmentCloseContant_Crowd
+from .aircabin import aircabinEnvironment_Events
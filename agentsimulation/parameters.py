@@ -0,0 +1,434 @@
+"""
+    Compiles the unum configuration into frozen parameter records.
+
+    The configuration (after model._ConvertJSON_to_conf) holds unum objects.
+    The dimensions are checked once here, and every value is converted to
+    a plain float in SI units (m, s, m**2, m**3, 1/m**3 ...).
+
+    The agents use these records in the step loop, so unum is used only when the
+    configuration is read and when the history is exported.
+"""
+from collections import namedtuple
+from types import MappingProxyType
+
+from unum import Unum
+from unum.units import m, s
+
+from . import SUSCEPTIBLE, EXPOSED, INFECTED, RECOVERED
+
+PERSON_STATES = (SUSCEPTIBLE, EXPOSED, INFECTED, RECOVERED)
+PERSON_STATE_CODES = dict([(state, code) for code, state in enumerate(PERSON_STATES)])
+
+DEFAULT_NEGLIGIBLE_STAIN_LOAD = 1e-6  # viruses. Stains with lower load are merged.
+
+# The policies of the history recording (simulation.recording.policy).
+RECORD_EVERY_STEP = "everyStep"   # a row every step.
+RECORD_STEPS      = "steps"       # a row every recording.steps steps.
+RECORD_INTERVAL   = "interval"    # a row every recording.interval of simulation time.
+RECORD_ON_EVENT   = "onEvent"     # a row when an event happened or the state changed.
+RECORDING_POLICIES = (RECORD_EVERY_STEP, RECORD_STEPS, RECORD_INTERVAL, RECORD_ON_EVENT)
+
+# The numerical methods that draw each stream of random numbers from its own generator (simulation.commonRandomNumbers).
+COMMON_RANDOM_NUMBERS_METHODS = ("Events", "EquiDistance")
+
+# The numerical methods that estimate the infection probability along the exposure path (simulation.raoBlackwell).
+RAO_BLACKWELL_METHODS = ("Events", "EquiDistance", "NextEvent", "MeanField", "TauLeaping")
+
+# The numerical methods of the persons and the room that support the zones of the room air (room.air.zones).
+AIR_ZONES_METHODS = ("Events", "EquiDistance", "TauLeaping")
+
+# The numerical methods that place the occupants in the room (room.proximity).
+PROXIMITY_METHODS = ("Crowd",)
+
+# The numerical method of the expected values. The secondary stays susceptible (as in simulation.raoBlackwell).
+MEAN_FIELD = "MeanField"
+DEFAULT_MEAN_FIELD_SOLVER = "BDF"   # The method of scipy.integrate.solve_ivp (simulation.meanField.solver).
+DEFAULT_MEAN_FIELD_RTOL = 1e-6
+DEFAULT_MEAN_FIELD_ATOL = 1e-12
+
+# The leap of the TauLeaping method (simulation.tauLeaping).
+DEFAULT_TAU_LEAPING_EPSILON  = 0.03   # The expected relative change of the state in a leap.
+DEFAULT_TAU_LEAPING_MAX_LEAP = 600.   # [s]
+
+ModelParameters = namedtuple("ModelParameters", ["simulation", "person", "room", "aircabin"])  # aircabin is None without the aircabin settings.
+
+SimulationParameters = namedtuple("SimulationParameters", ["dt",
+                                                           "numericalMethod",
+                                                           "terminatePrimaryInfected",
+                                                           "collectFullData",
+                                                           "recordingPolicy",
+                                                           "recordingSteps",       # int
+                                                           "recordingInterval",    # [s] or None
+                                                           "commonRandomNumbers",
+                                                           "raoBlackwell",
+                                                           "exposureTrace",
+                                                           "meanFieldSolver",
+                                                           "meanFieldRtol",
+                                                           "meanFieldAtol",
+                                                           "tauLeapingEpsilon",
+                                                           "tauLeapingMaxLeap"])   # [s]
+
+ActionParameters = namedtuple("ActionParameters", ["name",          # the action name.
+                                                   "frequency",     # [1/s]
+                                                   "handler",       # the name of the handling method.
+                                                   "fieldName"])    # the name of the event counter.
+
+PersonParameters = namedtuple("PersonParameters", ["breathingRate",          # [m**3/s]
+                                                   "breathingEfficiency",
+                                                   "maxViralLoad",           # [1/m**3]
+                                                   "minViralLoad",           # [1/m**3]
+                                                   "handSurfaceArea",        # [m**2]
+                                                   "handDecayRate",          # [1/s]
+                                                   "sicknessPeriod",         # [s]
+                                                   "doseresponseName",
+                                                   "doseresponseParams",
+                                                   "viralLoadFactor_cough",
+                                                   "viralLoadFactor_sneeze",
+                                                   "viralLoadFactor_talk",
+                                                   "stainArea",              # [m**2]
+                                                   "factorHandToFace",
+                                                   "handToMouth",
+                                                   "autoincolationVolume",   # [m**3]
+                                                   "factorSurfaceToHand",
+                                                   "factorHandToSurface",
+                                                   "washingHandEfficiency",
+                                                   "actions"])               # state -> tuple of ActionParameters
+
+RoomParameters = namedtuple("RoomParameters", ["surfaceArea",                 # [m**2]
+                                               "height",                      # [m]
+                                               "roomVolume",                  # [m**3]
+                                               "furnitureSurfaceAreaFactor",
+                                               "effectiveSurfaceArea",        # [m**2]
+                                               "decayRateAir",                # [1/s] decay + exchange.
+                                               "decayRateSurface",            # [1/s]
+                                               "fomiteSurfaceArea",           # [m**2]
+                                               "decayRateFomite",             # [1/s]
+                                               "cleaningEfficiencyFomite",
+                                               "negligibleStainLoad",         # stains with lower load are merged.
+                                               "airZones",                    # AirZonesParameters, None if the air is well mixed.
+                                               "proximity",                   # ProximityParameters, None if the occupants have no positions.
+                                               "actions"])                    # None -> tuple of ActionParameters
+
+AirZonesParameters = namedtuple("AirZonesParameters", ["names",              # tuple of the zone names.
+                                                       "volume",             # tuple, [m**3]
+                                                       "decayRateVirus",     # [1/s] the decay of the virus in the air.
+                                                       "ventilation",        # tuple, [1/s] the supply (and extraction) of clean air.
+                                                       "flows",              # tuple of (source zone,target zone,flow [m**3/s]).
+                                                       "occupants"])         # person name -> zone (the others are in zone 0).
+
+ProximityParameters = namedtuple("ProximityParameters", ["contactRadius",        # [m] the social contacts are between occupants within the radius.
+                                                         "talkRadius",           # [m] the occupants within the radius inhale the droplets of a talk.
+                                                         "talkInhaledFraction"]) # The fraction of the airborne droplets of a talk that each of them inhales
+                                                                                 # (taken from the droplets that are added to the air).
+
+AircabinParameters = namedtuple("AircabinParameters", ["rows",
+                                                       "seatsPerRow",
+                                                       "rowsPerCompartment",
+                                                       "rowVolume",                 # [m**3]
+                                                       "rowSurfaceArea",            # [m**2] the surfaces of the stains.
+                                                       "rowFomiteSurfaceArea",      # [m**2]
+                                                       "galleyVolume",              # [m**3]
+                                                       "galleySurfaceArea",         # [m**2]
+                                                       "galleyFomiteSurfaceArea",   # [m**2]
+                                                       "decayRateAir",              # [1/s] the decay of the virus in the air.
+                                                       "airChangeRate",             # [1/s] the supply (and extraction) of clean air.
+                                                       "longitudinalFlow",          # [m**3/s] between adjacent compartments.
+                                                       "flightDuration",            # [s]
+                                                       "indexCases",
+                                                       "crewMembers",
+                                                       "crewResidenceTime"])        # [s] the mean time in a compartment.
+
+
+def toSI(value, unit, name):
+    """
+        Convert a configuration value to a float in the requested SI unit.
+
+    :param value: unum or number
+            The value from the configuration.
+    :param unit: unum or 1
+            The SI unit. Use 1 for unitless values.
+    :param name: str
+            The path of the value in the configuration (used in the error message).
+    :return:
+        float
+    """
+    try:
+        if isinstance(value, Unum):
+            return float(value.asNumber(unit))
+        elif not isinstance(unit, Unum):
+            return float(value)
+    except TypeError as e:
+        raise ValueError(f"{name} has wrong units: {e}")
+
+    raise ValueError(f"{name} must have units of {unit}, got {value}")
+
+
+def compileActions(actionsSettings, states, agentType):
+    """
+        Build the event-handler dispatch table.
+
+    :param actionsSettings: dict
+            settings[agentType]["actions"]
+    :param states: list
+            The states of the agent. The frequency can be a dict state->frequency.
+    :param agentType: str
+            Used in the error messages.
+    :return:
+        A read only mapping state -> tuple of ActionParameters (in the order of the configuration).
+    """
+    ret = {}
+    for state in states:
+        actionList = []
+        for name, eventData in actionsSettings.items():
+            frequency = eventData["frequency"]
+            if isinstance(frequency, dict):
+                frequency = frequency[state]
+
+            actionList.append(ActionParameters(name=name,
+                                               frequency=toSI(frequency, 1/s, f"{agentType}.actions.{name}.frequency"),
+                                               handler=f"_event_handle_{name}",
+                                               fieldName=f"event_{name}"))
+        ret[state] = tuple(actionList)
+
+    return MappingProxyType(ret)
+
+
+def compileSimulation(settings):
+    simulation = settings["simulation"]
+
+    recording = simulation.get("recording", {})
+    recordingPolicy = recording.get("policy", RECORD_EVERY_STEP)
+    if recordingPolicy not in RECORDING_POLICIES:
+        raise ValueError(f"simulation.recording.policy must be one of {RECORDING_POLICIES}, got {recordingPolicy}")
+
+    recordingInterval = recording.get("interval", None)
+    if recordingInterval is not None:
+        recordingInterval = toSI(recordingInterval, s, "simulation.recording.interval")
+    elif recordingPolicy == RECORD_INTERVAL:
+        raise ValueError("simulation.recording.interval must be set for the interval policy")
+
+    commonRandomNumbers = bool(simulation.get("commonRandomNumbers", False))
+    if commonRandomNumbers and simulation["numericalMethod"] not in COMMON_RANDOM_NUMBERS_METHODS:
+        raise ValueError(f"simulation.commonRandomNumbers is supported only in {COMMON_RANDOM_NUMBERS_METHODS}")
+
+    # The exposure trace is recorded on the path in which the person stays susceptible (as in raoBlackwell).
+    exposureTrace = bool(simulation.get("exposureTrace", False))
+    raoBlackwell = bool(simulation.get("raoBlackwell", False)) or exposureTrace or simulation["numericalMethod"] == MEAN_FIELD
+    if raoBlackwell and simulation["numericalMethod"] not in RAO_BLACKWELL_METHODS:
+        raise ValueError(f"simulation.raoBlackwell is supported only in {RAO_BLACKWELL_METHODS}")
+
+    if exposureTrace and simulation["numericalMethod"] == MEAN_FIELD:
+        raise ValueError(f"simulation.exposureTrace is not supported in {MEAN_FIELD} (there are no immune system checks)")
+
+    meanField = simulation.get("meanField", {})
+    tauLeaping = simulation.get("tauLeaping", {})
+
+    return SimulationParameters(dt=toSI(simulation["dt"], s, "simulation.dt"),
+                                numericalMethod=simulation["numericalMethod"],
+                                terminatePrimaryInfected=simulation["terminatePrimaryInfected"],
+                                collectFullData=simulation["collectFullData"],
+                                recordingPolicy=recordingPolicy,
+                                recordingSteps=int(recording.get("steps", 1)),
+                                recordingInterval=recordingInterval,
+                                commonRandomNumbers=commonRandomNumbers,
+                                raoBlackwell=raoBlackwell,
+                                exposureTrace=exposureTrace,
+                                meanFieldSolver=meanField.get("solver", DEFAULT_MEAN_FIELD_SOLVER),
+                                meanFieldRtol=toSI(meanField.get("rtol", DEFAULT_MEAN_FIELD_RTOL), 1, "simulation.meanField.rtol"),
+                                meanFieldAtol=toSI(meanField.get("atol", DEFAULT_MEAN_FIELD_ATOL), 1, "simulation.meanField.atol"),
+                                tauLeapingEpsilon=toSI(tauLeaping.get("epsilon", DEFAULT_TAU_LEAPING_EPSILON), 1, "simulation.tauLeaping.epsilon"),
+                                tauLeapingMaxLeap=toSI(tauLeaping.get("maxLeap", DEFAULT_TAU_LEAPING_MAX_LEAP*s), s, "simulation.tauLeaping.maxLeap"))
+
+
+def compilePerson(settings):
+    physiology = settings["physiology"]
+    actions = settings["actions"]
+    doseresponse = actions["immuneSystem"]["doseresponse"]
+
+    return PersonParameters(
+        breathingRate=toSI(physiology["breathingRate"], m**3/s, "person.physiology.breathingRate"),
+        breathingEfficiency=toSI(physiology["breathingEfficiency"], 1, "person.physiology.breathingEfficiency"),
+        maxViralLoad=toSI(physiology["maxviralload"], 1/m**3, "person.physiology.maxviralload"),
+        minViralLoad=toSI(physiology["minviralload"], 1/m**3, "person.physiology.minviralload"),
+        handSurfaceArea=toSI(physiology["hand"]["surfaceArea"], m**2, "person.physiology.hand.surfaceArea"),
+        handDecayRate=toSI(physiology["hand"]["decayRate"], 1/s, "person.physiology.hand.decayRate"),
+        sicknessPeriod=toSI(physiology["sickness"]["period"], s, "person.physiology.sickness.period"),
+        doseresponseName=doseresponse["name"],
+        doseresponseParams=MappingProxyType({key: toSI(value, 1, f"person.actions.immuneSystem.doseresponse.params.{key}")
+                                             for key, value in doseresponse["params"].items()}),
+        viralLoadFactor_cough=toSI(actions["cough"]["viralLoadFactor"], 1, "person.actions.cough.viralLoadFactor"),
+        viralLoadFactor_sneeze=toSI(actions["sneeze"]["viralLoadFactor"], 1, "person.actions.sneeze.viralLoadFactor"),
+        viralLoadFactor_talk=toSI(actions["talk"]["viralLoadFactor"], 1, "person.actions.talk.viralLoadFactor"),
+        stainArea=toSI(actions["cough"]["stainArea"], m**2, "person.actions.cough.stainArea"),
+        factorHandToFace=toSI(actions["touchFace"]["factorHandToFace"], 1, "person.actions.touchFace.factorHandToFace"),
+        handToMouth=toSI(actions["touchFace"]["handToMouth"], 1, "person.actions.touchFace.handToMouth"),
+        autoincolationVolume=toSI(actions["touchFace"]["autoincolationVolume"], m**3, "person.actions.touchFace.autoincolationVolume"),
+        factorSurfaceToHand=toSI(actions["touchSurface"]["factorSurfaceToHand"], 1, "person.actions.touchSurface.factorSurfaceToHand"),
+        factorHandToSurface=toSI(actions["touchSurface"]["factorHandToSurface"], 1, "person.actions.touchSurface.factorHandToSurface"),
+        washingHandEfficiency=toSI(actions["washHands"]["efficiency"], 1, "person.actions.washHands.efficiency"),
+        actions=compileActions(actions, PERSON_STATES, "person")
+    )
+
+
+def compileRoom(settings):
+    physical = settings["physical"]
+
+    surfaceArea = toSI(physical["surfaceArea"], m**2, "room.physical.surfaceArea")
+    height = toSI(physical["height"], m, "room.physical.height")
+    furnitureSurfaceAreaFactor = toSI(physical["furnitureSurfaceAreaFactor"], 1, "room.physical.furnitureSurfaceAreaFactor")
+
+    return RoomParameters(
+        surfaceArea=surfaceArea,
+        height=height,
+        roomVolume=surfaceArea*height,
+        furnitureSurfaceAreaFactor=furnitureSurfaceAreaFactor,
+        effectiveSurfaceArea=surfaceArea*furnitureSurfaceAreaFactor,
+        decayRateAir=toSI(settings["air"]["decayRate"], 1/s, "room.air.decayRate") +
+                     toSI(settings["air"]["exchangeRate"], 1/s, "room.air.exchangeRate"),
+        decayRateSurface=toSI(settings["surface"]["decayRate"], 1/s, "room.surface.decayRate"),
+        fomiteSurfaceArea=toSI(settings["fomite"]["surfaceArea"], m**2, "room.fomite.surfaceArea"),
+        decayRateFomite=toSI(settings["fomite"]["decayRate"], 1/s, "room.fomite.decayRate"),
+        cleaningEfficiencyFomite=toSI(settings["actions"]["cleanFomite"]["efficiency"], 1, "room.actions.cleanFomite.efficiency"),
+        negligibleStainLoad=toSI(settings["surface"].get("negligibleLoad", DEFAULT_NEGLIGIBLE_STAIN_LOAD), 1, "room.surface.negligibleLoad"),
+        airZones=compileAirZones(settings["air"]) if "zones" in settings["air"] else None,
+        proximity=compileProximity(settings["proximity"]) if "proximity" in settings else None,
+        actions=compileActions(settings["actions"], [None], "room")
+    )
+
+
+def compileAirZones(airSettings):
+    """
+        The zones of the room air.
+
+        room.air.zones is a map zone name -> {"volume", "ventilation" (default room.air.exchangeRate),
+        "occupants" (list of person names)}, and room.air.flows is a map source zone -> {target zone -> flow}.
+
+    :param airSettings: dict
+            settings["room"]["air"]
+    :return:
+        AirZonesParameters
+    """
+    zones = airSettings["zones"]
+    if len(zones) == 0:
+        raise ValueError("room.air.zones must have at least one zone")
+
+    names = tuple(zones.keys())
+    zoneIndex = dict([(name, index) for index, name in enumerate(names)])
+
+    volume = []
+    ventilation = []
+    occupants = {}
+    for name, zone in zones.items():
+        volume.append(toSI(zone["volume"], m**3, f"room.air.zones.{name}.volume"))
+        if volume[-1] <= 0:
+            raise ValueError(f"room.air.zones.{name}.volume must be positive, got {zone['volume']}")
+
+        ventilation.append(toSI(zone.get("ventilation", airSettings["exchangeRate"]), 1/s, f"room.air.zones.{name}.ventilation"))
+        for person in zone.get("occupants", []):
+            if person in occupants:
+                raise ValueError(f"room.air.zones: {person} is an occupant of more than one zone")
+            occupants[person] = zoneIndex[name]
+
+    flows = []
+    for source, targets in airSettings.get("flows", {}).items():
+        for target, flow in targets.items():
+            for zone in (source, target):
+                if zone not in zoneIndex:
+                    raise ValueError(f"room.air.flows: {zone} is not a zone of room.air.zones")
+            flows.append((zoneIndex[source], zoneIndex[target], toSI(flow, m**3/s, f"room.air.flows.{source}.{target}")))
+
+    return AirZonesParameters(names=names,
+                              volume=tuple(volume),
+                              decayRateVirus=toSI(airSettings["decayRate"], 1/s, "room.air.decayRate"),
+                              ventilation=tuple(ventilation),
+                              flows=tuple(flows),
+                              occupants=MappingProxyType(occupants))
+
+
+def compileProximity(proximitySettings):
+    """
+        The close contact of the occupants that have positions.
+
+        room.proximity is {"contactRadius", "talk" : {"radius", "inhaledFraction"}}.
+        Without "talk", the talk droplets are only added to the air and the surfaces.
+
+    :param proximitySettings: dict
+            settings["room"]["proximity"]
+    :return:
+        ProximityParameters
+    """
+    talk = proximitySettings.get("talk", {})
+
+    contactRadius = toSI(proximitySettings["contactRadius"], m, "room.proximity.contactRadius")
+    talkRadius = toSI(talk["radius"], m, "room.proximity.talk.radius") if "radius" in talk else 0.
+    talkInhaledFraction = toSI(talk.get("inhaledFraction", 0), 1, "room.proximity.talk.inhaledFraction")
+
+    if contactRadius <= 0:
+        raise ValueError(f"room.proximity.contactRadius must be positive, got {proximitySettings['contactRadius']}")
+
+    if talkInhaledFraction < 0 or talkInhaledFraction > 1:
+        raise ValueError(f"room.proximity.talk.inhaledFraction must be between 0 and 1, got {talkInhaledFraction}")
+
+    return ProximityParameters(contactRadius=contactRadius,
+                               talkRadius=talkRadius,
+                               talkInhaledFraction=talkInhaledFraction)
+
+
+def compileAircabin(settings):
+    aircabin = settings["aircabin"]
+    row = aircabin["row"]
+    galley = aircabin["galley"]
+    ventilation = aircabin["ventilation"]
+
+    rows = int(aircabin["rows"])
+    rowsPerCompartment = int(aircabin.get("rowsPerCompartment", 1))
+    if rows % rowsPerCompartment != 0:
+        raise ValueError(f"aircabin.rows ({rows}) must be a multiple of aircabin.rowsPerCompartment ({rowsPerCompartment})")
+
+    seats = rows*int(aircabin["seatsPerRow"])
+    indexCases = int(aircabin.get("indexCases", 1))
+    if indexCases < 1 or indexCases >= seats:
+        raise ValueError(f"aircabin.indexCases must be between 1 and {seats-1}, got {indexCases}")
+
+    return AircabinParameters(
+        rows=rows,
+        seatsPerRow=int(aircabin["seatsPerRow"]),
+        rowsPerCompartment=rowsPerCompartment,
+        rowVolume=toSI(row["volume"], m**3, "aircabin.row.volume"),
+        rowSurfaceArea=toSI(row["surfaceArea"], m**2, "aircabin.row.surfaceArea"),
+        rowFomiteSurfaceArea=toSI(row["fomiteSurfaceArea"], m**2, "aircabin.row.fomiteSurfaceArea"),
+        galleyVolume=toSI(galley["volume"], m**3, "aircabin.galley.volume"),
+        galleySurfaceArea=toSI(galley["surfaceArea"], m**2, "aircabin.galley.surfaceArea"),
+        galleyFomiteSurfaceArea=toSI(galley["fomiteSurfaceArea"], m**2, "aircabin.galley.fomiteSurfaceArea"),
+        decayRateAir=toSI(settings["room"]["air"]["decayRate"], 1/s, "room.air.decayRate"),
+        airChangeRate=toSI(ventilation["airChangeRate"], 1/s, "aircabin.ventilation.airChangeRate"),
+        longitudinalFlow=toSI(ventilation["longitudinalFlow"], m**3/s, "aircabin.ventilation.longitudinalFlow"),
+        flightDuration=toSI(aircabin["flightDuration"], s, "aircabin.flightDuration"),
+        indexCases=indexCases,
+        crewMembers=int(aircabin["crew"]["members"]),
+        crewResidenceTime=toSI(aircabin["crew"]["residenceTime"], s, "aircabin.crew.residenceTime")
+    )
+
+
+def compileSettings(settings):
+    """
+        Check the dimensions of the configuration and convert it to SI floats.
+
+    :param settings: dict
+            The output of Model._ConvertJSON_to_conf.
+    :return:
+        ModelParameters
+    """
+    simulation = compileSimulation(settings)
+    room = compileRoom(settings["room"])
+    if room.airZones is not None and (settings["simulation"].get("environment", "singleRoomEnvironmentCloseContant") != "singleRoomEnvironmentCloseContant" or
+                                     simulation.numericalMethod not in AIR_ZONES_METHODS):
+        raise ValueError(f"room.air.zones is supported only in the single room environment with {AIR_ZONES_METHODS}")
+
+    if room.proximity is not None and simulation.numericalMethod not in PROXIMITY_METHODS:
+        raise ValueError(f"room.proximity is supported only in {PROXIMITY_METHODS}")
+
+    return ModelParameters(simulation=simulation,
+                           person=compilePerson(settings["person"]),
+                           room=room,
+                           aircabin=compileAircabin(settings) if "aircabin" in settings else None)
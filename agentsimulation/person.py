@@ -3,10 +3,30 @@ from unum.units import *
 from  . import abstractAgent
 from scipy.stats import uniform,gamma,beta
 
-from . import log_interp1d,ml,SUSCEPTIBLE,EXPOSED,INFECTED,RECOVERED
+from . import LogLinearTrajectory,ml,SUSCEPTIBLE,EXPOSED,INFECTED,RECOVERED
+from .parameters import PERSON_STATES,PERSON_STATE_CODES
+from .history import FLOAT,DATETIME,CATEGORY,CONSTANT,NAT
 
 import pandas
 
+RECOVERED_VIRALLOAD = (1e-10/ml).asNumber(1/m**3) # [1/m**3] the viral load at the end of the sickness period.
+STATE_CHANGE_RESOLUTION = 1000 # [ns]. The state changes after (and not at) the incubation/sickness end.
+
+# The field changes that are written to the history (in this order, after the event counters).
+FIELD_CHANGE_COLUMNS = ["surfaceToHand","fomiteToHand","hand_interperson","faceToHand","wash_hands",
+                        "exposeFromBreath","exposeFromHand","totalExposeFromBreath","totalExposeFromHand",
+                        "expulsion_breath_talk","expulsion_breath_sneeze","expulsion_breath_cough",
+                        "hand_with_decay","immuneSystem"]
+
+# The field changes that are not zero when something happened in the step.
+EVENT_COLUMNS = ["surfaceToHand","fomiteToHand","hand_interperson","faceToHand","wash_hands",
+                 "exposeFromHand",
+                 "expulsion_breath_talk","expulsion_breath_sneeze","expulsion_breath_cough"]
+
+# The field changes that are reset every step (their sum is the total of the route).
+# The breath exposure and the decay change continuously.
+SUMMED_COLUMNS = EVENT_COLUMNS + ["exposeFromBreath","hand_with_decay"]
+
 
 def getPersonClass(modelType):
 
@@ -52,6 +72,7 @@ class Person(object):
 
     _currentState       = None
     _currentLocation    = None      # a ref to the compartment the person resides in.
+    _zone               = None      # The air zone of the person in the compartment (see Room.airConcentration).
     _residenceTime      = None      # the time to stay in this compartment.
     _residenceTimeCounter = None    # The time the person stayed in that compartment.
 
@@ -61,8 +82,17 @@ class Person(object):
     _totalExposure      = None      # The total exposure to the virus.
     _virusHandConcentration = None  # Virus concentration on hands.
 
-    _incubationStartDatetime = None
     _incubationPeriod = None
+    _incubationStartNs = None       # The incubation start [ns] from the simulation start (None if not exposed).
+    _incubationPeriodNs = None      # The incubation period [ns] (int).
+    _sicknessPeriodNs = None
+    _viralLoadTrajectory = None     # The viral load curve of the current state (LogLinearTrajectory).
+
+    # The Rao-Blackwell estimate of the infection (simulation.raoBlackwell), see _estimateInfection.
+    _logSurvival = None             # log of the probability not to be infected in the checks so far.
+    _weightedInfectionTime = None   # sum of the check time [s] * the probability to be infected first in the check.
+    _sampledInfectionNs = None      # The first check whose uniform was below the probability (None if not infected).
+    _exposureTrace = None           # list of (time [ns], currentExposure, uniform) of the checks (simulation.exposureTrace).
 
     _maxViralLoad  = None
     _nonEvaporatingDropletsVolume_cough = None
@@ -71,15 +101,29 @@ class Person(object):
     _nonEvaporatingDropletsVolume_sneeze = None
     _evaporatingDropletsVolume_sneeze = None
 
+    _fieldChangeColumns = None      # The field changes that are written to the history.
 
-    def enterLocation(self,locationRef):
+    # The state is held in SI floats. These are the units of the history.
+    _historyUnits = dict(viralLoad=(1/ml,1/m**3),
+                         handconcentration=(1/cm**2,1/m**2),
+                         hand_with_decay=(1/cm**2,1/m**2))
+
+    _summedColumns = SUMMED_COLUMNS
+    _eventColumns = EVENT_COLUMNS
+
+    _sharedFields = abstractAgent.Agent._sharedFields + ("_currentLocation",)
+
+    def enterLocation(self,locationRef,zone=0):
         """
             The person enters the location
         :param locationRef: room obj.
             The object that the person enters to.
+        :param zone: int
+            The air zone of the person in the location.
         :return:
         """
         self._currentLocation = locationRef
+        self._zone = zone
 
         # if locationRef.unique_id in self.settings["residence"]:
         #     residencefunc = self.settings["residence"][locationRef.unique_id]
@@ -97,13 +141,17 @@ class Person(object):
     def location(self):
         return self._currentLocation
 
+    @property
+    def zone(self):
+        return self._zone
+
     @property
     def currentState(self):
         return self._currentState
 
     @property
     def washingHandEfficiency(self):
-        return self.settings["actions"]["washHands"]["efficiency"]
+        return self._parameters.washingHandEfficiency
 
     @property
     def nonEvaporatingDropletsVolume_cough(self):
@@ -135,7 +183,7 @@ class Person(object):
 
     @property
     def incubationStartDatetime(self):
-        return self._incubationStartDatetime
+        return None if self._incubationStartNs is None else self.model.toDatetime(self._incubationStartNs)
 
 
     @property
@@ -146,13 +194,61 @@ class Person(object):
     def virusHandConcentration(self):
         return self._virusHandConcentration
 
+    @property
+    def infectionProbability(self):
+        """
+            The probability to be infected in the immune system checks so far (simulation.raoBlackwell).
+        """
+        return -numpy.expm1(self._logSurvival)
+
+    @property
+    def expectedInfectionTime(self):
+        """
+            The expected infection time [s] from the simulation start, given that the person
+            was infected (simulation.raoBlackwell). nan if the infection probability is 0.
+        """
+        infectionProbability = self.infectionProbability
+        return self._weightedInfectionTime/infectionProbability if infectionProbability > 0 else numpy.nan
+
+    @property
+    def exposureTrace(self):
+        """
+            The exposure at the immune system checks and their uniforms (simulation.exposureTrace).
+
+            The exposure does not depend on the dose response (the person stays susceptible),
+            so the outcome for other dose responses can be computed from the trace (see doseResponse.reevaluate).
+
+        :return:
+            pandas.DataFrame with the columns time [s from the simulation start], exposure, uniform.
+        """
+        trace = numpy.array(self._exposureTrace,dtype=float).reshape(-1,3)
+        return pandas.DataFrame(dict(time=trace[:,0]*1e-9,exposure=trace[:,1],uniform=trace[:,2]))
+
+    @property
+    def sampledInfectionNs(self):
+        """
+            The infection time of the sampled outcome, int [ns] from the simulation start,
+            or None if the person was not infected (simulation.raoBlackwell).
+        """
+        return self._sampledInfectionNs
+
     @property
     def incubationEnd(self):
-        return self._incubationStartDatetime + self._incubationPeriod
+        return self.model.toDatetime(self.incubationEndNs)
+
+    @property
+    def incubationEndNs(self):
+        """
+            The end of the incubation, int [ns] from the simulation start.
+        """
+        return self._incubationStartNs + self._incubationPeriodNs
 
 
     @property
     def viralLoad(self):
+        """
+            The viral load [1/m**3]
+        """
         return self._viralLoad
 
     @property
@@ -170,28 +266,41 @@ class Person(object):
 
     @property
     def viralLoadFactor_cough(self):
-        return self.model.settings["person"]["actions"]["cough"]["viralLoadFactor"]
+        return self._parameters.viralLoadFactor_cough
 
     @property
     def viralLoadFactor_sneeze(self):
-        return self.model.settings["person"]["actions"]["sneeze"]["viralLoadFactor"]
+        return self._parameters.viralLoadFactor_sneeze
 
     @property
     def viralLoadFactor_talk(self):
-        return self.model.settings["person"]["actions"]["talk"]["viralLoadFactor"]
+        return self._parameters.viralLoadFactor_talk
 
     @property
     def maxViralLoad(self):
-        return self.settings["physiology"]["maxviralload"]
+        """
+            [1/m**3]
+        """
+        return self._parameters.maxViralLoad
 
 
     @property
     def sicknessPeriod(self):
-        return self.settings["physiology"]["sickness"]["period"]
+        """
+            [s]
+        """
+        return self._parameters.sicknessPeriod
 
     @property
     def sicknessPeriod_datetime(self):
-        return pandas.to_timedelta("%sd" % self.sicknessPeriod.asNumber(d))
+        return pandas.to_timedelta(self._sicknessPeriodNs, unit='ns')
+
+    @property
+    def sicknessPeriodNs(self):
+        """
+            int [ns]
+        """
+        return self._sicknessPeriodNs
 
     @property
     def factorSurfaceToHand(self):
@@ -199,7 +308,7 @@ class Person(object):
             f12
         :return:
         """
-        return self.settings["actions"]["touchSurface"]["factorSurfaceToHand"]
+        return self._parameters.factorSurfaceToHand
 
     @property
     def factorHandToSurface(self):
@@ -207,12 +316,15 @@ class Person(object):
             f12
         :return:
         """
-        return self.settings["actions"]["touchSurface"]["factorHandToSurface"]
+        return self._parameters.factorHandToSurface
 
 
     @property
     def handSurfaceArea(self):
-        return self.settings["physiology"]["hand"]["surfaceArea"]
+        """
+            [m**2]
+        """
+        return self._parameters.handSurfaceArea
 
     @property
     def factorHandToFace(self):
@@ -221,28 +333,37 @@ class Person(object):
             f23
         :return:
         """
-        return self.settings["actions"]["touchFace"]["factorHandToFace"]
+        return self._parameters.factorHandToFace
 
     @property
     def autoincolationVolume(self):
-        return self.settings["actions"]["touchFace"]["autoincolationVolume"]
+        """
+            [m**3]
+        """
+        return self._parameters.autoincolationVolume
 
     @property
     def handToMouth(self):
-        return self.settings["actions"]["touchFace"]["handToMouth"]
+        return self._parameters.handToMouth
 
     @property
     def breathingRate(self):
-        return self.settings["physiology"]["breathingRate"]
+        """
+            [m**3/s]
+        """
+        return self._parameters.breathingRate
 
     @property
     def breathingEfficiency(self):
-        return self.settings["physiology"]["breathingEfficiency"]
+        return self._parameters.breathingEfficiency
 
 
     @property
     def handDecayRate(self):
-        return self.settings["physiology"]["hand"]["decayRate"]
+        """
+            [1/s]
+        """
+        return self._parameters.handDecayRate
 
     def __init__(self, unique_id, model,startState=SUSCEPTIBLE):
         """
@@ -264,14 +385,19 @@ class Person(object):
         super().__init__(unique_id, model,agentType="person")
         self._currentState = startState
         self._currentLocation = None
-        incubationStartDatetime = model.simulationStart if startState == EXPOSED else None
-
-        self._incubationStartDatetime=incubationStartDatetime
         self._incubationPeriod= self.get_incubationPeriod()
-
-        self._dt = model.settings["simulation"]["dt"]
-        self._viralLoad = 0/ml
-        self._virusHandConcentration = 0/cm**2
+        self._incubationPeriodNs = self._incubationPeriod.value
+        self._sicknessPeriodNs = pandas.to_timedelta(self.sicknessPeriod, unit='s').value
+        if startState == EXPOSED:
+            self._becomeExposed(0)
+
+        self._logSurvival = 0.
+        self._weightedInfectionTime = 0.
+        self._exposureTrace = [] if model.parameters.simulation.exposureTrace else None
+
+        self._dt = model.dt
+        self._viralLoad = 0.
+        self._virusHandConcentration = 0.
         self._currentExposure = 0.
         self._totalExposure = 0.
         self._fieldChange["surfaceToHand"] = 0.
@@ -296,87 +422,177 @@ class Person(object):
     def step(self):
 
         room = self.location
+        params = self._parameters
+        dt = self.model.dt
+        fieldChange = self._fieldChange
 
-        self._fieldChange["exposeFromBreath"] = (room.virusConcentrationAir * \
-                                             self.breathingRate * \
-                                             self.breathingEfficiency * self.dt).asNumber()
+        fieldChange["exposeFromBreath"] += room.airConcentration(self._zone) * \
+                                           params.breathingRate * \
+                                           params.breathingEfficiency * dt
 
-        self._currentExposure +=  self._fieldChange["exposeFromHand"] + self._fieldChange["exposeFromBreath"]
+        self._currentExposure +=  fieldChange["exposeFromHand"] + fieldChange["exposeFromBreath"]
         if (self._currentExposure < 0):
             self._currentExposure = 0
 
-        self._totalExposure += self._fieldChange["exposeFromHand"] + self._fieldChange["exposeFromBreath"]
+        self._totalExposure += fieldChange["exposeFromHand"] + fieldChange["exposeFromBreath"]
         if (self._totalExposure < 0):
             self._totalExposure = 0
 
-        self._fieldChange["totalExposeFromBreath"] += self._fieldChange["exposeFromBreath"]
-        self._fieldChange["totalExposeFromHand"]   += self._fieldChange["exposeFromHand"]
+        fieldChange["totalExposeFromBreath"] += fieldChange["exposeFromBreath"]
+        fieldChange["totalExposeFromHand"]   += fieldChange["exposeFromHand"]
 
-        handchange = (self._fieldChange["surfaceToHand"]     + self._fieldChange["fomiteToHand"]  + \
-                      self._fieldChange["hand_interperson"] + self._fieldChange["faceToHand"])/self.handSurfaceArea
+        handchange = (fieldChange["surfaceToHand"]     + fieldChange["fomiteToHand"]  + \
+                      fieldChange["hand_interperson"] + fieldChange["faceToHand"])/params.handSurfaceArea
 
         hand_before  = self._virusHandConcentration
-        self._virusHandConcentration = (self._virusHandConcentration + handchange)/(1+ (self.handDecayRate*self.dt).asNumber())
-        if (self._virusHandConcentration < 0/cm**2):
-            self._virusHandConcentration = 0/cm**2
+        self._virusHandConcentration = (self._virusHandConcentration + handchange)/(1+ params.handDecayRate*dt)
+        if (self._virusHandConcentration < 0):
+            self._virusHandConcentration = 0.
 
-        self._fieldChange["hand_with_decay"] = self._virusHandConcentration - hand_before
+        fieldChange["hand_with_decay"] = self._virusHandConcentration - hand_before
 
         self.collect()
 
-        self._fieldChange["surfaceToHand"] = 0.
-        self._fieldChange["fomiteToHand"]  = 0.
-        self._fieldChange["hand_interperson"] = 0.
-        self._fieldChange["faceToHand"] = 0.
-        self._fieldChange["exposeFromBreath"] = 0.
-        self._fieldChange["exposeFromHand"]  = 0.
-        self._fieldChange["wash_hands"] = 0.
-        self._fieldChange["expulsion_breath_talk"] = 0.
-        self._fieldChange["expulsion_breath_sneeze"] = 0.
-        self._fieldChange["expulsion_breath_cough"] = 0.
+        fieldChange["surfaceToHand"] = 0.
+        fieldChange["fomiteToHand"]  = 0.
+        fieldChange["hand_interperson"] = 0.
+        fieldChange["faceToHand"] = 0.
+        fieldChange["exposeFromBreath"] = 0.
+        fieldChange["exposeFromHand"]  = 0.
+        fieldChange["wash_hands"] = 0.
+        fieldChange["expulsion_breath_talk"] = 0.
+        fieldChange["expulsion_breath_sneeze"] = 0.
+        fieldChange["expulsion_breath_cough"] = 0.
+
+        self.updateState()
 
+    def updateState(self):
+        """
+            Update the state and the viral load to the current time.
+        :return:
+            None
+        """
         if self.currentState == EXPOSED:
-            if self.model.getCurrentDatetime > self.incubationEnd:
-                self._currentState = INFECTED
-                self._viralLoad = self.maxViralLoad
+            timeIncubating = self.model.currentTimeNs - self._incubationStartNs
+            if timeIncubating > self._incubationPeriodNs:
+                self._becomeInfected()
             else:
-
-                minViral = self.model.settings['person']['physiology']['minviralload'].asNumber()
-
-                # update the viral load
-                incubationStartDatetime = self.incubationStartDatetime
-                currentdate             = self.model.getCurrentDatetime
-                hoursIncubating = (currentdate-incubationStartDatetime).total_seconds()/pandas.to_timedelta("1h").total_seconds()
-                totalIncubationPeriod = self.incubationPeriod
-                totalIncubationHours = totalIncubationPeriod.total_seconds() / pandas.to_timedelta("1h").total_seconds()
-
-                viralInterpolator = log_interp1d([0,numpy.ceil(totalIncubationHours)],[minViral,self.maxViralLoad.asNumber(1/ml)])
-                self._viralLoad = viralInterpolator(hoursIncubating)/ml
+                self._viralLoad = float(self._viralLoadTrajectory(timeIncubating*1e-9))
 
         elif self.currentState == INFECTED:
-            if (self.model.getCurrentDatetime - self.incubationEnd) > self.sicknessPeriod_datetime:
+            ## reduce the viral load with time.
+            timeSick = self.model.currentTimeNs - self._incubationStartNs - self._incubationPeriodNs
+            if timeSick > self._sicknessPeriodNs:
                 self._currentState = RECOVERED
             else:
-                ## reduce the viral load with time.
-                incubationEnd = self.incubationEnd
-                currentdate = self.model.getCurrentDatetime
-                hoursSick = (currentdate - incubationEnd).total_seconds() / pandas.to_timedelta("1h").total_seconds()
-                if hoursSick < 0:
-                    hoursSick =0
+                if timeSick < 0:
+                    timeSick = 0
 
-                totalHoursSick = self.sicknessPeriod_datetime.total_seconds() / pandas.to_timedelta("1h").total_seconds()
-
-                viralInterpolator = log_interp1d([0, numpy.ceil(totalHoursSick)],
-                                                 [self.maxViralLoad.asNumber(1 / ml),1e-10])
-
-                self._viralLoad = viralInterpolator(hoursSick) / ml
+                self._viralLoad = float(self._viralLoadTrajectory(timeSick*1e-9))
 
         if self._residenceTime is not None:
             if self._residenceTimeCounter > self._residenceTime:
                 gotRoom = self.settings
 
             else:
-                self._residenceTimeCounter += self._dt
+                self._residenceTimeCounter += self.model.dt
+
+    def _becomeExposed(self,incubationStartNs):
+        """
+            Start the incubation and set the viral load curve of the incubation.
+
+            The viral load rises (log-linearly) from minviralload to maxviralload during
+            the incubation period (rounded up to hours).
+        :param incubationStartNs: int
+                [ns] from the simulation start.
+        :return:
+            None
+        """
+        params = self._parameters
+        self._currentState = EXPOSED
+        self._incubationStartNs = incubationStartNs
+
+        totalIncubationHours = numpy.ceil(self._incubationPeriod.total_seconds()/3600.)
+        self._viralLoadTrajectory = LogLinearTrajectory(totalIncubationHours*3600.,params.minViralLoad,params.maxViralLoad)
+
+    def _becomeInfected(self):
+        """
+            End the incubation and set the viral load curve of the sickness.
+
+            The viral load drops (log-linearly) from maxviralload during the sickness period (rounded up to hours).
+        :return:
+            None
+        """
+        params = self._parameters
+        self._currentState = INFECTED
+        self._viralLoad = params.maxViralLoad
+
+        totalHoursSick = numpy.ceil(params.sicknessPeriod/3600.)
+        self._viralLoadTrajectory = LogLinearTrajectory(totalHoursSick*3600.,params.maxViralLoad,RECOVERED_VIRALLOAD)
+
+    def nextStateChange(self):
+        """
+            The first time at which updateState changes the state.
+        :return:
+            int [ns] from the simulation start, or None (if the state does not change with time).
+        """
+        if self.currentState == EXPOSED:
+            return self.incubationEndNs + STATE_CHANGE_RESOLUTION
+        elif self.currentState == INFECTED:
+            return self.incubationEndNs + self._sicknessPeriodNs + STATE_CHANGE_RESOLUTION
+        else:
+            return None
+
+    def advance(self,dt):
+        """
+            Advance the person dt seconds without events, in closed form.
+
+            The hand concentration decays exponentially and the exposure from breath
+            is the integral of the room air concentration (that decays exponentially).
+            Must be called before the room advances.
+
+            The exposure is added to the exposure in the next step().
+
+        :param dt: float
+                [s]
+        :return:
+            None
+        """
+        params = self._parameters
+        room   = self.location
+
+        decayRateAir = room.decayRateAir
+        airIntegral = -numpy.expm1(-decayRateAir*dt)/decayRateAir if decayRateAir > 0 else dt
+
+        self._fieldChange["exposeFromBreath"] += room.virusConcentrationAir * \
+                                                 params.breathingRate * \
+                                                 params.breathingEfficiency * airIntegral
+
+        self._virusHandConcentration *= numpy.exp(-params.handDecayRate*dt)
+
+    def relativeChangeRate(self):
+        """
+            The largest relative rate of change [1/s] of the hand concentration and the viral load
+            in the current state (used to choose the leap of the TauLeaping method).
+
+            An action that moves a fraction f of the hand concentration adds its rate*f,
+            and the viral load changes at ln(10)*|slope| of its log-linear curve.
+        :return:
+            float
+        """
+        params = self._parameters
+        rates = dict([(action.name,action.frequency) for action in self.getActionList()])
+
+        hand = params.handDecayRate + \
+               rates["touchFace"]*params.factorHandToFace + \
+               rates["touchFomite"]*params.factorHandToSurface + \
+               rates["washHands"]*params.washingHandEfficiency
+
+        viralLoad = 0.
+        if self.currentState in [EXPOSED,INFECTED]:
+            viralLoad = numpy.log(10)*numpy.abs(self._viralLoadTrajectory.slope)
+
+        return float(numpy.maximum(hand,viralLoad))
 
     def _event_handle_touchFomite(self):
         """
@@ -390,12 +606,13 @@ class Person(object):
             None
         """
         room = self.location
+        params = self._parameters
 
-        fomiteToHand = self.factorSurfaceToHand * self.handSurfaceArea * room.virusFomiteConcentration
-        handToFomite = self.factorHandToSurface * self.handSurfaceArea * self.virusHandConcentration
+        fomiteToHand = params.factorSurfaceToHand * params.handSurfaceArea * room.virusFomiteConcentration
+        handToFomite = params.factorHandToSurface * params.handSurfaceArea * self._virusHandConcentration
 
-        self._fieldChange["fomiteToHand"] += (fomiteToHand - handToFomite).asNumber()
-        room.updateFomite(-self._fieldChange["fomiteToHand"])
+        self._fieldChange["fomiteToHand"] += fomiteToHand - handToFomite
+        room.updateFomite(-(fomiteToHand - handToFomite))
 
     def _event_handle_touchFace(self):
         """
@@ -407,11 +624,12 @@ class Person(object):
         :return:
             None
         """
-        handToFace = self.factorHandToFace * self.handSurfaceArea * self.virusHandConcentration
-        faceToHand = self.factorHandToFace * self.handSurfaceArea * (self.autoincolationVolume * self.viralLoad / self.handSurfaceArea)
+        params = self._parameters
+        handToFace = params.factorHandToFace * params.handSurfaceArea * self._virusHandConcentration
+        faceToHand = params.factorHandToFace * params.handSurfaceArea * (params.autoincolationVolume * self._viralLoad / params.handSurfaceArea)
 
-        self._fieldChange["faceToHand"]   += (faceToHand - handToFace).asNumber()
-        self._fieldChange["exposeFromHand"] -= (self._fieldChange["faceToHand"]*self.handToMouth)
+        self._fieldChange["faceToHand"]   += faceToHand - handToFace
+        self._fieldChange["exposeFromHand"] -= ((faceToHand - handToFace)*params.handToMouth)
 
     def _event_handle_touchSurface(self):
         """
@@ -423,16 +641,15 @@ class Person(object):
             None
         """
         surfaceToHand = 0
+        params = self._parameters
 
-        for stain in self.location.shedList:
-            # stain area on furniture = stainArea * (area of furniture/total area)  (total is effective here).
-            # prob to touch stain on furniture = [stain area on furniture]/[area of furniture] = stainArea / total area
-            P     = (stain["stainArea"]/self.location.effectiveSurfaceArea).asNumber()
-            if self.random.uniform(0,1) < P:
-                surfaceToHand = (stain["viralLoadSurface"]*
-                                  self.factorSurfaceToHand*
-                                  self.handSurfaceArea/stain["stainArea"]).asNumber()
-                break # touch 1 stain at a time.
+        # stain area on furniture = stainArea * (area of furniture/total area)  (total is effective here).
+        # prob to touch stain on furniture = [stain area on furniture]/[area of furniture] = stainArea / total area
+        # touch 1 stain at a time.
+        stain = self.location.touchStain()
+        if stain is not None:
+            viralLoadSurface,stainArea = stain
+            surfaceToHand = viralLoadSurface*params.factorSurfaceToHand*params.handSurfaceArea/stainArea
 
         self._fieldChange["surfaceToHand"] += surfaceToHand
 
@@ -446,13 +663,13 @@ class Person(object):
         :return:
             None
         """
-        stainArea = self.settings["actions"]["cough"]["stainArea"]
+        stainArea = self._parameters.stainArea
 
-        viralExpolsionAir = (self.viralLoadFactor_cough*self.viralLoad * self.evaporatingDropletsVolume_cough).asNumber()
-        viralExpolsionSurface = (self.viralLoadFactor_cough*self.viralLoad * self.nonEvaporatingDropletsVolume_cough).asNumber()
+        viralExpolsionAir = self._parameters.viralLoadFactor_cough*self._viralLoad * self._evaporatingDropletsVolume_cough
+        viralExpolsionSurface = self._parameters.viralLoadFactor_cough*self._viralLoad * self._nonEvaporatingDropletsVolume_cough
 
         if viralExpolsionAir > 0:
-            self.location.updateAir(viralExpolsionAir)
+            self.location.updateAir(viralExpolsionAir,zone=self._zone)
 
         if viralExpolsionSurface > 0:
             self.location.updateStain(viralExpolsionSurface,stainArea)
@@ -469,14 +686,14 @@ class Person(object):
         :return:
             None
         """
-        stainArea = self.settings["actions"]["cough"]["stainArea"]
+        stainArea = self._parameters.stainArea
 
-        viralExpolsionAir = (self.viralLoadFactor_talk*self.viralLoad * self.evaporatingDropletsVolume_talk).asNumber()
-        viralExpolsionSurface = (self.viralLoadFactor_talk*self.viralLoad * self.nonEvaporatingDropletsVolume_talk).asNumber()
+        viralExpolsionAir = self._parameters.viralLoadFactor_talk*self._viralLoad * self._evaporatingDropletsVolume_talk
+        viralExpolsionSurface = self._parameters.viralLoadFactor_talk*self._viralLoad * self._nonEvaporatingDropletsVolume_talk
 
 
         if viralExpolsionAir > 0:
-            self.location.updateAir(viralExpolsionAir)
+            self.location.updateAir(viralExpolsionAir,zone=self._zone)
 
         if viralExpolsionSurface > 0:
             self.location.updateStain(viralExpolsionSurface,stainArea)
@@ -493,13 +710,13 @@ class Person(object):
         :return:
             None
         """
-        stainArea = self.settings["actions"]["cough"]["stainArea"]
+        stainArea = self._parameters.stainArea
 
-        viralExpolsionAir = (self.viralLoadFactor_sneeze*self.viralLoad * self._evaporatingDropletsVolume_sneeze).asNumber()
-        viralExpolsionSurface = (self.viralLoadFactor_sneeze*self.viralLoad * self._nonEvaporatingDropletsVolume_sneeze).asNumber()
+        viralExpolsionAir = self._parameters.viralLoadFactor_sneeze*self._viralLoad * self._evaporatingDropletsVolume_sneeze
+        viralExpolsionSurface = self._parameters.viralLoadFactor_sneeze*self._viralLoad * self._nonEvaporatingDropletsVolume_sneeze
 
         if viralExpolsionAir> 0:
-            self.location.updateAir(viralExpolsionAir)
+            self.location.updateAir(viralExpolsionAir,zone=self._zone)
 
         if viralExpolsionSurface >0:
             self.location.updateStain(viralExpolsionSurface,stainArea)
@@ -516,8 +733,9 @@ class Person(object):
 
         :return:
         """
-        self._fieldChange["wash_hands"] += -(self._virusHandConcentration*self.washingHandEfficiency*self.handSurfaceArea).asNumber()
-        self._virusHandConcentration *= (1 - self.washingHandEfficiency)
+        params = self._parameters
+        self._fieldChange["wash_hands"] += -self._virusHandConcentration*params.washingHandEfficiency*params.handSurfaceArea
+        self._virusHandConcentration *= (1 - params.washingHandEfficiency)
 
     def _event_handle_immuneSystem(self):
         """
@@ -531,54 +749,103 @@ class Person(object):
             None
         """
         if self.currentState == SUSCEPTIBLE:
-            doseresponse = self.settings["actions"]["immuneSystem"]["doseresponse"]
-            doseresponseFunc = getattr(self,"doseresponse_%s" % doseresponse["name"])
+            params = self._parameters
+            doseresponseFunc = getattr(self,"doseresponse_%s" % params.doseresponseName)
 
-            P = doseresponseFunc(exposure=self.currentExposure, **doseresponse["params"])
-            val = self.random.uniform(0,1)
+            P = doseresponseFunc(exposure=self.currentExposure, **params.doseresponseParams)
+            val = self.randomStream("doseresponse").uniform(0,1)
             #print("testing for sickness %s: %s %s" % (self.currentExposure,P,val))
-            if  val < P:
+            raoBlackwell = self.model.parameters.simulation.raoBlackwell
+            if raoBlackwell:
+                self._estimateInfection(P,val)
+
+            if  val < P and not raoBlackwell:
                 # Became infected.
-                self._incubationStartDatetime = self.model.getCurrentDatetime
-                self._currentState = EXPOSED
+                self._becomeExposed(self.model.currentTimeNs)
 
             else:
                 self._fieldChange["immuneSystem"] = -self.currentExposure
                 self._currentExposure = 0
 
+    def _estimateInfection(self,P,uniform):
+        """
+            Record an immune system check in the Rao-Blackwell estimate of the infection.
+
+            The person stays susceptible, so the run continues over the whole exposure path and
+            the probability to be infected in it is the complement of the product of (1-P) over the checks.
+            The sampled outcome is kept: the infection time is the first check whose uniform is below P
+            (this is the infection of the run without the estimate).
+
+        :param P: float
+                The probability to be infected in this check (given that the person was not infected before).
+        :param uniform: float
+                The uniform of the check.
+        """
+        currentTimeNs = self.model.currentTimeNs
+        if uniform < P and self._sampledInfectionNs is None:
+            self._sampledInfectionNs = currentTimeNs
+
+        if self._exposureTrace is not None:
+            self._exposureTrace.append((currentTimeNs,self._currentExposure,uniform))
+
+        self._weightedInfectionTime += numpy.exp(self._logSurvival)*P*currentTimeNs*1e-9
+        self._logSurvival += numpy.log1p(-P) if P < 1 else -numpy.inf
+
     def updateSocial(self,viralLoad):
         self._fieldChange["hand_interperson"] += viralLoad
 
-    def collect(self):
+    def _createHistory(self):
+        """
+            The history of the person.
 
+            A field change that was not set yet (an event that did not happen, for example) is NaN.
+        :return:
+            HistoryRecorder
+        """
+        eventColumns = []
+        for actionList in self._parameters.actions.values():
+            eventColumns += [action.fieldName for action in actionList if action.fieldName not in eventColumns]
 
-        ts = dict(name = self.unique_id,
-                  state = self.currentState,
-                  date = self.model.getCurrentDatetime,
-                  viralLoad = self.viralLoad,
-                  totalExposure =  self.totalExposed,
-                  currentExposure=self.currentExposure,
-                  handconcentration=self.virusHandConcentration,
-                  incubationStart = self.incubationStartDatetime
-                  )
+        self._fieldChangeColumns = FIELD_CHANGE_COLUMNS + eventColumns
 
-        if self.incubationStartDatetime is not None:
-            ts['symptomsAppear'] = self.incubationStartDatetime+self.incubationPeriod
-        else:
-            ts['symptomsAppear'] = pandas.NaT
+        columns = [("name",CONSTANT),
+                   ("state",CATEGORY),
+                   ("date",DATETIME),
+                   ("viralLoad",FLOAT),
+                   ("totalExposure",FLOAT),
+                   ("currentExposure",FLOAT),
+                   ("handconcentration",FLOAT),
+                   ("incubationStart",DATETIME),
+                   ("symptomsAppear",DATETIME)] + [(col,FLOAT) for col in self._fieldChangeColumns]
+
+        return self._newHistory(columns,
+                                units=self._historyUnits,
+                                categories=dict(state=list(PERSON_STATES)),
+                                constants=dict(name=self.unique_id))
 
-        for k,v in self._fieldChange.items():
-            ts[k] =v
+    def collect(self):
+        fieldChange = self._fieldChange
+        simulationStart = self.model.simulationStartNs
+
+        floats = [self._viralLoad,self._totalExposure,self._currentExposure,self._virusHandConcentration] + \
+                 [fieldChange.get(col,numpy.nan) for col in self._fieldChangeColumns]
+
+        if self._incubationStartNs is not None:
+            dates = (simulationStart + self.model.currentTimeNs,
+                     simulationStart + self._incubationStartNs,
+                     simulationStart + self.incubationEndNs)
+        else:
+            dates = (simulationStart + self.model.currentTimeNs,NAT,NAT)
 
-        self._history.append(ts)
+        self._history.record(floats,dates,(PERSON_STATE_CODES[self._currentState],))
 
-    def doseresponse_exp(self, exposure, k):
+    @staticmethod
+    def doseresponse_exp(exposure, k):
         """
             Return the probability to become sick following exposure to a viralLoad
 
             the function is 1-exp(-viralLoad/k)
 
-        :param self:
         :param viralLoad:
         :param kwargs:
                 - k : the dose response coefficient
@@ -610,13 +877,14 @@ class Person(object):
         talkDistributionName = self.settings["actions"]["talk"]["dropletModel"]
         evaporatingTalk,nonEvaporatingTalk=  getattr(self, "_Talk_%s" % talkDistributionName)()
 
-        self._evaporatingDropletsVolume_cough     = evaporatingCough
-        self._evaporatingDropletsVolume_sneeze    = evaporatingSneeze
-        self._evaporatingDropletsVolume_talk      = evaporatingTalk
+        # [m**3]
+        self._evaporatingDropletsVolume_cough     = evaporatingCough.asNumber(m**3)
+        self._evaporatingDropletsVolume_sneeze    = evaporatingSneeze.asNumber(m**3)
+        self._evaporatingDropletsVolume_talk      = evaporatingTalk.asNumber(m**3)
 
-        self._nonEvaporatingDropletsVolume_cough  = nonEvaporatingCough
-        self._nonEvaporatingDropletsVolume_sneeze = nonEvaporatingSneeze
-        self._nonEvaporatingDropletsVolume_talk = nonEvaporatingTalk
+        self._nonEvaporatingDropletsVolume_cough  = nonEvaporatingCough.asNumber(m**3)
+        self._nonEvaporatingDropletsVolume_sneeze = nonEvaporatingSneeze.asNumber(m**3)
+        self._nonEvaporatingDropletsVolume_talk = nonEvaporatingTalk.asNumber(m**3)
 
 
     ##
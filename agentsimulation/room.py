@@ -2,6 +2,173 @@ import numpy
 from unum.units import *
 import unum
 from  . import abstractAgent
+from .airflow import AirflowNetwork
+from .history import FLOAT,DATETIME,CONSTANT
+from .parameters import toSI
+
+class StainStore(object):
+    """
+        Holds the stains on the room surfaces in arrays.
+
+        - All the stains decay at the same rate, so the decay is held in a single multiplier.
+          The load of a stain is saved divided by the multiplier at the time it was shed.
+
+        - The stains are tested one after the other (in the order they were shed) and the first
+          stain that is touched is taken (at most one stain per touch). The probability to touch a stain
+          does not change after it was shed, so the cumulative hazard -sum(log(1-P)) of the first i
+          stains is saved. A touch draws one uniform number and finds the first stain whose
+          cumulative hazard exceeds it.
+
+        - Consecutive stains whose load is below the negligible load are merged to one stain
+          (with the same probability to touch any of them).
+    """
+
+    _load = None           # The load of the stain divided by the decay multiplier at the time it was shed.
+    _area = None           # [m**2]
+    _hazard = None         # The cumulative hazard of the first i stains.
+    _count = None
+    _decay = None          # The decay multiplier.
+    _mergeCount = None     # merge when the count reaches this size.
+
+    _effectiveSurfaceArea = None
+    _negligibleLoad = None
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def viralLoad(self):
+        """
+            The current viral load of the stains.
+        """
+        return self._load[:self._count]*self._decay
+
+    @property
+    def stainArea(self):
+        return self._area[:self._count]
+
+    def __init__(self,effectiveSurfaceArea,negligibleLoad=0):
+        """
+        :param effectiveSurfaceArea: float
+                The area of all the surfaces in the room [m**2]
+        :param negligibleLoad: float
+                The stains whose load is below that are merged.
+        """
+        self._effectiveSurfaceArea = effectiveSurfaceArea
+        self._negligibleLoad = negligibleLoad
+
+        self._load   = numpy.zeros(64)
+        self._area   = numpy.zeros(64)
+        self._hazard = numpy.zeros(64)
+        self._count  = 0
+        self._decay  = 1.
+        self._mergeCount = 64
+
+    def add(self,viralLoad,stainArea):
+        """
+            Add a stain, or several stains (in the order they were shed).
+
+        :param viralLoad: float or numpy.array
+                The number of viruses in each stain.
+        :param stainArea: float or numpy.array
+                [m**2]
+        """
+        viralLoad = numpy.atleast_1d(viralLoad)
+        stainArea = numpy.broadcast_to(stainArea,viralLoad.shape)
+        end = self._count + len(viralLoad)
+
+        if end > len(self._load):
+            size = len(self._load)
+            while size < end:
+                size *= 2
+            for name in ["_load","_area","_hazard"]:
+                current = getattr(self,name)
+                setattr(self,name,numpy.concatenate([current,numpy.zeros(size-len(current))]))
+
+        previousHazard = self._hazard[self._count-1] if self._count > 0 else 0.
+        hazard = -numpy.log1p(-numpy.minimum(stainArea/self._effectiveSurfaceArea,1.))
+
+        self._load[self._count:end]   = viralLoad/self._decay
+        self._area[self._count:end]   = stainArea
+        # the cumulative sum from the previous hazard adds the stains one after the other.
+        self._hazard[self._count:end] = numpy.cumsum(numpy.concatenate([[previousHazard],hazard]))[1:]
+        self._count = end
+
+        if self._count >= self._mergeCount:
+            self.mergeNegligible()
+            self._mergeCount = max(2*self._count,64)
+
+    def decay(self,factor):
+        """
+            Multiply the viral load of all the stains by factor.
+        """
+        self._decay *= factor
+        if self._decay < 1e-200:
+            self._load[:self._count] *= self._decay
+            self._decay = 1.
+
+    def touch(self,uniform):
+        """
+            Touch at most one stain.
+
+        :param uniform: float
+                uniform in [0,1).
+        :return:
+            (the viral load on the touched stain,stain area [m**2]) or None if no stain was touched.
+        """
+        hazard = -numpy.log1p(-uniform)
+        index = numpy.searchsorted(self._hazard[:self._count],hazard,side='right')
+        if index == self._count:
+            return None
+
+        return self._load[index]*self._decay,self._area[index]
+
+    def touchEach(self,uniform):
+        """
+            Each uniform number touches at most one stain (see touch).
+
+        :param uniform: numpy.array
+                uniform in [0,1).
+        :return:
+            (the viral load on the touched stains (0 if no stain was touched),stain area [m**2] (1 if no stain was touched))
+        """
+        hazard = -numpy.log1p(-uniform)
+        index = numpy.searchsorted(self._hazard[:self._count],hazard,side='right')
+        touched = index < self._count
+        index = numpy.minimum(index,max(self._count-1,0))
+
+        return numpy.where(touched,self._load[index]*self._decay,0.),numpy.where(touched,self._area[index],1.)
+
+    def mergeNegligible(self):
+        """
+            Merge every run of consecutive stains whose load is below the negligible load to its last stain.
+
+            The merged stain holds the total load and area of the run, and the cumulative hazard
+            of its last stain (so the probability to touch one of the stains of the run and the order are kept).
+        """
+        count = self._count
+        negligible = self._load[:count]*self._decay < self._negligibleLoad
+        if not negligible.any():
+            return
+
+        # the run id of every stain: a new run starts at every stain that is not negligible or after one.
+        newRun = numpy.ones(count,dtype=bool)
+        newRun[1:] = ~(negligible[1:] & negligible[:-1])
+        runId  = numpy.cumsum(newRun)-1
+        runEnd = numpy.flatnonzero(numpy.append(newRun[1:],True))
+
+        self._load[:len(runEnd)]   = numpy.bincount(runId,weights=self._load[:count])
+        self._area[:len(runEnd)]   = numpy.bincount(runId,weights=self._area[:count])
+        self._hazard[:len(runEnd)] = self._hazard[runEnd]
+        self._count = len(runEnd)
+
+    def asList(self):
+        """
+            The stains as a list of dicts (stainArea,viralLoadSurface).
+        """
+        return [dict(stainArea=area,viralLoadSurface=load) for area,load in zip(self.stainArea,self.viralLoad)]
+
 
 def getRoomClass(modelType):
 
@@ -25,14 +192,34 @@ class Room(object):
             - cleanFomite
             - social (inter person communication).
 
+        Air zones (room.air.zones):
+
+            The air is divided to zones that exchange air by the flows (room.air.flows)
+            and are ventilated at their own rate. The concentrations of the zones are advanced together
+            with the implicit step of airflow.AirflowNetwork, and each person breathes and
+            exhales in its zone. virusConcentrationAir is then the mean concentration of the room.
 
     """
     _virusConcentrationAir      = None  # c
-    _shedList                  = None  # A list of stains from coughing
+    _zoneConcentrationAir       = None  # c of each zone (None if the air is well mixed).
+    _zoneChangeAir              = None  # The viruses that were exhaled to each zone in the step.
+    _airflow                    = None  # airflow.AirflowNetwork of the zones.
+    _shedList                  = None  # The stains from coughing, talking and sneezing (StainStore)
     _fomiteConcentration        = None
 
     _personInRoom = None # a map name->person.
 
+    # The state is held in SI floats. These are the units of the history.
+    _historyUnits = dict(virusConcentrationAir=(1/m**3,1/m**3),
+                         fomiteConcentration=(1/cm**2,1/m**2),
+                         fomite_with_decay=(1/cm**2,1/m**2),
+                         air_with_decay=(1/m**3,1/m**3))
+
+    _eventColumns = ["change_air","change_fomite","clean_fomite"]
+    _summedColumns = _eventColumns + ["fomite_with_decay","air_with_decay"]
+
+    _sharedFields = abstractAgent.Agent._sharedFields + ("_personInRoom",)
+
     @property
     def dt(self):
         return self.model.dt
@@ -43,27 +230,70 @@ class Room(object):
 
     @property
     def virusFomiteConcentration(self):
+        """
+            [1/m**2]
+        """
         return self._fomiteConcentration
 
     @property
     def virusConcentrationAir(self):
+        """
+            [1/m**3]
+        """
         return self._virusConcentrationAir
 
+    @property
+    def airZones(self):
+        """
+            The names of the air zones (None if the air is well mixed).
+        """
+        return None if self._parameters.airZones is None else self._parameters.airZones.names
+
+    @property
+    def zoneConcentrationAir(self):
+        """
+            The concentration of each air zone [1/m**3] (None if the air is well mixed).
+        """
+        return self._zoneConcentrationAir
+
+    def airConcentration(self,zone=0):
+        """
+            The concentration that a person in the zone breathes [1/m**3].
+
+        :param zone: int
+                The index of the zone (see airZones).
+        :return:
+            float
+        """
+        if self._zoneConcentrationAir is None:
+            return self.virusConcentrationAir
+
+        return self._zoneConcentrationAir[zone]
+
     @property
     def effectiveSurfaceArea(self):
-        return self.settings["physical"]["surfaceArea"]*self.furnitureSurfaceAreaFactor
+        """
+            [m**2]
+        """
+        return self._parameters.effectiveSurfaceArea
 
     @property
     def furnitureSurfaceArea(self):
-        return self.settings["physical"]["surfaceArea"]*(self.furnitureSurfaceAreaFactor-1)
+        """
+            [m**2]
+        """
+        return self._parameters.surfaceArea*(self.furnitureSurfaceAreaFactor-1)
 
     @property
     def furnitureSurfaceAreaFactor(self):
-        return self.settings["physical"]["furnitureSurfaceAreaFactor"]
+        return self._parameters.furnitureSurfaceAreaFactor
 
     @property
     def roomVolume(self):
-        return self.settings["physical"]["surfaceArea"]*self.settings["physical"]["height"]
+        """
+            [m**3]
+        """
+        return self._parameters.roomVolume
 
     @property
     def personInteractionFrequency(self):
@@ -71,49 +301,111 @@ class Room(object):
 
     @property
     def decayRateAir(self):
-        return self.settings["air"]["decayRate"]+\
-               self.settings["air"]["exchangeRate"]
+        """
+            decay + exchange [1/s]
+        """
+        return self._parameters.decayRateAir
 
     @property
     def decayRateSurface(self):
-        return self.settings["surface"]["decayRate"]
+        """
+            [1/s]
+        """
+        return self._parameters.decayRateSurface
 
     @property
     def fomiteSurfaceArea(self):
-        return self.settings["fomite"]["surfaceArea"]
+        """
+            [m**2]
+        """
+        return self._parameters.fomiteSurfaceArea
 
     @property
     def decayRateFomite(self):
-        return self.settings["fomite"]["decayRate"]
+        """
+            [1/s]
+        """
+        return self._parameters.decayRateFomite
 
     @property
     def cleaningEfficiencyFomite(self):
-        return self.settings["actions"]["cleanFomite"]["efficiency"]
+        return self._parameters.cleaningEfficiencyFomite
 
     @property
     def shedList(self):
+        """
+            The stains as a list of dicts (stainArea [m**2], viralLoadSurface).
+        """
+        return self._shedList.asList()
+
+    @property
+    def stains(self):
         return self._shedList
 
     def __init__(self, unique_id, model):
         super().__init__(unique_id,model,agentType="room")
 
-        self._virusConcentrationAir      = 0/m**3
-        self._shedList = []
-        self._fomiteConcentration = 0/m**2
+        self._virusConcentrationAir      = 0.
+        self._shedList = StainStore(self._parameters.effectiveSurfaceArea,self._parameters.negligibleStainLoad)
+        self._fomiteConcentration = 0.
         self._personInRoom ={}
 
         self._fieldChange["airconcentration"] = 0.
         self._fieldChange["fomite"] = 0.
         self._fieldChange["clean_fomite"] = 0.
 
-    def enterRoom(self,person):
+        zones = self._parameters.airZones
+        if zones is not None:
+            self._airflow = AirflowNetwork(zones.volume,zones.flows,zones.decayRateVirus + numpy.array(zones.ventilation))
+            self._zoneConcentrationAir = numpy.zeros(self._airflow.compartments)
+            self._zoneChangeAir = numpy.zeros(self._airflow.compartments)
+
+    def enterRoom(self,person,zone=None):
         """
             Register person in a room.
         :param person:
+        :param zone: int
+                The air zone of the person. If None, the zone of the person in room.air.zones (default 0).
         :return:
         """
+        if zone is None:
+            zones = self._parameters.airZones
+            zone = 0 if zones is None else zones.occupants.get(person.unique_id,0)
+
         self._personInRoom[person.unique_id] = person
-        person.enterLocation(self)
+        person.enterLocation(self,zone=zone)
+
+    def setVentilation(self,ventilation=None,flows=None):
+        """
+            Change the ventilation of the air zones (for example, when a window is opened).
+
+            The implicit step is factorized again in the next step.
+
+        :param ventilation: dict
+                zone name -> the supply (and extraction) of clean air [1/time unum]. The other zones are not changed.
+        :param flows: dict
+                source zone -> {target zone -> flow [m**3/time unum]}. Replaces all the flows between the zones.
+        :return:
+            None
+        """
+        zones = self._parameters.airZones
+        if zones is None:
+            raise ValueError("The ventilation can be changed only in a room with air zones (room.air.zones)")
+
+        def zoneIndex(name):
+            if name not in zones.names:
+                raise ValueError(f"{name} is not a zone of room.air.zones")
+            return zones.names.index(name)
+
+        if ventilation is not None:
+            decayRate = numpy.array(self._airflow.decayRate)
+            for zone,rate in ventilation.items():
+                decayRate[zoneIndex(zone)] = zones.decayRateVirus + toSI(rate,1/s,f"ventilation.{zone}")
+            self._airflow.setDecayRate(decayRate)
+
+        if flows is not None:
+            self._airflow.setFlows([(zoneIndex(source),zoneIndex(target),toSI(flow,m**3/s,f"flows.{source}.{target}"))
+                                    for source,targets in flows.items() for target,flow in targets.items()])
 
     def leaveRoom(self,person):
         self._personInRoom[person.unique_id].leaveLocation()
@@ -122,8 +414,9 @@ class Room(object):
 
 
     def _event_handle_cleanFomite(self):
-        self._fieldChange['clean_fomite'] +=  -(self._fomiteConcentration*self.cleaningEfficiencyFomite*self.fomiteSurfaceArea).asNumber()
-        self._fomiteConcentration   *=   (1-self.cleaningEfficiencyFomite)
+        params = self._parameters
+        self._fieldChange['clean_fomite'] +=  -self._fomiteConcentration*params.cleaningEfficiencyFomite*params.fomiteSurfaceArea
+        self._fomiteConcentration   *=   (1-params.cleaningEfficiencyFomite)
 
     def _event_handle_social(self):
         """
@@ -134,18 +427,40 @@ class Room(object):
         person1 = self.model.primary
         person2 = self.model.secondary
 
-        person1Person2 = (person1.handSurfaceArea * person1.factorHandToFace * (
-                          person2.virusHandConcentration - person1.virusHandConcentration)).asNumber()
+        person1Person2 = person1.handSurfaceArea * person1.factorHandToFace * (
+                          person2.virusHandConcentration - person1.virusHandConcentration)
 
         person1.updateSocial( person1Person2)
         person2.updateSocial(-person1Person2)
 
 
-    def updateAir(self,viralLoad):
+    def updateAir(self,viralLoad,zone=0):
         self._fieldChange["airconcentration"] += viralLoad
+        if self._zoneChangeAir is not None:
+            self._zoneChangeAir[zone] += viralLoad
 
     def updateStain(self,viralLoad,stainArea):
-        self._shedList += [dict(stainArea=stainArea,viralLoadSurface=viralLoad,date=self.model.getCurrentDatetime)]
+        """
+            Add a stain.
+
+        :param viralLoad: float
+                The number of viruses in the stain.
+        :param stainArea: float
+                [m**2]
+        """
+        self._shedList.add(viralLoad,stainArea)
+
+    def touchStain(self):
+        """
+            Touch at most one stain.
+
+        :return:
+            (the viral load on the touched stain,stain area [m**2]) or None if no stain was touched.
+        """
+        if self._shedList.count == 0:
+            return None
+
+        return self._shedList.touch(self.randomStream("touchStain").uniform(0,1))
 
     def  updateFomite(self,viralLoad):
         self._fieldChange['fomite'] += viralLoad
@@ -161,30 +476,33 @@ class Room(object):
             Decay virus in the room.
 
             Use first order decay, solve implicitly.
-            remember that the decayRate is in 1/[dt] units.
+            All the rates are in [1/s] and dt is in [s].
 
         :return:
             None
         """
-        decayRateAir,_     = self.decayRateAir.matchUnits(1/self.dt)
+        params = self._parameters
+        dt = self.model.dt
 
-        airConcentrationChange = self._fieldChange["airconcentration"]/self.roomVolume
         air_before = self._virusConcentrationAir
-        self._virusConcentrationAir = (self._virusConcentrationAir + airConcentrationChange)/ \
-                                      (1 + (decayRateAir * self.dt).asNumber())
-
-        fomiteChange = self._fieldChange["fomite"]/self.fomiteSurfaceArea
+        if self._airflow is None:
+            airConcentrationChange = self._fieldChange["airconcentration"]/params.roomVolume
+            self._virusConcentrationAir = (self._virusConcentrationAir + airConcentrationChange)/ \
+                                          (1 + params.decayRateAir * dt)
+        else:
+            self._zoneConcentrationAir = self._airflow.step(self._zoneConcentrationAir,self._zoneChangeAir,dt)
+            self._zoneChangeAir[:] = 0.
+            volume = self._airflow.volume
+            self._virusConcentrationAir = numpy.dot(self._zoneConcentrationAir,volume)/numpy.sum(volume)
+
+        fomiteChange = self._fieldChange["fomite"]/params.fomiteSurfaceArea
 
         fomite_before = self._fomiteConcentration
-        decayRateFomite,_    = self.decayRateFomite.matchUnits(1/self.dt)
 
         self._fomiteConcentration = (self._fomiteConcentration + fomiteChange)/ \
-                                    (1 + (decayRateFomite * self.dt).asNumber())
+                                    (1 + params.decayRateFomite * dt)
 
-        decayRateSurface, _ = self.decayRateSurface.matchUnits(1 / self.dt)
-        for stain in self._shedList:
-            stain["viralLoadSurface"] = (stain["viralLoadSurface"])/ \
-                                    (1 + (decayRateSurface * self.dt).asNumber())
+        self.decayStains(1/(1 + params.decayRateSurface * dt))
 
         self._fieldChange["fomite_with_decay"] = self._fomiteConcentration - fomite_before
         self._fieldChange["air_with_decay"] = self._virusConcentrationAir- air_before
@@ -194,16 +512,73 @@ class Room(object):
         self._fieldChange["fomite"] = 0.
         self._fieldChange["clean_fomite"] = 0.
 
-    def collect(self):
+    def decayStains(self,factor):
+        """
+            Multiply the viral load of all the stains by factor.
+        :param factor: float
+        :return:
+            None
+        """
+        self._shedList.decay(factor)
+
+    def advance(self,dt):
+        """
+            Advance the room dt seconds without events, in closed form (exponential decay).
 
-        ts = dict(name = self.unique_id,
-                  date = self.model.getCurrentDatetime,
-                  virusConcentrationAir =  self.virusConcentrationAir,
-                  fomiteConcentration=self.virusFomiteConcentration,
-                  change_air =self._fieldChange["airconcentration"],
-                  change_fomite = self._fieldChange["fomite"],
-                  fomite_with_decay = self._fieldChange["fomite_with_decay"],
-                  air_with_decay    = self._fieldChange["air_with_decay"],
-                  clean_fomite      = self._fieldChange["clean_fomite"])
-
-        self._history.append(ts)
+            The changes of the events are added in the next step().
+
+        :param dt: float
+                [s]
+        :return:
+            None
+        """
+        params = self._parameters
+
+        self._virusConcentrationAir *= numpy.exp(-params.decayRateAir*dt)
+        self._fomiteConcentration   *= numpy.exp(-params.decayRateFomite*dt)
+        self.decayStains(numpy.exp(-params.decayRateSurface*dt))
+
+    def relativeChangeRate(self):
+        """
+            The largest relative rate of change [1/s] of the air, the fomite, the stains and
+            (by the social action) the hands of the persons in the room
+            (used to choose the leap of the TauLeaping method).
+        :return:
+            float
+        """
+        params = self._parameters
+        rates = dict([(action.name,action.frequency) for action in self.getActionList()])
+
+        fomite = params.decayRateFomite + rates["cleanFomite"]*params.cleaningEfficiencyFomite
+        hands = 0.
+        for person in self._personInRoom.values():
+            touchFomite = dict([(action.name,action.frequency) for action in person.getActionList()])["touchFomite"]
+            fomite += touchFomite*person.factorSurfaceToHand*person.handSurfaceArea/params.fomiteSurfaceArea
+            hands = numpy.maximum(hands,rates["social"]*person.factorHandToFace)
+
+        decayRateAir = params.decayRateAir if self._airflow is None else self._airflow.maxRate
+        return float(numpy.max([decayRateAir,params.decayRateSurface,fomite,hands]))
+
+    def _createHistory(self):
+        columns = [("name",CONSTANT),
+                   ("date",DATETIME),
+                   ("virusConcentrationAir",FLOAT),
+                   ("fomiteConcentration",FLOAT),
+                   ("change_air",FLOAT),
+                   ("change_fomite",FLOAT),
+                   ("fomite_with_decay",FLOAT),
+                   ("air_with_decay",FLOAT),
+                   ("clean_fomite",FLOAT)]
+
+        return self._newHistory(columns,units=self._historyUnits,constants=dict(name=self.unique_id))
+
+    def collect(self):
+        fieldChange = self._fieldChange
+        self._history.record((self._virusConcentrationAir,
+                              self._fomiteConcentration,
+                              fieldChange["airconcentration"],
+                              fieldChange["fomite"],
+                              fieldChange["fomite_with_decay"],
+                              fieldChange["air_with_decay"],
+                              fieldChange["clean_fomite"]),
+                             (self.model.simulationStartNs + self.model.currentTimeNs,))
@@ -0,0 +1,172 @@
+"""
+    A uniform grid index of the positions of the occupants of a room.
+
+    The floor is divided to square cells whose side is the largest radius of the queries,
+    so the occupants within the radius of an occupant are in its cell or in the 8 cells around it.
+    The occupants are sorted by their cell, and the occupants of a cell are found by a binary search.
+
+    Finding all the pairs within the radius costs O(N log N + the number of candidate pairs),
+    instead of the N**2 distances of all the pairs.
+
+    The neighbours are returned in compressed rows (CSR): the neighbours of occupant i are
+    neighbours[offset[i]:offset[i+1]].
+"""
+import numpy
+
+# The cells around a cell (and the cell itself).
+CELL_OFFSETS = [(dx,dy) for dx in (-1,0,1) for dy in (-1,0,1)]
+
+
+class SpatialGrid(object):
+    """
+        The cells of the occupants.
+    """
+
+    _cellSize = None    # [m]
+    _positions = None   # (N,2) [m]
+    _cells = None       # (N,2) the cell of each occupant.
+    _order = None       # The occupants sorted by their cell.
+    _sortedCell = None  # The cell id of the sorted occupants.
+    _columns = None     # The number of cells in a row (the cell id is x*columns + y).
+
+    @property
+    def cellSize(self):
+        """
+            [m]
+        """
+        return self._cellSize
+
+    @property
+    def positions(self):
+        """
+            [m]
+        """
+        return self._positions
+
+    def __init__(self,positions,cellSize):
+        """
+        :param positions: numpy.array
+                (N,2) the positions of the occupants [m].
+        :param cellSize: float
+                The side of a cell [m], the largest radius of the queries.
+        """
+        if cellSize <= 0:
+            raise ValueError(f"The cell size must be positive, got {cellSize}")
+
+        self._cellSize = float(cellSize)
+        self.update(positions)
+
+    def update(self,positions):
+        """
+            Index new positions of the occupants.
+
+        :param positions: numpy.array
+                (N,2) [m]
+        """
+        self._positions = numpy.array(positions,dtype=float).reshape(-1,2)
+
+        cells = numpy.floor((self._positions - self._positions.min(axis=0,initial=0.))/self._cellSize).astype(numpy.int64)
+        self._columns = int(cells[:,1].max(initial=0)) + 3      # a margin for the cells around the last column.
+        self._cells = cells
+
+        cellId = self._cellId(cells[:,0],cells[:,1])
+        self._order = numpy.argsort(cellId,kind="stable")
+        self._sortedCell = cellId[self._order]
+
+    def _cellId(self,x,y):
+        return x*self._columns + y
+
+    def pairsWithin(self,radius):
+        """
+            All the pairs of occupants whose distance is at most radius.
+
+        :param radius: float
+                [m], at most the cell size.
+        :return:
+            (first,second,distance [m]) numpy.arrays, each pair once (first < second).
+        """
+        if radius > self._cellSize:
+            raise ValueError(f"The radius ({radius}) must be at most the cell size ({self._cellSize})")
+
+        first = []
+        second = []
+        for dx,dy in CELL_OFFSETS:
+            cellId = self._cellId(self._cells[:,0]+dx,self._cells[:,1]+dy)
+            start = numpy.searchsorted(self._sortedCell,cellId,side="left")
+            end   = numpy.searchsorted(self._sortedCell,cellId,side="right")
+            counts = end - start
+
+            # expand each occupant to the occupants of the cell (the ranges start..end of the sorted occupants).
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            source = numpy.repeat(numpy.arange(len(counts)),counts)
+            rangeStart = numpy.repeat(start - numpy.cumsum(counts) + counts,counts)
+            target = self._order[rangeStart + numpy.arange(total)]
+
+            candidate = source < target
+            first.append(source[candidate])
+            second.append(target[candidate])
+
+        if len(first) == 0:
+            return numpy.zeros(0,dtype=int),numpy.zeros(0,dtype=int),numpy.zeros(0)
+
+        first = numpy.concatenate(first)
+        second = numpy.concatenate(second)
+        distance = numpy.hypot(*(self._positions[first] - self._positions[second]).T)
+        within = distance <= radius
+
+        return first[within],second[within],distance[within]
+
+    def neighbours(self,radius):
+        """
+            The neighbours of each occupant within the radius.
+
+        :param radius: float
+                [m], at most the cell size.
+        :return:
+            (offset,neighbours) numpy.arrays. The neighbours of occupant i are neighbours[offset[i]:offset[i+1]].
+        """
+        first,second,distance = self.pairsWithin(radius)
+        return toNeighbourRows(first,second,len(self._positions))
+
+
+def toNeighbourRows(first,second,occupants):
+    """
+        The compressed rows of the symmetric pairs.
+
+    :param first: numpy.array
+    :param second: numpy.array
+            The pairs (each pair once).
+    :param occupants: int
+    :return:
+        (offset,neighbours) numpy.arrays.
+    """
+    source = numpy.concatenate([first,second])
+    target = numpy.concatenate([second,first])
+    order = numpy.argsort(source,kind="stable")
+
+    offset = numpy.zeros(occupants+1,dtype=int)
+    offset[1:] = numpy.cumsum(numpy.bincount(source,minlength=occupants))
+    return offset,target[order]
+
+
+def expandRows(offset,neighbours,idx):
+    """
+        The neighbours of the occupants in idx, as pairs.
+
+    :param offset: numpy.array
+    :param neighbours: numpy.array
+            The compressed rows (see SpatialGrid.neighbours).
+    :param idx: numpy.array
+            The occupants.
+    :return:
+        (occupant,neighbour) numpy.arrays, a pair for each neighbour of each occupant in idx.
+    """
+    start = offset[idx]
+    counts = offset[idx+1] - start
+    total = int(counts.sum())
+
+    occupant = numpy.repeat(idx,counts)
+    rangeStart = numpy.repeat(start - numpy.cumsum(counts) + counts,counts)
+    return occupant,neighbours[rangeStart + numpy.arange(total)]
@@ -0,0 +1,217 @@
+"""
+    The stores of the run documents (the metadata of the runs).
+
+    - DatalayerDocumentStore : the hera datalayer (mongo).
+    - FileDocumentStore      : a local JSON-lines file, to run (and test) sweeps without a database.
+
+    A document is dict(resource=...,dataFormat=...,type=...,desc=...).
+    The documents are added in bulk (addDocuments). DocumentBuffer holds the documents
+    of a worker and adds them when it is full.
+"""
+import fcntl
+import json
+import math
+import os
+
+import numpy
+
+PARQUET = "parquet"
+
+
+def _jsonValue(obj):
+    """
+        Replace nan by None (null), also in the nested dicts and lists.
+    """
+    if isinstance(obj, dict):
+        return dict([(key, _jsonValue(value)) for key, value in obj.items()])
+    if isinstance(obj, (list, tuple)):
+        return [_jsonValue(value) for value in obj]
+    if isinstance(obj, numpy.generic):
+        obj = obj.item()
+    if isinstance(obj, float) and math.isnan(obj):
+        return None
+    return obj
+
+
+def toJSON(obj):
+    """
+        The JSON of a document (or of the documents of a run).
+
+        numpy scalars are converted to python, nan is saved as null and other values that are not JSON
+        are saved as strings. Infinite values are refused (ValueError), since they are not valid JSON.
+
+    :param obj: dict or list
+    :return:
+        str
+    """
+    return json.dumps(_jsonValue(obj), allow_nan=False, default=str)
+
+
+class DatalayerDocumentStore(object):
+    """
+        The documents of a project in the hera datalayer.
+    """
+
+    _projectName = None
+    _datalayer = None
+
+    def __init__(self, projectName):
+        from hera import datalayer
+
+        self._projectName = projectName
+        self._datalayer = datalayer
+
+    def countRuns(self, jsonObj):
+        """
+            The number of runs of the configuration.
+        """
+        return len(self.getDocuments(data="agents", params=jsonObj))
+
+    def getDocuments(self, **desc):
+        """
+            Return the documents of the project whose desc has the values in desc.
+
+        :return:
+            list of dict.
+        """
+        query = dict(desc)
+        params = query.pop("params", None)
+        if params is not None:
+            query.update(self._datalayer.dictToMongoQuery(params, prefix="params"))
+
+        return [dict(resource=doc.resource, dataFormat=doc.dataFormat, type=doc.type, desc=doc.desc)
+                for doc in self._datalayer.Simulations.getDocuments(projectName=self._projectName, **query)]
+
+    def addDocuments(self, documents):
+        """
+            Insert the documents.
+
+            Uses one insert of the metadata collection when the datalayer exposes it,
+            and addDocument for each document otherwise.
+        """
+        if len(documents) == 0:
+            return
+
+        # the datalayer saves nan as a number, save it as null (as in the catalog).
+        documents = json.loads(toJSON(documents))
+        collection = self._datalayer.Simulations
+        metadataCol = getattr(collection, "_metadataCol", None)
+        if metadataCol is None:
+            for doc in documents:
+                collection.addDocument(projectName=self._projectName, **doc)
+        else:
+            metadataCol.objects.insert([metadataCol(projectName=self._projectName, **doc) for doc in documents],
+                                       load_bulk=False)
+
+
+class FileDocumentStore(object):
+    """
+        The documents of a project in a JSON-lines file.
+
+        The file is locked while writing, so several workers can add documents.
+    """
+
+    _path = None
+    _projectName = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def __init__(self, path, projectName):
+        self._path = path
+        self._projectName = projectName
+
+    def addDocuments(self, documents):
+        if len(documents) == 0:
+            return
+
+        lines = "".join([toJSON(dict(projectName=self._projectName, **doc)) + "\n" for doc in documents])
+        with open(self._path, "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                file.write(lines)
+                file.flush()
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def getDocuments(self, **desc):
+        """
+            Return the documents of the project whose desc has the values in desc.
+
+        :return:
+            list of dict.
+        """
+        if not os.path.exists(self._path):
+            return []
+
+        desc = json.loads(toJSON(desc))
+        ret = []
+        with open(self._path) as file:
+            for line in file:
+                doc = json.loads(line)
+                if doc["projectName"] == self._projectName and \
+                        all([doc["desc"].get(key) == value for key, value in desc.items()]):
+                    ret.append(doc)
+        return ret
+
+    def countRuns(self, jsonObj):
+        """
+            The number of runs of the configuration.
+        """
+        return len(self.getDocuments(data="agents", params=jsonObj))
+
+
+class DocumentBuffer(object):
+    """
+        Holds the documents of the runs and adds them to the store in bulk.
+    """
+
+    _store = None
+    _size = None
+    _onFlush = None
+    _runs = None       # list of (key, documents)
+    _documents = None  # the number of documents in the buffer.
+
+    def __init__(self, store, size=100, onFlush=None):
+        """
+        :param store:
+                The document store.
+        :param size: int
+                The number of documents that triggers flush().
+        :param onFlush: callable
+                Called with the keys of the runs after they were added to the store.
+        """
+        self._store = store
+        self._size = size
+        self._onFlush = onFlush
+        self._runs = []
+        self._documents = 0
+
+    def __len__(self):
+        return self._documents
+
+    def add(self, key, documents):
+        """
+            Add the documents of a run.
+
+        :param key:
+                The key of the run (passed to onFlush).
+        :param documents: list
+        """
+        self._runs.append((key, documents))
+        self._documents += len(documents)
+        if self._documents >= self._size:
+            self.flush()
+
+    def flush(self):
+        if len(self._runs) == 0:
+            return
+
+        runs = self._runs
+        self._runs = []
+        self._documents = 0
+
+        self._store.addDocuments([doc for key, documents in runs for doc in documents])
+        if self._onFlush is not None:
+            self._onFlush([key for key, documents in runs])
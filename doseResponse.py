@@ -0,0 +1,96 @@
+"""
+    Re-evaluation of the infection of the secondary for other dose responses, from the exposure traces.
+
+    With simulation.exposureTrace, a run records the exposure of the secondary at each immune system check
+    and the uniform that was drawn (the secondary stays susceptible, see Person._estimateInfection).
+    The exposure does not depend on the dose response, so the outcome of the run for any dose response is:
+
+        - secondarySick        : a uniform of a check is below the probability of the check.
+        - infectionTime        : the time of the first such check [s from the simulation start].
+        - infectionProbability : 1 - prod(1-P) over the checks (the Rao-Blackwell estimate).
+
+    A sweep over the dose response parameters is then N simulations and a vectorized pass over the traces.
+"""
+import numpy
+import pandas
+
+from agentsimulation.person import Person
+
+
+def reevaluate(trace, doseResponses, runids=None):
+    """
+        The outcomes of the runs of the trace for each dose response.
+
+    :param trace: pandas.DataFrame
+            The columns runid, time [s], exposure, uniform (the exposureTrace table, see resultStore.readResults).
+            The checks of a run are in the order of their time.
+    :param doseResponses: list
+            list of dict(name=...,params=...), as person.actions.immuneSystem.doseresponse
+            (for example, dict(name="exp",params=dict(k=410))). The parameters are numbers (in SI units).
+    :param runids: list
+            All the runs. A run that ended before the first check is not in the trace (it is not infected).
+            If None, use the runs in the trace.
+    :return:
+        pandas.DataFrame with the columns runid, doseResponse (the index in doseResponses), the parameters,
+        secondarySick, infectionTime [s] (nan if not infected) and infectionProbability.
+    """
+    trace = trace.sort_values("runid", kind="stable")
+    runid = trace["runid"].values
+    exposure = trace["exposure"].values
+    uniform = trace["uniform"].values
+    time = trace["time"].values
+
+    runs, starts = numpy.unique(runid, return_index=True)
+    rowIndex = numpy.arange(len(runid))
+
+    allRuns = runs if runids is None else numpy.union1d(runs, runids)
+    position = numpy.searchsorted(allRuns, runs)
+
+    ret = []
+    for i, doseResponse in enumerate(doseResponses):
+        doseresponseFunc = getattr(Person, f"doseresponse_{doseResponse['name']}")
+        P = doseresponseFunc(exposure=exposure, **doseResponse["params"])
+
+        if len(runs) > 0:
+            # the first check of each run whose uniform is below the probability (len(runid) if none).
+            firstInfection = numpy.minimum.reduceat(numpy.where(uniform < P, rowIndex, len(runid)), starts)
+            logSurvival = numpy.add.reduceat(numpy.log1p(-numpy.minimum(P, 1)), starts)
+        else:
+            firstInfection = logSurvival = numpy.array([])
+
+        infected = numpy.zeros(len(allRuns), dtype=bool)
+        infected[position] = firstInfection < len(runid)
+
+        infectionTime = numpy.full(len(allRuns), numpy.nan)
+        infectionTime[infected] = time[firstInfection[infected[position]]]
+
+        infectionProbability = numpy.zeros(len(allRuns))
+        infectionProbability[position] = -numpy.expm1(logSurvival)
+
+        results = pandas.DataFrame(dict(runid=allRuns,
+                                        doseResponse=i,
+                                        secondarySick=infected,
+                                        infectionTime=infectionTime,
+                                        infectionProbability=infectionProbability))
+        ret.append(results.assign(**doseResponse["params"]))
+
+    return pandas.concat(ret, ignore_index=True)
+
+
+def attackRates(results):
+    """
+        The secondary attack rate of each dose response.
+
+    :param results: pandas.DataFrame
+            The result of reevaluate.
+    :return:
+        pandas.DataFrame indexed by doseResponse with the runs, the sampled attack rate (secondarySick),
+        the Rao-Blackwell attack rate (infectionProbability) and their standard errors.
+    """
+    grouped = results.groupby("doseResponse")
+    ret = pandas.DataFrame(dict(runs=grouped.size(),
+                                secondarySick=grouped["secondarySick"].mean(),
+                                secondarySickStderr=grouped["secondarySick"].sem(),
+                                infectionProbability=grouped["infectionProbability"].mean(),
+                                infectionProbabilityStderr=grouped["infectionProbability"].sem()))
+    return ret
@@ -0,0 +1,78 @@
+"""
+    Paired comparison of the runs of two configurations.
+
+    With simulation.commonRandomNumbers, the runs of two configurations with the same seed (the replicate)
+    draw the same random numbers (see Model.randomStream). The difference of a result between the paired
+    runs has a smaller variance than the difference between independent runs, so fewer runs are needed
+    to resolve it.
+"""
+import numpy
+import pandas
+
+Z95 = 1.959963984540054  # The 97.5% quantile of the normal distribution.
+
+
+def descValue(desc, field):
+    """
+        The value of a field of the desc of a run. Nested fields are separated by dots
+        (for example, secondaryExposure.totalExposure).
+    """
+    value = desc
+    for key in field.split("."):
+        value = value[key]
+    return numpy.nan if value is None else float(value)
+
+
+def pairedDifferences(documentsA, documentsB, fields=("secondarySick",), key="seed"):
+    """
+        The differences (B - A) of the fields over the runs of the two configurations with the same key.
+
+    :param documentsA: list
+            The documents of the runs of the first configuration (dict with desc).
+    :param documentsB: list
+            The documents of the runs of the second configuration.
+    :param fields: list
+            The fields of the desc to compare (bool fields are compared as 0/1).
+    :param key: str
+            The field of the desc that pairs the runs.
+    :return:
+        pandas.DataFrame with a row for each field:
+            pairs          : the number of paired runs.
+            meanA, meanB   : the means of the paired runs.
+            difference     : the mean of the differences.
+            stderr         : the standard error of the difference.
+            ciLow, ciHigh  : the 95% confidence interval of the difference.
+            unpairedStderr : the standard error if the runs were independent.
+            runsFactor     : (unpairedStderr/stderr)**2, the factor of the runs that pairing saves.
+    """
+    descA = dict([(doc["desc"][key], doc["desc"]) for doc in documentsA if doc["desc"].get(key) is not None])
+    descB = dict([(doc["desc"][key], doc["desc"]) for doc in documentsB if doc["desc"].get(key) is not None])
+    keys = sorted(set(descA) & set(descB))
+
+    ret = []
+    for field in fields:
+        valuesA = numpy.array([descValue(descA[x], field) for x in keys])
+        valuesB = numpy.array([descValue(descB[x], field) for x in keys])
+        valid = ~(numpy.isnan(valuesA) | numpy.isnan(valuesB))
+        valuesA, valuesB = valuesA[valid], valuesB[valid]
+
+        pairs = len(valuesA)
+        difference = valuesB - valuesA
+        if pairs > 1:
+            stderr = difference.std(ddof=1) / numpy.sqrt(pairs)
+            unpairedStderr = numpy.sqrt((valuesA.var(ddof=1) + valuesB.var(ddof=1)) / pairs)
+        else:
+            stderr = unpairedStderr = numpy.nan
+
+        ret.append(dict(field=field,
+                        pairs=pairs,
+                        meanA=valuesA.mean() if pairs > 0 else numpy.nan,
+                        meanB=valuesB.mean() if pairs > 0 else numpy.nan,
+                        difference=difference.mean() if pairs > 0 else numpy.nan,
+                        stderr=stderr,
+                        ciLow=difference.mean() - Z95 * stderr if pairs > 0 else numpy.nan,
+                        ciHigh=difference.mean() + Z95 * stderr if pairs > 0 else numpy.nan,
+                        unpairedStderr=unpairedStderr,
+                        runsFactor=(unpairedStderr / stderr) ** 2 if stderr > 0 else numpy.nan))
+
+    return pandas.DataFrame(ret).set_index("field")
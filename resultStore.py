@@ -0,0 +1,127 @@
+"""
+    A columnar store of the histories of the runs.
+
+    The runs of a configuration are saved in one parquet dataset for each table (agents, room):
+
+        <path>/<table>/worker=<worker>/part-<uuid>.parquet
+
+    Each worker appends its runs as row groups to its own file, so the workers do not
+    write to the same file. The rows are keyed by the runid column.
+
+    The files are compressed with zstd, the state, name and agent columns are
+    dictionary encoded and the timestamps are int64 [ns].
+"""
+import os
+import uuid
+from pathlib import Path
+
+import pyarrow
+import pyarrow.parquet as pq
+
+DICTIONARY_COLUMNS = ["state", "name", "agent"]
+
+
+class ResultWriter(object):
+    """
+        Appends the histories of the runs of a worker to the datasets of a configuration.
+
+        A file is closed (and a new one is opened) after runsPerFile runs, and in close().
+        Only closed files can be read.
+    """
+
+    _path = None
+    _worker = None
+    _compression = None
+    _runsPerFile = None
+
+    _writers = None  # table -> pq.ParquetWriter
+    _runs = None     # table -> the number of runs in the open file.
+
+    @property
+    def path(self):
+        return self._path
+
+    def __init__(self, path, worker=None, compression="zstd", runsPerFile=200):
+        """
+        :param path: str
+                The directory of the datasets of the configuration.
+        :param worker: str
+                The name of the worker partition. If None, use the host and the process id.
+        :param compression: str
+                The parquet codec (zstd, lz4, snappy...).
+        :param runsPerFile: int
+                The number of runs in a file.
+        """
+        self._path = os.path.abspath(path)
+        self._worker = f"{os.uname().nodename}-{os.getpid()}" if worker is None else worker
+        self._compression = compression
+        self._runsPerFile = runsPerFile
+        self._writers = {}
+        self._runs = {}
+
+    def tablePath(self, table):
+        """
+            The directory of the dataset of the table.
+        """
+        return os.path.join(self._path, table)
+
+    def write(self, table, runid, data):
+        """
+            Append the history of a run to the table.
+
+        :param table: str
+                The name of the table (agents or room).
+        :param runid: int
+                The run id. Added as the runid column.
+        :param data: pandas.DataFrame
+                The history (unitless).
+        :return:
+            The directory of the dataset.
+        """
+        arrowTable = pyarrow.Table.from_pandas(data.assign(runid=runid), preserve_index=False)
+
+        if table not in self._writers:
+            partition = os.path.join(self.tablePath(table), f"worker={self._worker}")
+            Path(partition).mkdir(parents=True, exist_ok=True)
+            fileName = os.path.join(partition, f"part-{uuid.uuid4().hex}.parquet")
+            self._writers[table] = pq.ParquetWriter(fileName,
+                                                    arrowTable.schema,
+                                                    compression=self._compression,
+                                                    use_dictionary=[x for x in DICTIONARY_COLUMNS if x in data],
+                                                    version="2.6")
+            self._runs[table] = 0
+
+        writer = self._writers[table]
+        writer.write_table(arrowTable.cast(writer.schema))
+        self._runs[table] += 1
+
+        if self._runs[table] >= self._runsPerFile:
+            writer.close()
+            del self._writers[table]
+
+        return self.tablePath(table)
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+
+def readResults(path, table, runid=None):
+    """
+        Read a table of the runs of a configuration.
+
+    :param path: str
+            The directory of the datasets of the configuration.
+    :param table: str
+            The name of the table (agents or room).
+    :param runid: int or list
+            Read only these runs. If None, read all the runs.
+    :return:
+        pandas.DataFrame
+    """
+    filters = None
+    if runid is not None:
+        filters = [("runid", "in", list(runid) if isinstance(runid, (list, tuple)) else [runid])]
+
+    return pq.read_table(os.path.join(path, table), filters=filters).to_pandas()
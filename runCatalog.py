@@ -0,0 +1,327 @@
+"""
+    A local catalog of the runs of each configuration.
+
+    The catalog is an SQLite file that is shared by the workers of a sweep.
+    A configuration is identified by the hash of its canonical JSON (see configurationHash).
+
+    - reserve() claims run slots atomically, so the workers do not need to query
+      the datalayer to know how many runs were done.
+    - complete() saves the documents of a run (and adds its results to the running estimates).
+    - sync() pushes the documents that were not pushed to the datalayer (by the workers), in bulk.
+
+    The catalog keeps running estimates (the mean and its confidence interval) of results of the runs
+    (for example, secondarySick and serialIndex). reserve() stops a configuration once the half-widths
+    of its confidence intervals are below the requested precision.
+"""
+import hashlib
+import json
+import math
+import sqlite3
+
+from documentStore import toJSON
+
+RESERVED  = "reserved"
+COMPLETED = "completed"
+FAILED    = "failed"
+
+Z95 = 1.959963984540054  # The 97.5% quantile of the normal distribution.
+
+
+def configurationHash(jsonObj):
+    """
+        The hash of the canonical JSON of the configuration.
+
+    :param jsonObj: dict
+            The merged configuration.
+    :return:
+        str
+    """
+    canonical = json.dumps(jsonObj, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def estimate(count, total, totalSquares, z=Z95):
+    """
+        The mean and the half-width of its confidence interval from the running sums.
+
+        If all the values are 0 or 1 (total == totalSquares), use the Wilson interval of a proportion,
+        which does not collapse to zero width when the proportion is 0 or 1.
+        Otherwise, use the normal interval of the mean.
+
+    :param count: int
+            The number of values.
+    :param total: float
+            The sum of the values.
+    :param totalSquares: float
+            The sum of the squares of the values.
+    :param z: float
+            The quantile of the confidence level.
+    :return:
+        (mean, half-width). The half-width is inf if there are less than 2 values.
+    """
+    if count < 2:
+        return (total / count if count > 0 else math.nan), math.inf
+
+    mean = total / count
+    if total == totalSquares:
+        center = (mean + z**2 / (2 * count)) / (1 + z**2 / count)
+        halfWidth = z * math.sqrt(mean * (1 - mean) / count + z**2 / (4 * count**2)) / (1 + z**2 / count)
+        # report the half-width around the mean (the interval is not symmetric).
+        return mean, halfWidth + abs(center - mean)
+
+    variance = max(totalSquares - count * mean**2, 0) / (count - 1)
+    return mean, z * math.sqrt(variance / count)
+
+
+class RunCatalog(object):
+    """
+        The run slots and the documents of the runs of each configuration.
+
+        Slots are numbered from the number of runs that existed when the configuration was added.
+        A failed run releases its slot (it is not counted in maxRuns), a run of a worker that was killed
+        remains reserved.
+    """
+
+    _path = None
+    _connection = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def __init__(self, path, timeout=60):
+        """
+            Opens (and creates) the catalog.
+
+        :param path: str
+                The SQLite file.
+        :param timeout: float
+                [s] the time to wait for a lock of another worker.
+        """
+        self._path = path
+        self._connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS configurations (
+                                        hash     TEXT PRIMARY KEY,
+                                        name     TEXT,
+                                        params   TEXT,
+                                        nextSlot INTEGER,
+                                        active   INTEGER)""")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS runs (
+                                        hash      TEXT,
+                                        slot      INTEGER,
+                                        status    TEXT,
+                                        documents TEXT,
+                                        synced    INTEGER DEFAULT 0,
+                                        PRIMARY KEY (hash, slot))""")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS estimates (
+                                        hash         TEXT,
+                                        field        TEXT,
+                                        count        INTEGER,
+                                        total        REAL,
+                                        totalSquares REAL,
+                                        PRIMARY KEY (hash, field))""")
+
+    def _transaction(self):
+        self._connection.execute("BEGIN IMMEDIATE")
+
+    def hasConfiguration(self, jsonObj):
+        return self._connection.execute("SELECT 1 FROM configurations WHERE hash=?",
+                                        (configurationHash(jsonObj),)).fetchone() is not None
+
+    def addConfiguration(self, jsonObj, name=None, existingRuns=0):
+        """
+            Add a configuration (if it is not in the catalog).
+
+        :param jsonObj: dict
+                The merged configuration.
+        :param name: str
+                The name of the configuration.
+        :param existingRuns: int
+                The number of runs of the configuration that were done before the catalog.
+        :return:
+            The hash of the configuration.
+        """
+        key = configurationHash(jsonObj)
+        self._connection.execute("INSERT OR IGNORE INTO configurations VALUES (?,?,?,?,?)",
+                                 (key, name, toJSON(jsonObj), existingRuns, existingRuns))
+        return key
+
+    def reserve(self, jsonObj, maxRuns, count=1, precision=None, minRuns=0):
+        """
+            Claim run slots of the configuration (atomically).
+
+            The configuration must be in the catalog (see addConfiguration).
+
+        :param jsonObj: dict
+                The merged configuration.
+        :param maxRuns: int
+                The number of runs of the configuration.
+        :param count: int
+                The number of slots to claim.
+        :param precision: dict
+                field -> the half-width of the confidence interval of its mean (see converged).
+                If None, run maxRuns runs.
+        :param minRuns: int
+                The number of completed runs before the precision is checked.
+        :return:
+            list of slots (less than count, or empty, if maxRuns is reached or the estimates converged).
+        """
+        key = configurationHash(jsonObj)
+        self._transaction()
+        try:
+            row = self._connection.execute("SELECT nextSlot,active FROM configurations WHERE hash=?", (key,)).fetchone()
+            if row is None:
+                raise ValueError(f"Configuration {key} is not in the catalog {self._path}")
+
+            nextSlot, active = row
+            if precision is not None and self._converged(key, precision, minRuns):
+                count = 0
+
+            count = max(0, int(min(count, maxRuns - active)))
+            slots = list(range(nextSlot, nextSlot + count))
+
+            self._connection.execute("UPDATE configurations SET nextSlot=?,active=? WHERE hash=?",
+                                     (nextSlot + count, active + count, key))
+            self._connection.executemany("INSERT INTO runs (hash,slot,status) VALUES (?,?,?)",
+                                         [(key, slot, RESERVED) for slot in slots])
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+        return slots
+
+    def complete(self, jsonObj, slot, documents, values={}):
+        """
+            Save the documents of a run.
+
+        :param jsonObj: dict
+                The merged configuration.
+        :param slot: int
+                The slot of the run.
+        :param documents: list
+                list of dict(resource=...,dataFormat=...,type=...,desc=...).
+        :param values: dict
+                field -> the result of the run that is added to the estimates (None or nan are skipped).
+        """
+        key = configurationHash(jsonObj)
+        values = [(field, float(value)) for field, value in values.items() if value is not None and not math.isnan(float(value))]
+
+        self._transaction()
+        try:
+            self._connection.execute("UPDATE runs SET status=?,documents=? WHERE hash=? AND slot=?",
+                                     (COMPLETED, toJSON(documents), key, slot))
+            self._connection.executemany("""INSERT INTO estimates VALUES (?,?,1,?,?)
+                                            ON CONFLICT (hash,field) DO UPDATE SET count=count+1,
+                                                                                   total=total+excluded.total,
+                                                                                   totalSquares=totalSquares+excluded.totalSquares""",
+                                         [(key, field, value, value**2) for field, value in values])
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def estimates(self, jsonObj):
+        """
+            The running estimates of the configuration.
+
+        :return:
+            dict field -> dict(count=...,mean=...,halfWidth=...)
+        """
+        return self._estimates(configurationHash(jsonObj))
+
+    def _estimates(self, key):
+        ret = {}
+        for field, count, total, totalSquares in self._connection.execute(
+                "SELECT field,count,total,totalSquares FROM estimates WHERE hash=?", (key,)):
+            mean, halfWidth = estimate(count, total, totalSquares)
+            ret[field] = dict(count=count, mean=mean, halfWidth=halfWidth)
+        return ret
+
+    def converged(self, jsonObj, precision, minRuns=0):
+        """
+            True if the configuration has minRuns completed runs and the half-width of the confidence
+            interval of each field is below its precision.
+
+            A field that has no values (serialIndex when the secondary is never sick, for example)
+            does not prevent the convergence.
+
+        :param jsonObj: dict
+                The merged configuration.
+        :param precision: dict
+                field -> the half-width (in the units of the field).
+        :param minRuns: int
+        :return:
+            bool
+        """
+        return self._converged(configurationHash(jsonObj), precision, minRuns)
+
+    def _converged(self, key, precision, minRuns):
+        completed = self._connection.execute("SELECT COUNT(*) FROM runs WHERE hash=? AND status=?",
+                                             (key, COMPLETED)).fetchone()[0]
+        if completed < max(minRuns, 1):
+            return False
+
+        estimates = self._estimates(key)
+        return all([estimates[field]["halfWidth"] <= value for field, value in precision.items() if field in estimates])
+
+    def release(self, jsonObj, slot):
+        """
+            Release the slot of a failed run.
+        """
+        key = configurationHash(jsonObj)
+        self._transaction()
+        try:
+            self._connection.execute("UPDATE runs SET status=? WHERE hash=? AND slot=?", (FAILED, key, slot))
+            self._connection.execute("UPDATE configurations SET active=active-1 WHERE hash=?", (key,))
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def runs(self, jsonObj, status=COMPLETED):
+        """
+            The number of runs of the configuration with the status (not including the runs before the catalog).
+        """
+        return self._connection.execute("SELECT COUNT(*) FROM runs WHERE hash=? AND status=?",
+                                        (configurationHash(jsonObj), status)).fetchone()[0]
+
+    def markSynced(self, runs):
+        """
+            Mark runs whose documents were added to the datalayer (by the worker).
+
+        :param runs: list
+                list of (configuration hash, slot).
+        """
+        self._connection.executemany("UPDATE runs SET synced=1 WHERE hash=? AND slot=?", runs)
+
+    def sync(self, addDocuments, batchSize=500):
+        """
+            Push the documents of the completed runs that were not pushed.
+
+        :param addDocuments: callable
+                Gets a list of documents (dict(resource=...,dataFormat=...,type=...,desc=...)) and saves them.
+        :param batchSize: int
+                The number of runs in each call to addDocuments.
+        :return:
+            The number of runs that were pushed.
+        """
+        total = 0
+        while True:
+            rows = self._connection.execute("SELECT hash,slot,documents FROM runs WHERE status=? AND synced=0 LIMIT ?",
+                                            (COMPLETED, batchSize)).fetchall()
+            if len(rows) == 0:
+                return total
+
+            documents = []
+            for key, slot, runDocuments in rows:
+                documents += json.loads(runDocuments)
+
+            addDocuments(documents)
+            self.markSynced([(key, slot) for key, slot, runDocuments in rows])
+            total += len(rows)
+
+    def close(self):
+        self._connection.close()
+
@@ -1,26 +1,106 @@
 import multiprocessing
-import os
-from functools import partial
+import multiprocessing.util
+import copy
+import itertools
+import traceback
 import platform
 import binascii
 
 baseSeed = int(str(int(binascii.hexlify(platform.node().encode('utf-8')), 16))[-3:])
 
-def run(configuration,i):
+seedsPerTask = 50
 
-    vi = int(i % 2**32)
+scenario = None # The singleRoomScenario module, imported once in each worker.
+configurations = {} # configuration file -> (configuration,name), read once in each worker.
 
-    print("python singleRoomScenario.py %s %s" % (configuration,str(int(vi))))
-    os.system("python singleRoomScenario.py %s %s" % (configuration,str(int(vi))))
+def initWorker():
+    """
+        Import the scenario (pandas, scipy, unum and the datalayer connection) once for the worker.
+    """
+    global scenario
+    import singleRoomScenario
+    scenario = singleRoomScenario
 
+    # close the result files and add the buffered documents when the worker exits.
+    multiprocessing.util.Finalize(None,scenario.finishRuns,exitpriority=10)
 
-workers = multiprocessing.cpu_count()
-print(workers)
+def run(configuration,seeds):
+    """
+        Run the seeds of the configuration in the worker.
 
-confList = ["runningConf.json"]
+    :param configuration: str
+            The name of the configuration file.
+    :param seeds: list
+            The seeds to run.
+    :return:
+        list of (seed, None) or (seed, the traceback of the failure).
+    """
+    if configuration not in configurations:
+        configurations[configuration] = scenario.loadConfiguration(configuration)
 
-with multiprocessing.Pool(workers) as pool:
+    base,name = configurations[configuration]
+
+    ret = []
+    for i in seeds:
+        vi = int(i % 2**32)
+        print("%s %s" % (configuration,vi))
+        try:
+            model = scenario.runConfiguration(vi,copy.deepcopy(base),name)
+            if model is None:
+                # the configuration reached maxRuns or its estimates converged.
+                break
+            if model is scenario.SKIPPED:
+                # another process runs the slot, the next seed reserves another slot.
+                continue
+            ret.append((vi,None))
+        except Exception:
+            ret.append((vi,traceback.format_exc()))
+
+    return ret
+
+def runTask(task):
+    """
+        Run a task (configuration,seeds), see run.
+    :return:
+        (configuration, the results of run)
+    """
+    configuration,seeds = task
+    return configuration,run(configuration,seeds)
+
+
+if __name__=="__main__":
+
+    workers = multiprocessing.cpu_count()
+    print(workers)
+
+    confList = ["runningConf.json"]
+
+    # interleave the tasks of the configurations, so the workers of a configuration that converged
+    # (see simulation.stopping) move to the configurations that are still uncertain.
+    confTasks = []
     for j,conf in enumerate(confList):
-        rfunc = partial(run,conf)
-        pool.map(rfunc,[1e5*baseSeed+1e4*j+x for x in range(1500)])
-    
\ No newline at end of file
+        seeds = [1e5*baseSeed+1e4*j+x for x in range(1500)]
+        confTasks.append([(conf,seeds[x:x+seedsPerTask]) for x in range(0,len(seeds),seedsPerTask)])
+    tasks = [task for taskList in itertools.zip_longest(*confTasks) for task in taskList if task is not None]
+
+    failed = []
+    pool = multiprocessing.Pool(workers,initializer=initWorker)
+    for conf,results in pool.imap_unordered(runTask,tasks):
+        for seed,error in results:
+            if error is not None:
+                print("%s %s failed:\n%s" % (conf,seed,error))
+                failed.append((conf,seed))
+
+    # close (and not terminate) so that the workers close their result files and flush their documents.
+    pool.close()
+    pool.join()
+
+    print("%s runs failed" % len(failed))
+    for conf,seed in failed:
+        print(conf,seed)
+
+    initWorker()
+    for conf in confList:
+        for field,value in scenario.configurationEstimates(conf).items():
+            print("%s %s: %s +- %s (%s runs)" % (conf,field,value['mean'],value['halfWidth'],value['count']))
+    print("%s runs were added to the datalayer" % scenario.syncCatalog())
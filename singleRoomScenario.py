@@ -1,115 +1,591 @@
 from pathlib import Path
-from agentsimulation.model import getModelClass
+from agentsimulation.model import getModelClass,loadCheckpoint
 from agentsimulation.person import EXPOSED
-from hera import datalayer
+from runCatalog import RunCatalog,configurationHash
+from resultStore import ResultWriter,readResults
+from documentStore import DatalayerDocumentStore,FileDocumentStore,DocumentBuffer,PARQUET
+from pairedAnalysis import pairedDifferences
+import doseResponse
 import os
 import sys
 import json
+import glob
+import fcntl
 import pandas
 
+projectName = "Corona_singleRoom_withTalk"
+resultsPath = "results_data3"
+checkpointInterval = 600 # [s] of wall time between the checkpoints of a run.
+SKIPPED = "skipped" # returned by run when the reserved slot is run by another process.
+
+_catalog = None
+_resultWriters = {} # configuration name -> ResultWriter
+_documentStore = None
+_documentBuffer = None
+
+
+def getCatalog():
+    """
+        The run catalog of the results directory (opened once in each process).
+    """
+    global _catalog
+    if _catalog is None:
+        Path(resultsPath).mkdir(parents=True, exist_ok=True)
+        _catalog = RunCatalog(os.path.join(resultsPath,"runCatalog.sqlite"))
+    return _catalog
+
+def getResultWriter(name):
+    """
+        The result writer of the configuration (opened once in each process).
+    """
+    if name not in _resultWriters:
+        _resultWriters[name] = ResultWriter(os.path.join(resultsPath,name))
+    return _resultWriters[name]
+
+def closeResultWriters():
+    """
+        Close the files of the result writers (must be called before the process ends).
+    """
+    for writer in _resultWriters.values():
+        writer.close()
+
+def getDocumentStore():
+    """
+        The store of the run documents.
+
+        If the environment variable DOCUMENT_STORE is set, the documents are saved to that
+        JSON-lines file (no database is needed). Otherwise, they are saved to the datalayer.
+    """
+    global _documentStore
+    if _documentStore is None:
+        path = os.environ.get("DOCUMENT_STORE")
+        _documentStore = DatalayerDocumentStore(projectName) if path is None else FileDocumentStore(path,projectName)
+    return _documentStore
+
+def submitDocuments(jsonObj,slot,documents,values={}):
+    """
+        Save the documents of a completed run.
+
+        The documents are saved in the catalog and are held in the buffer of the process,
+        which adds them to the document store in bulk.
+
+        values (field -> the result of the run: secondarySick, serialIndex and infectionProbability) are added to the
+        running estimates of the configuration in the catalog (see popSweepSettings).
+    """
+    global _documentBuffer
+    if _documentBuffer is None:
+        _documentBuffer = DocumentBuffer(getDocumentStore(),onFlush=getCatalog().markSynced)
+
+    getCatalog().complete(jsonObj,slot,documents,values)
+    _documentBuffer.add((configurationHash(jsonObj),slot),documents)
+
+def finishRuns():
+    """
+        Close the result files and add the buffered documents (must be called before the process ends).
+    """
+    closeResultWriters()
+    if _documentBuffer is not None:
+        _documentBuffer.flush()
+
+def popSweepSettings(jsonObj):
+    """
+        Remove the settings of the sweep from the configuration (they are not part of the configuration hash).
+
+            - simulation.maxRuns  : the maximal number of runs.
+            - simulation.stopping : (optional) stop the configuration before maxRuns once the estimates converged:
+
+                    {"minRuns" : 200, "precision" : {"secondarySick" : 0.01, "serialIndex" : 3600}}
+
+              precision is the half-width of the 95% confidence interval of the mean of each field
+              (serialIndex in [s]). With simulation.raoBlackwell, use infectionProbability instead of
+              secondarySick (its variance is lower). With the Crowd numerical method, use attackRate.
+              See RunCatalog.converged.
+
+    :return:
+        (maxRuns, stopping dict)
+    """
+    maxRuns = jsonObj['simulation'].pop('maxRuns')
+    stopping = jsonObj['simulation'].pop('stopping',{})
+    return maxRuns,stopping
+
+def reserveRuns(jsonObj,maxRuns,name,count=1,stopping={}):
+    """
+        Claim run slots of the configuration in the run catalog.
+
+        The document store is queried only the first time the configuration is added to the catalog,
+        to count the runs that were done before.
+
+    :param jsonObj: dict
+            The configuration (without maxRuns).
+    :param maxRuns: int
+    :param name: str
+            The name of the configuration.
+    :param count: int
+            The number of runs.
+    :param stopping: dict
+            See popSweepSettings.
+    :return:
+        list of slots (empty if maxRuns was reached or the estimates converged).
+    """
+    catalog = getCatalog()
+    if not catalog.hasConfiguration(jsonObj):
+        catalog.addConfiguration(jsonObj,name,getDocumentStore().countRuns(jsonObj))
+
+    return catalog.reserve(jsonObj,maxRuns,count,precision=stopping.get('precision'),minRuns=stopping.get('minRuns',0))
+
+def syncCatalog():
+    """
+        Add the documents of the completed runs in the catalog that were not added by the workers.
+
+    :return:
+        The number of runs that were added.
+    """
+    return getCatalog().sync(getDocumentStore().addDocuments)
+
+def checkpointPath(jsonObj,slot):
+    """
+        The checkpoint file of the run in the slot of the configuration.
+    """
+    return os.path.join(resultsPath,"checkpoints",f"{configurationHash(jsonObj)}_{slot}.pkl")
+
+def _lockRun(path):
+    """
+        Lock the run of the checkpoint path (the lock is released when the process ends).
+
+    :return:
+        The open lock file, or None if the run is locked by another process.
+    """
+    Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+    lock = open(f"{path}.lock","a")
+    try:
+        fcntl.flock(lock,fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+def _removeCheckpoint(path):
+    """
+        Remove the checkpoint of a run that ended (and its lock file).
+    """
+    for fileName in [path,f"{path}.tmp",f"{path}.lock"]:
+        if os.path.exists(fileName):
+            os.remove(fileName)
+
+def _unlockRun(lock):
+    """
+        Release the lock of a run (see _lockRun).
+    """
+    lock.close()
+
+def resumeRun(jsonObj):
+    """
+        Find a run of the configuration that has a checkpoint and is not running
+        (its worker was killed) and lock it.
+
+    :return:
+        (model,runid,slot,lock) or None.
+    """
+    for path in glob.glob(checkpointPath(jsonObj,"*")):
+        lock = _lockRun(path)
+        if lock is None:
+            continue
+
+        if not os.path.exists(path):
+            # the run ended after the glob.
+            _removeCheckpoint(path)
+            _unlockRun(lock)
+            continue
+
+        model,metadata = loadCheckpoint(path)
+        return model,metadata['runid'],metadata['slot'],lock
+
+    return None
+
 def run(i,jsonObj,name):
+    """
+        Run a slot of the configuration.
 
-    projectName = "Corona_singleRoom_withTalk"
-    maxRuns = jsonObj['simulation']['maxRuns']
+        A run of the configuration that was stopped (its worker was killed or it raised an exception)
+        is resumed from its checkpoint before new slots are reserved. The checkpoint is removed only
+        when the run ends.
 
-    del jsonObj['simulation']['maxRuns']
-    casequery = datalayer.dictToMongoQuery(jsonObj, prefix="params")
+    :return:
+        The model, None if there are no slots left, or SKIPPED if the reserved slot is run by another process.
+    """
+    maxRuns,stopping = popSweepSettings(jsonObj)
 
-    docList = datalayer.Simulations.getDocuments(projectName=projectName,data="agents" ,**casequery)
-    print(len(docList))
+    resumed = resumeRun(jsonObj)
+    if resumed is not None:
+        model,i,slot,lock = resumed
+    else:
+        slots = reserveRuns(jsonObj,maxRuns,name,stopping=stopping)
+        if len(slots) == 0:
+           return
 
-    if len(docList) >= maxRuns:
-       return
+        model = None
+        slot = slots[0]
+        lock = _lockRun(checkpointPath(jsonObj,slot))
+        if lock is None:
+            # another process runs the slot.
+            getCatalog().release(jsonObj,slot)
+            return SKIPPED
+
+    path = checkpointPath(jsonObj,slot)
+    runner = _runOccupants if hasOccupants(jsonObj) else _run
+    try:
+        model = runner(i,slot,jsonObj,name,model)
+        # remove the checkpoint before the lock is released, so the run is not resumed by another process.
+        _removeCheckpoint(path)
+        return model
+    except Exception:
+        # a run that saved a checkpoint keeps its slot and is resumed later.
+        if not os.path.exists(path):
+            getCatalog().release(jsonObj,slot)
+        raise
+    finally:
+        _unlockRun(lock)
+
+def _exposureSummary(summary):
+    """
+        The exposure totals of a person (from Agent.summary).
+    """
+    ret = dict(totalExposure=float(summary['totalExposure']))
+    for key,value in summary.items():
+        if key.startswith("sum_"):
+            ret[key[4:]] = float(value)
+    return ret
+
+def runSeed(slot,jsonObj):
+    """
+        The random seed of the run in the slot.
 
-    modelCls = getModelClass(jsonObj)
+        The seed is offset by the hash of the configuration, so the slots of a configuration have different seeds
+        and different configurations do not share them.
+        With simulation.commonRandomNumbers, the seed is the slot (the replicate), so the same slot
+        of different configurations draws the same random numbers (see Model.randomStream).
+    """
+    if jsonObj['simulation'].get('commonRandomNumbers',False):
+        return slot
+    return (int(configurationHash(jsonObj),16) + slot) % 2**32
 
-    model = modelCls(jsonObj,i+len(docList))
-    model.runSimulation(jsonObj['simulation']['terminatePrimaryInfected'])
+def _run(i,slot,jsonObj,name,model=None):
 
-    primary = model.primary.history(unitless=True).assign(agent="primary")
-    secondary = model.secondary.history(unitless=True).assign(agent="secondary")
-    room = model.room.history(unitless=True)
+    if model is None:
+        modelCls = getModelClass(jsonObj)
+        model = modelCls(jsonObj,runSeed(slot,jsonObj))
+
+    path = checkpointPath(jsonObj,slot)
+    model.runSimulation(jsonObj['simulation']['terminatePrimaryInfected'],
+                        checkpoint=lambda x: x.saveCheckpoint(path,runid=i,slot=slot),
+                        checkpointInterval=checkpointInterval)
+
+    # The last row of the history and the totals of the exposure routes (see Agent.summary).
+    primary = model.primary.summary(unitless=True)
+    secondary = model.secondary.summary(unitless=True)
 
     individual_units = model.primary.hisoryUnits
     room_units = model.room.hisoryUnits
 
-    try:
-        serialIndex = secondary.iloc[-1].symptomsAppear-primary.iloc[-1].symptomsAppear
-        serialIndexLength = serialIndex.total_seconds()
-    except TypeError:
-        serialIndexLength = None
+    secondaryState = secondary['state']
+    secondaryIncubationStart = secondary['incubationStart']
+    secondarySymptoms = secondary['symptomsAppear']
 
-    try:
-        infectionDateDiff = secondary.iloc[-1].incubationStart -primary.iloc[-1].symptomsAppear
-        infectionDateDiff_sec = infectionDateDiff.total_seconds()
-    except TypeError:
-        infectionDateDiff_sec = None
+    estimate = {}
+    if model.parameters.simulation.raoBlackwell:
+        # The secondary stays susceptible (see Person._estimateInfection).
+        # The sampled outcome is the first immune system check whose uniform was below the probability.
+        sampledInfectionNs = model.secondary.sampledInfectionNs
+        if sampledInfectionNs is not None:
+            secondaryState = EXPOSED
+            secondaryIncubationStart = model.toDatetime(sampledInfectionNs)
+            secondarySymptoms = secondaryIncubationStart + model.secondary.incubationPeriod
 
-    agents = pandas.concat([primary,secondary],ignore_index=True,sort=False)
+        primarySymptoms = (primary['symptomsAppear']-model.simulationStart).total_seconds()
+        estimate = dict(infectionProbability=float(model.secondary.infectionProbability),
+                        expectedInfectionDateDiff=float(model.secondary.expectedInfectionTime-primarySymptoms))
 
+    if pandas.isnull(secondarySymptoms):
+        serialIndexLength = None
+    else:
+        serialIndex = secondarySymptoms-primary['symptomsAppear']
+        serialIndexLength = serialIndex.total_seconds()
 
+    if pandas.isnull(secondaryIncubationStart):
+        infectionDateDiff_sec = None
+    else:
+        infectionDateDiff = secondaryIncubationStart -primary['symptomsAppear']
+        infectionDateDiff_sec = infectionDateDiff.total_seconds()
 
     documentType = "coronaAgent"
     descAgents = dict(
          runid=i,
+         seed=runSeed(slot,jsonObj),
          data="agents",
-         primaryState=primary.iloc[-1].state,
-         secondaryState=secondary.iloc[-1].state,
-         secondarySick=secondary.iloc[-1].state == EXPOSED,
+         primaryState=primary['state'],
+         secondaryState=secondaryState,
+         secondarySick=bool(secondaryState == EXPOSED),
          serialIndex=serialIndexLength,
          infectionDateDiff=infectionDateDiff_sec,
+         **estimate,
+         primaryExposure=_exposureSummary(primary),
+         secondaryExposure=_exposureSummary(secondary),
          params = jsonObj,
          individual_units=individual_units,
          room_units=room_units
      )
 
-    obj = datalayer.Simulations.addDocument(projectName=projectName,
-                                      resource="",
-                                      dataFormat=datalayer.datatypes.PARQUET,
-                                      type=documentType,
-                                      desc = descAgents)
+    descRoom = dict(descAgents)
+    descRoom['data'] = "room"
 
-    basePath = os.path.join("results_data3",name,"run_%s" % str(obj.id))
-    Path(basePath).mkdir(parents=True, exist_ok=True)
-    agent_path = os.path.join(basePath,"agents.parquet")
-    obj.resource = os.path.abspath(agent_path)
-    obj.save()
+    # The runs of the configuration are appended to one dataset for each table (keyed by runid).
+    writer = getResultWriter(name)
+    agent_path = writer.tablePath("agents")
+    room_path = writer.tablePath("room")
 
-    descRoom = descAgents
-    descRoom['data'] = "room"
+    if jsonObj['simulation']['collectFullData']:
+        primaryHistory = model.primary.history(unitless=True).assign(agent="primary")
+        secondaryHistory = model.secondary.history(unitless=True).assign(agent="secondary")
+        agents = pandas.concat([primaryHistory,secondaryHistory],ignore_index=True,sort=False)
+
+        writer.write("agents",i,agents)
+        writer.write("room",i,model.room.history(unitless=True))
+
+    if model.parameters.simulation.exposureTrace:
+        writer.write("exposureTrace",i,model.secondary.exposureTrace)
+
+    submitDocuments(jsonObj,slot,[dict(resource=agent_path,
+                                       dataFormat=PARQUET,
+                                       type=documentType,
+                                       desc=descAgents),
+                                  dict(resource=room_path,
+                                       dataFormat=PARQUET,
+                                       type=documentType,
+                                       desc=descRoom)],
+                    dict(secondarySick=descAgents['secondarySick'],
+                         serialIndex=serialIndexLength,
+                         infectionProbability=estimate.get('infectionProbability')))
+
+    return model
+
+
+def hasOccupants(jsonObj):
+    """
+        True if the model of the configuration has many occupants (the Crowd numerical method or the aircabin),
+        and not a primary and a secondary.
+    """
+    return jsonObj['simulation']['numericalMethod'] == "Crowd" or \
+           jsonObj['simulation'].get('environment') == "aircabinEnvironment"
+
+def _runOccupants(i,slot,jsonObj,name,model=None):
+    """
+        Run a slot of a model of many occupants (see hasOccupants).
+
+        The occupants table has a row for each occupant (see the summary of the model).
+        The document of the run holds the number of secondary infections and the attack rate
+        (the fraction of the occupants that are not index cases that were infected).
+    """
+    if model is None:
+        modelCls = getModelClass(jsonObj)
+        model = modelCls(jsonObj,runSeed(slot,jsonObj))
+
+    path = checkpointPath(jsonObj,slot)
+    model.runSimulation(jsonObj['simulation']['terminatePrimaryInfected'],
+                        checkpoint=lambda x: x.saveCheckpoint(path,runid=i,slot=slot),
+                        checkpointInterval=checkpointInterval)
+
+    secondaryInfections = model.secondaryInfections
+    attackRate = secondaryInfections/(model.occupants-model.indexCases)
 
-    room_path = os.path.abspath(os.path.join(basePath,"room.parquet"))
-    obj = datalayer.Simulations.addDocument(projectName=projectName,
-                                      resource=room_path,
-                                      dataFormat='parquet',
-                                      type=documentType,
-                                      desc = descRoom)
+    documentType = "coronaAgent"
+    descAgents = dict(
+         runid=i,
+         seed=runSeed(slot,jsonObj),
+         data="agents",
+         occupants=model.occupants,
+         indexCases=model.indexCases,
+         secondaryInfections=secondaryInfections,
+         attackRate=attackRate,
+         params = jsonObj,
+         room_units=model.room.hisoryUnits
+     )
 
+    descRoom = dict(descAgents)
+    descRoom['data'] = "room"
+
+    writer = getResultWriter(name)
+    writer.write("occupants",i,model.summary())
     if jsonObj['simulation']['collectFullData']:
-        agents.to_parquet(agent_path, use_deprecated_int96_timestamps=True, compression='gzip')
-        room.to_parquet(room_path, use_deprecated_int96_timestamps=True, compression='gzip')
+        writer.write("room",i,model.room.history(unitless=True))
+
+    submitDocuments(jsonObj,slot,[dict(resource=writer.tablePath("occupants"),
+                                       dataFormat=PARQUET,
+                                       type=documentType,
+                                       desc=descAgents),
+                                  dict(resource=writer.tablePath("room"),
+                                       dataFormat=PARQUET,
+                                       type=documentType,
+                                       desc=descRoom)],
+                    dict(attackRate=attackRate,secondaryInfections=secondaryInfections))
+
+    return model
+
+
+def runBatched(i,jsonObj,name):
+    """
+        Run the replicates of the Batched numerical method and save the summary of each replicate.
+
+        The batch does not hold the history, so only the documents are saved (without data files).
+
+    :param i: int
+            The run id of the batch (the seed is of the first slot of the batch, see runSeed).
+    :param jsonObj: dict
+            The configuration.
+    :param name: str
+            The name of the configuration.
+    :return:
+        The model
+    """
+    maxRuns,stopping = popSweepSettings(jsonObj)
+
+    slots = reserveRuns(jsonObj,maxRuns,name,count=jsonObj['simulation'].get('replicates',1000),stopping=stopping)
+    if len(slots) == 0:
+       return
+
+    try:
+        modelCls = getModelClass(jsonObj)
+
+        model = modelCls(jsonObj,runSeed(slots[0],jsonObj),replicates=len(slots))
+        model.runSimulation(jsonObj['simulation']['terminatePrimaryInfected'])
+    except Exception:
+        for slot in slots:
+            getCatalog().release(jsonObj,slot)
+        raise
+
+    documentType = "coronaAgent"
+    for slot,runSummary in zip(slots,model.summary().to_dict(orient="records")):
+        descAgents = dict(
+             runid=i,
+             replicate=runSummary['runid'],
+             data="agents",
+             primaryState=runSummary['primaryState'],
+             secondaryState=runSummary['secondaryState'],
+             secondarySick=runSummary['secondarySick'],
+             serialIndex=runSummary['serialIndex'],
+             infectionDateDiff=runSummary['infectionDateDiff'],
+             params = jsonObj
+         )
+
+        submitDocuments(jsonObj,slot,[dict(resource="",
+                                           dataFormat=PARQUET,
+                                           type=documentType,
+                                           desc=descAgents)],
+                        dict(secondarySick=runSummary['secondarySick'],serialIndex=runSummary['serialIndex']))
 
     return model
 
 
+def compareConfigurations(configurationA,configurationB,fields=("secondarySick","secondaryExposure.totalExposure")):
+    """
+        The paired differences of the runs of two configurations (B - A), see pairedAnalysis.pairedDifferences.
+
+        The runs are paired by their seed, so the configurations should be run with simulation.commonRandomNumbers.
+
+    :param configurationA: str
+            The name of the configuration file.
+    :param configurationB: str
+    :param fields: list
+            The fields of the desc of the runs.
+    :return:
+        pandas.DataFrame
+    """
+    documents = []
+    for configuration in [configurationA,configurationB]:
+        jsonObj,name = loadConfiguration(configuration)
+        popSweepSettings(jsonObj)
+        documents.append(getDocumentStore().getDocuments(data="agents",params=jsonObj))
+
+    return pairedDifferences(documents[0],documents[1],fields=fields)
+
+def reevaluateDoseResponse(configuration,doseResponses):
+    """
+        The outcomes of the runs of the configuration for other dose responses (see doseResponse.reevaluate).
+
+        The configuration must be run with simulation.exposureTrace.
+
+    :param configuration: str
+            The name of the configuration file.
+    :param doseResponses: list
+            list of dict(name=...,params=...).
+    :return:
+        pandas.DataFrame (see doseResponse.reevaluate)
+    """
+    jsonObj,name = loadConfiguration(configuration)
+    popSweepSettings(jsonObj)
+    runids = [doc['desc']['runid'] for doc in getDocumentStore().getDocuments(data="agents",params=jsonObj)]
+    trace = readResults(os.path.join(resultsPath,name),"exposureTrace")
+    return doseResponse.reevaluate(trace,doseResponses,runids=runids)
+
+def configurationEstimates(configuration):
+    """
+        The running estimates (secondarySick, serialIndex, infectionProbability) of the configuration in the run catalog.
+
+    :param configuration: str
+            The name of the configuration file.
+    :return:
+        dict field -> dict(count=...,mean=...,halfWidth=...)
+    """
+    jsonObj,name = loadConfiguration(configuration)
+    popSweepSettings(jsonObj)
+    return getCatalog().estimates(jsonObj)
+
 def updateConf(base,newconf):
 
     def _updateConf(base,newconf):
         for k,v in newconf.items():
             if isinstance(v,dict):
-                _updateConf(base[k],newconf[k])
+                _updateConf(base.setdefault(k,{}),newconf[k])
             else:
                 base[k] = newconf[k]
     _updateConf(base,newconf)
 
-if __name__=="__main__":
+def loadConfiguration(configuration):
+    """
+        Read the running configuration and update it with the configuration file.
 
+    :param configuration: str
+            The name of the configuration file (in the configuration directory).
+    :return:
+        (the configuration dict, the name of the configuration)
+    """
     with open("configuration/runningConf.json") as file:
         base = json.load(file)
 
-    with open(os.path.join("configuration",sys.argv[1])) as file:
+    with open(os.path.join("configuration",configuration)) as file:
         conf = json.load(file)
 
     updateConf(base,conf)
-    name = sys.argv[1].split(".")[0]
-    model = run(int(sys.argv[2]),base,name)
+    name = configuration.split(".")[0]
+    return base,name
+
+def runConfiguration(i,jsonObj,name):
+    """
+        Run a seed with the numerical method of the configuration.
+
+        jsonObj is changed (maxRuns is removed), so pass a copy when running several seeds.
+
+    :return:
+        The model, None if the configuration has no slots (it reached maxRuns or converged),
+        or SKIPPED if the slot is run by another process.
+    """
+    if jsonObj['simulation']['numericalMethod'] == "Batched":
+        return runBatched(i,jsonObj,name)
+    else:
+        return run(i,jsonObj,name)
+
+if __name__=="__main__":
+
+    base,name = loadConfiguration(sys.argv[1])
+    model = runConfiguration(int(sys.argv[2]),base,name)
+    finishRuns()
+    syncCatalog()
@@ -0,0 +1,112 @@
+"""
+    The configurations of the tests.
+
+    The tests run short simulations of configuration/runningConf.json: the primary is infected after
+    a few hours and recovers after a few more, and the secondary is infected more often.
+
+    The numerical methods are compared with the Events method by the event counters of the runs
+    of the same seeds (see assertEventCountsAgree).
+"""
+import functools
+import json
+import os
+
+import numpy
+
+from agentsimulation.model import getModelClass
+
+CONFIGURATION = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),"configuration","runningConf.json")
+
+
+def shortConfiguration(numericalMethod="Events",**simulation):
+    """
+        The configuration of a short run.
+
+    :param numericalMethod: str
+    :param simulation:
+            Other fields of the simulation section.
+    :return:
+        dict (the JSON of the configuration).
+    """
+    with open(CONFIGURATION) as configurationFile:
+        conf = json.load(configurationFile)
+
+    conf['person']['physiology']['incubation']['params']['mean'] = "0.15*d"
+    conf['person']['physiology']['sickness']['period'] = "0.3*d"
+    conf['person']['actions']['immuneSystem']['doseresponse']['params']['k'] = 0.01
+    conf['simulation']['numericalMethod'] = numericalMethod
+    conf['simulation']['terminatePrimaryInfected'] = False
+    conf['simulation'].update(simulation)
+    return conf
+
+
+def meanAndError(values):
+    """
+        The mean and the standard error of the mean.
+
+    :param values: list of float
+    :return:
+        (mean,standard error)
+    """
+    values = numpy.asarray(values,dtype=float)
+    return values.mean(),values.std(ddof=1)/numpy.sqrt(len(values))
+
+
+# The event counters (agent,action) that are compared between the methods.
+COUNTERS = [("primary","talk"),("secondary","touchSurface"),("secondary","touchFace")]
+
+SEEDS = range(20)
+
+
+@functools.lru_cache(maxsize=None)
+def eventCounts(numericalMethod):
+    """
+        The number of events of the COUNTERS in the run of each seed
+        (the secondary stays susceptible, as in MeanField).
+
+        The runs of the same seed have the same incubation period of the primary in all the methods,
+        so the differences of the runs of the same seed have a lower variance.
+
+    :param numericalMethod: str
+    :return:
+        numpy.array (seed,counter)
+    """
+    counts = []
+    for seed in SEEDS:
+        conf = shortConfiguration(numericalMethod,raoBlackwell=True)
+        model = getModelClass(conf)(conf,seed)
+        model.runSimulation(False)
+
+        histories = dict([(agent.unique_id,agent.history(unitless=True)) for agent in model.agents])
+        counts.append([histories[agent][f"event_{action}"].iloc[-1] for agent,action in COUNTERS])
+    return numpy.array(counts)
+
+
+def expectedEventCounts():
+    """
+        The counts of the Events method (see eventCounts), corrected for the events that it misses:
+        it handles at most one event of an action in a step, so it counts 1-exp(-rate*dt) events
+        in a step instead of rate*dt.
+
+    :return:
+        numpy.array (seed,counter)
+    """
+    conf = shortConfiguration("Events")
+    model = getModelClass(conf)(conf,0)
+    correction = []
+    for agent,action in COUNTERS:
+        person = getattr(model,agent)
+        rate = dict([(x.name,x.frequency) for x in person._parameters.actions[person.currentState]])[action]
+        correction.append(rate*model.dt/-numpy.expm1(-rate*model.dt))
+
+    return eventCounts("Events")*numpy.array(correction)
+
+
+def assertEventCountsAgree(numericalMethod):
+    """
+        The counts of the method agree with the counts of the Events method (see expectedEventCounts).
+    """
+    differences = eventCounts(numericalMethod) - expectedEventCounts()
+    for column,(agent,action) in enumerate(COUNTERS):
+        mean,error = meanAndError(differences[:,column])
+        assert abs(mean) < 4*error, f"{agent} {action}"
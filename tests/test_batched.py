@@ -0,0 +1,73 @@
+"""
+    The Batched method agrees with the runs of the Events method.
+"""
+import numpy
+
+from agentsimulation import EXPOSED
+from agentsimulation.model import getModelClass
+from agentsimulation.room import StainStore
+
+from .common import shortConfiguration, meanAndError
+
+REPLICATES = 300
+
+# The dose response of the comparison of the infection (about 20% of the secondaries are infected).
+DOSE_RESPONSE_K = 1e-7
+
+
+def test_infection():
+    conf = shortConfiguration("Events",terminatePrimaryInfected=True,raoBlackwell=True)
+    conf['person']['actions']['immuneSystem']['doseresponse']['params']['k'] = DOSE_RESPONSE_K
+    probabilities = []
+    for seed in range(40):
+        model = getModelClass(conf)(conf,seed)
+        model.runSimulation(True)
+        probabilities.append(model.secondary.infectionProbability)
+
+    conf = shortConfiguration("Batched",terminatePrimaryInfected=True)
+    conf['person']['actions']['immuneSystem']['doseresponse']['params']['k'] = DOSE_RESPONSE_K
+    model = getModelClass(conf)(conf,1,replicates=REPLICATES)
+    model.runSimulation(True)
+    summary = model.summary()
+
+    assert len(summary) == REPLICATES
+    assert set(summary.secondaryState[summary.secondarySick]) <= {EXPOSED}
+
+    expected,expectedError = meanAndError(probabilities)
+    mean,error = meanAndError(summary.secondarySick)
+    assert 0.05 < mean < 0.5
+    assert abs(mean - expected) < 4*(error + expectedError)
+
+
+def test_mergedStainsAreTheStainStores():
+    conf = shortConfiguration("Batched")
+    room = getModelClass(conf)(conf,1,replicates=20).room
+    stores = [StainStore(room.effectiveSurfaceArea,room._parameters.negligibleStainLoad) for _ in range(20)]
+
+    # merge once at the end (the merges depend on when they are done).
+    room._mergeCount = 10**9
+    for store in stores:
+        store._mergeCount = 10**9
+    random = numpy.random.RandomState(0)
+    for step in range(2000):
+        idx = numpy.flatnonzero(random.uniform(size=20) < 0.3)
+        loads = 10**random.uniform(-9,-3,size=len(idx))
+        area = random.uniform(1e-4,1e-2)
+        room.updateStain(idx,loads,area)
+        for replicate,load in zip(idx,loads):
+            stores[replicate].add(load,area)
+
+        if step % 500 == 499:
+            factor = random.uniform(0.1,1)
+            room._surfaceDecay *= factor
+            for store in stores:
+                store.decay(factor)
+
+    room.mergeNegligible()
+    for replicate,store in enumerate(stores):
+        store.mergeNegligible()
+        count = room._stainCount[replicate]
+        assert count == store.count
+        numpy.testing.assert_allclose(room._stainLoad[replicate,:count]*room._surfaceDecay,store.viralLoad)
+        numpy.testing.assert_allclose(room._stainArea[replicate,:count],store.stainArea)
+        numpy.testing.assert_allclose(room._stainHazard[replicate,:count],store._hazard[:count])
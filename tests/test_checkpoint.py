@@ -0,0 +1,50 @@
+"""
+    A run that is resumed from a checkpoint continues the trajectory of the run.
+"""
+import pytest
+
+from agentsimulation.model import getModelClass, loadCheckpoint
+
+from .common import shortConfiguration
+
+REPLICATES = dict(Batched=20)
+
+
+class StopRun(Exception):
+    pass
+
+
+def _results(model):
+    if model.parameters.simulation.numericalMethod == "Batched":
+        return [model.summary()]
+    return [agent.history(unitless=True) for agent in model.agents]
+
+
+@pytest.mark.parametrize("numericalMethod",["Events","EquiDistance","TauLeaping","NextEvent","MeanField","Batched"])
+def test_resume(numericalMethod,tmp_path):
+    conf = shortConfiguration(numericalMethod)
+    kwargs = dict(replicates=REPLICATES[numericalMethod]) if numericalMethod in REPLICATES else {}
+    path = str(tmp_path / "checkpoint.pkl")
+
+    model = getModelClass(conf)(conf,3,**kwargs)
+    model.runSimulation(False)
+    expected = _results(model)
+
+    # save a checkpoint after the first step and stop the run.
+    steps = []
+    def checkpoint(model):
+        steps.append(model.currentTimeNs)
+        model.saveCheckpoint(path,runid=3)
+        raise StopRun()
+
+    model = getModelClass(conf)(conf,3,**kwargs)
+    with pytest.raises(StopRun):
+        model.runSimulation(False,checkpoint=checkpoint,checkpointInterval=0)
+
+    resumed,metadata = loadCheckpoint(path)
+    assert metadata == dict(runid=3)
+    assert resumed.currentTimeNs == steps[-1]
+    resumed.runSimulation(False)
+
+    for result,expectedResult in zip(_results(resumed),expected):
+        assert result.equals(expectedResult)
@@ -0,0 +1,50 @@
+"""
+    With simulation.commonRandomNumbers, runs of different configurations with the same seed are paired:
+    the streams that the change does not touch draw the same numbers.
+"""
+import pytest
+
+from agentsimulation.model import getModelClass
+
+from .common import shortConfiguration
+
+PAIRED_COLUMNS = dict(primary=["viralLoad","event_talk","event_cough","event_sneeze","expulsion_breath_talk"],
+                      secondary=["exposeFromBreath"],
+                      room=["virusConcentrationAir","change_air"])
+
+
+def _histories(washHands,commonRandomNumbers,seed=5):
+    conf = shortConfiguration("Events",commonRandomNumbers=commonRandomNumbers,raoBlackwell=True)
+    conf['person']['actions']['washHands']['frequency'] = washHands
+    model = getModelClass(conf)(conf,seed)
+    model.runSimulation(False)
+    return dict([(agent.unique_id,agent.history(unitless=True)) for agent in model.agents])
+
+
+def test_pairedRuns():
+    first = _histories("3/d",True)
+    second = _histories("30/d",True)
+
+    # the hands change, but the air is shed by the same events.
+    assert not first["secondary"].event_washHands.equals(second["secondary"].event_washHands)
+    for agent,columns in PAIRED_COLUMNS.items():
+        assert first[agent][columns].equals(second[agent][columns]), agent
+
+
+def test_sharedGeneratorIsNotPaired():
+    first = _histories("3/d",False)
+    second = _histories("30/d",False)
+    assert not first["room"][PAIRED_COLUMNS["room"]].equals(second["room"][PAIRED_COLUMNS["room"]])
+
+
+def test_sameSeedSameRun():
+    first = _histories("3/d",True)
+    second = _histories("3/d",True)
+    for agent in first:
+        assert first[agent].equals(second[agent])
+
+
+def test_onlyEventMethods():
+    conf = shortConfiguration("TauLeaping",commonRandomNumbers=True)
+    with pytest.raises(ValueError):
+        getModelClass(conf)(conf,5)
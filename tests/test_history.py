@@ -0,0 +1,56 @@
+"""
+    The decimated history keeps the exact totals of the full history.
+"""
+import numpy
+import pytest
+
+from agentsimulation.history import DecimatedRecorder, HistoryRecorder, FLOAT, DATETIME
+from agentsimulation.model import getModelClass
+
+from .common import shortConfiguration
+
+COLUMNS = [("date",DATETIME),("change",FLOAT),("level",FLOAT)]
+
+
+def _record(recorder,random,rows=1000):
+    for row in range(rows):
+        change = random.uniform() if random.uniform() < 0.1 else 0.
+        recorder.record((change,random.uniform()),(row*6*10**9,))
+
+
+@pytest.mark.parametrize("policy",[dict(steps=7),dict(interval=60*10**9),dict(eventColumns=["change"])])
+def test_recorderTotals(policy):
+    full = HistoryRecorder(COLUMNS,sumColumns=["change"])
+    decimated = DecimatedRecorder(COLUMNS,sumColumns=["change"],**policy)
+    _record(full,numpy.random.RandomState(0))
+    _record(decimated,numpy.random.RandomState(0))
+
+    fullHistory = full.toDataFrame(unitless=True)
+    history = decimated.toDataFrame(unitless=True)
+    assert len(history) < len(fullHistory)
+    assert numpy.isclose(history.change.sum(),fullHistory.change.sum(),rtol=1e-12)
+    assert history.iloc[-1].equals(fullHistory.iloc[-1].replace({"change":history.change.iloc[-1]}))
+    summary,fullSummary = decimated.summary(),full.summary()
+    assert numpy.isclose(summary["sum_change"],fullSummary["sum_change"],rtol=1e-12)
+    assert (summary["date"],summary["level"]) == (fullSummary["date"],fullSummary["level"])
+
+    # reading the history does not write the staged row.
+    assert decimated.toDataFrame(unitless=True).equals(history)
+
+
+@pytest.mark.parametrize("recording",[dict(policy="steps",steps=10),dict(policy="interval",interval="10*min"),dict(policy="onEvent")])
+def test_modelTotals(recording):
+    histories = []
+    for simulation in [{},dict(recording=recording)]:
+        conf = shortConfiguration(**simulation)
+        model = getModelClass(conf)(conf,1)
+        model.runSimulation(False)
+        histories.append([(agent.history(unitless=True),agent._summedColumns) for agent in model.agents])
+
+    for (full,summed),(history,_) in zip(*histories):
+        assert len(history) < len(full)
+        for column in summed:
+            assert numpy.isclose(numpy.nansum(history[column]),numpy.nansum(full[column]),rtol=1e-9,atol=0), column
+
+        other = [column for column in full.columns if column not in summed]
+        assert history[other].iloc[-1].equals(full[other].iloc[-1])
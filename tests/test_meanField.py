@@ -0,0 +1,60 @@
+"""
+    The MeanField method is the expectation of the stochastic methods.
+"""
+import numpy
+import scipy.integrate
+
+from agentsimulation.model import getModelClass
+from agentsimulation.room import StainStore
+
+from .common import shortConfiguration, meanAndError, assertEventCountsAgree
+
+
+def _expectedPickup(store):
+    """
+        The expected concentration on the stain that a touch takes: the sum of p_hit(k)*load_k/area_k.
+    """
+    hazard = store._hazard[:store.count]
+    survival = numpy.exp(-numpy.concatenate([[0.],hazard]))
+    return numpy.sum((survival[:-1] - survival[1:])*store.viralLoad/store.stainArea)
+
+
+def test_stainPickupIsTheMeanOfStainStore():
+    conf = shortConfiguration("MeanField")
+    model = getModelClass(conf)(conf,0)
+    room = model.room
+    params = room._parameters
+
+    rate = 1/60.        # stains per second.
+    load = 1000.
+    area = room.effectiveSurfaceArea/20
+    duration = 3600.
+
+    def derivative(t,y):
+        room.setOdeState(y)
+        room.resetRates()
+        room.updateStain(load*rate,area,rate)
+        return room.derivative()
+
+    solution = scipy.integrate.solve_ivp(derivative,(0,duration),room.odeState(),rtol=1e-8,atol=1e-12)
+    room.setOdeState(solution.y[:,-1])
+
+    random = numpy.random.RandomState(0)
+    pickups = []
+    for replicate in range(2000):
+        store = StainStore(room.effectiveSurfaceArea,params.negligibleStainLoad)
+        shedTimes = numpy.sort(random.uniform(0,duration,size=random.poisson(rate*duration)))
+        for shedTime in shedTimes:
+            store.add(load*numpy.exp(-params.decayRateSurface*(duration-shedTime)),area)
+        pickups.append(_expectedPickup(store))
+
+    mean,error = meanAndError(pickups)
+    assert abs(room.stainPickup - mean) < 4*error
+
+    # the total load of the stains/effectiveSurfaceArea (without the first hit) is about 3 times larger.
+    assert room.stainLoad/room.effectiveSurfaceArea > mean + 10*error
+
+
+def test_eventCounters():
+    # the counters hold the expected number of events since the simulation start.
+    assertEventCountsAgree("MeanField")
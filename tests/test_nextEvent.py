@@ -0,0 +1,8 @@
+"""
+    The NextEvent method agrees with the Events method.
+"""
+from .common import assertEventCountsAgree
+
+
+def test_eventCounts():
+    assertEventCountsAgree("NextEvent")
@@ -0,0 +1,46 @@
+"""
+    The configuration is compiled once to records of SI floats.
+"""
+import pytest
+
+from agentsimulation.model import getModelClass
+from agentsimulation.parameters import PERSON_STATES
+
+from .common import shortConfiguration
+
+
+def _parameters(conf):
+    return getModelClass(conf)(conf,1).parameters
+
+
+def test_siFloats():
+    parameters = _parameters(shortConfiguration())
+
+    assert parameters.person.breathingRate == pytest.approx(10e-3/60)       # 10*L/min [m**3/s]
+    assert parameters.room.roomVolume == pytest.approx(300.)                # 100*m**2 * 3*m
+    assert parameters.room.effectiveSurfaceArea == pytest.approx(180.)
+    assert parameters.person.sicknessPeriod == pytest.approx(0.3*86400)
+
+    rates = dict([(action.name,action.frequency) for action in parameters.person.actions[PERSON_STATES[0]]])
+    assert rates["talk"] == pytest.approx(4/3600.)
+    assert rates["touchSurface"] == pytest.approx(1/60.)
+
+
+def test_recordsAreFrozen():
+    parameters = _parameters(shortConfiguration())
+    with pytest.raises(AttributeError):
+        parameters.person.breathingRate = 1.
+    with pytest.raises(TypeError):
+        parameters.person.actions[PERSON_STATES[0]] = ()
+
+
+def test_wrongUnits():
+    conf = shortConfiguration()
+    conf['person']['physiology']['breathingRate'] = "10*m"
+    with pytest.raises(ValueError,match="person.physiology.breathingRate"):
+        _parameters(conf)
+
+
+def test_compiledOnce():
+    conf = shortConfiguration()
+    assert _parameters(conf) is _parameters(shortConfiguration())
@@ -0,0 +1,129 @@
+"""
+    StainStore behaves as the list of stains that it replaced.
+
+    The list of stains is touched from the oldest stain: each stain is touched with the probability
+    stainArea/effectiveSurfaceArea and the touch stops at the first stain that was touched.
+"""
+import numpy
+
+from agentsimulation.room import StainStore
+
+EFFECTIVE_SURFACE_AREA = 1.
+
+
+class StainList(object):
+    """
+        The list of stains (the baseline of StainStore).
+    """
+
+    def __init__(self):
+        self.stains = []
+
+    def add(self,viralLoad,stainArea):
+        self.stains.append(dict(stainArea=stainArea,viralLoadSurface=viralLoad))
+
+    def decay(self,factor):
+        for stain in self.stains:
+            stain["viralLoadSurface"] *= factor
+
+    def touch(self,random):
+        for stain in self.stains:
+            if random.uniform(0,1) < stain["stainArea"]/EFFECTIVE_SURFACE_AREA:
+                return stain["viralLoadSurface"],stain["stainArea"]
+        return None
+
+    def hitProbability(self):
+        probability = numpy.array([stain["stainArea"]/EFFECTIVE_SURFACE_AREA for stain in self.stains])
+        missed = numpy.concatenate([[1.],numpy.cumprod(1-probability)[:-1]])
+        return missed*probability
+
+
+def _stains(random,count=30):
+    return random.uniform(1,100,size=count),random.uniform(0.01,0.1,size=count)
+
+
+def _fill(stains,loads,areas,decay=0.99):
+    for load,area in zip(loads,areas):
+        stains.decay(decay)
+        stains.add(load,area)
+
+
+def test_loadsAndAreas():
+    loads,areas = _stains(numpy.random.RandomState(0))
+    stainList = StainList()
+    store = StainStore(EFFECTIVE_SURFACE_AREA)
+    _fill(stainList,loads,areas)
+    _fill(store,loads,areas)
+
+    assert store.count == len(stainList.stains)
+    numpy.testing.assert_allclose(store.viralLoad,[stain["viralLoadSurface"] for stain in stainList.stains],rtol=1e-12)
+    assert store.asList() == [dict(stainArea=stain["stainArea"],viralLoadSurface=load)
+                              for stain,load in zip(stainList.stains,store.viralLoad)]
+
+
+def test_touchProbability():
+    random = numpy.random.RandomState(1)
+    loads,areas = _stains(random)
+    stainList = StainList()
+    store = StainStore(EFFECTIVE_SURFACE_AREA)
+    _fill(stainList,loads,areas,decay=1.)
+    _fill(store,loads,areas,decay=1.)
+
+    # the probability that a touch takes each stain.
+    hazard = numpy.concatenate([[0.],store._hazard[:store.count]])
+    numpy.testing.assert_allclose(numpy.exp(-hazard[:-1]) - numpy.exp(-hazard[1:]),stainList.hitProbability(),rtol=1e-12)
+
+    touches = 20000
+    index = dict([(load,i) for i,load in enumerate(loads)])
+    listCounts = numpy.zeros(len(loads)+1)
+    for _ in range(touches):
+        stain = stainList.touch(random)
+        listCounts[-1 if stain is None else index[stain[0]]] += 1
+
+    storeLoads,_ = store.touchEach(random.uniform(0,1,size=touches))
+    storeCounts = numpy.zeros(len(loads)+1)
+    for load in storeLoads:
+        storeCounts[index[load] if load > 0 else -1] += 1
+
+    expected = touches*numpy.append(stainList.hitProbability(),1-stainList.hitProbability().sum())
+    for counts in [listCounts,storeCounts]:
+        assert numpy.all(numpy.abs(counts - expected) < 5*numpy.sqrt(expected) + 1)
+
+
+def test_mergeKeepsTheTotalsAndTheOrder():
+    random = numpy.random.RandomState(2)
+    loads,areas = _stains(random,count=200)
+    loads[random.uniform(size=len(loads)) < 0.7] = 1e-6
+
+    merged = StainStore(EFFECTIVE_SURFACE_AREA,negligibleLoad=1e-3)
+    store = StainStore(EFFECTIVE_SURFACE_AREA)
+    _fill(merged,loads,areas,decay=1.)
+    _fill(store,loads,areas,decay=1.)
+    merged.mergeNegligible()
+
+    assert merged.count < store.count
+    assert numpy.isclose(merged.viralLoad.sum(),store.viralLoad.sum(),rtol=1e-12)
+    assert numpy.isclose(merged.stainArea.sum(),store.stainArea.sum(),rtol=1e-12)
+
+    # the stains that are not negligible are touched with the same probability.
+    uniform = random.uniform(0,1,size=5000)
+    mergedLoads,_ = merged.touchEach(uniform)
+    storeLoads,_ = store.touchEach(uniform)
+    large = storeLoads > 1e-3
+    numpy.testing.assert_array_equal(mergedLoads[large],storeLoads[large])
+
+
+def test_addSeveralStains():
+    loads,areas = _stains(numpy.random.RandomState(3),count=100)
+    store = StainStore(EFFECTIVE_SURFACE_AREA)
+    bulk = StainStore(EFFECTIVE_SURFACE_AREA)
+    store.decay(0.5)
+    bulk.decay(0.5)
+    for load,area in zip(loads,areas):
+        store.add(load,area)
+    bulk.add(loads[:1],areas[:1])
+    bulk.add(loads[1:],areas[1:])
+
+    assert bulk.count == store.count
+    numpy.testing.assert_array_equal(bulk.viralLoad,store.viralLoad)
+    numpy.testing.assert_array_equal(bulk._hazard[:bulk.count],store._hazard[:store.count])
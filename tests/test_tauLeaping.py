@@ -0,0 +1,8 @@
+"""
+    The TauLeaping method agrees with the Events method.
+"""
+from .common import assertEventCountsAgree
+
+
+def test_eventCounts():
+    assertEventCountsAgree("TauLeaping")